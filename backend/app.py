@@ -16,20 +16,31 @@ from datetime import datetime
 import os
 
 from queue_manager import queue_manager
+from queue_journal import queue_journal, reconcile_with_upload_folder
 from printer_manager import printer_manager
+from delta_publisher import delta_publisher
+from update_dispatcher import update_dispatcher
+from dispatch_executor import dispatch_executor
+from upload_store import upload_store, printer_file_path_for
+from storage_manager import storage_manager, storage_full
+from chunked_uploads import chunked_upload_manager, upload_rejected
+from telemetry_store import telemetry_store, RESOLUTIONS
+from duration_model import duration_model
+from scheduling import get_policy
+from placement import requirements_from_metadata
 from dotenv import load_dotenv
 load_dotenv()
 from apscheduler.schedulers.background import BackgroundScheduler
 import time
-from pathlib import Path
 import base64
+import zipfile
 from jwt import decode as jwt_decode, get_unverified_header
 from jwt.exceptions import ExpiredSignatureError, InvalidTokenError
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.serialization import load_pem_public_key
 from cryptography.hazmat.backends import default_backend
 from functools import wraps
-from printing_utils import extract_bambulab_estimated_time
+from printing_utils import extract_print_metadata_async, extract_print_metadata_many_async
 from auth import validate_and_decode_jwt
 
 
@@ -37,12 +48,18 @@ from auth import validate_and_decode_jwt
  
 app = Flask(__name__, template_folder="../frontend/templates", static_folder="../frontend/static")
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "fallback_key_for_dev_only")  # Replace for production!
-socketio = SocketIO(app, cors_allowed_origins="*")
+# "threading" for the dev server, wsgi.py sets it to "gevent" before importing this file
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=os.getenv("PRINTEZ_ASYNC_MODE", "threading"))
  
 # Configuration
 app.config['UPLOAD_FOLDER'] = './uploads'
 app.config['ALLOWED_EXTENSIONS'] = {'gcode', '3mf'}
-app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # Limit file size to 10 MB
+app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # Limit request size to 10 MB, bigger files are uploaded in chunks
+app.config['MAX_CHUNKED_UPLOAD_SIZE'] = 500 * 1024 * 1024
+app.config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024
+# A whole class set in one request, as many files or one .zip
+app.config['MAX_BATCH_UPLOAD_SIZE'] = 200 * 1024 * 1024
+app.config['MAX_BATCH_FILES'] = 100
 
 
 
@@ -68,9 +85,20 @@ msal_app = ConfidentialClientApplication(
 scheduler = BackgroundScheduler()
 UID = os.getenv("UID")
 ACCESS_TOKEN = os.getenv("CLOUD_ACCESS_TOKEN")
+REFRESH_TOKEN = os.getenv("CLOUD_REFRESH_TOKEN")
 REGION = os.getenv("REGION")
-p_man = printer_manager(UID, ACCESS_TOKEN, REGION)
-q_man = queue_manager()
+p_man = printer_manager(UID, ACCESS_TOKEN, REGION, refresh_token=REFRESH_TOKEN)
+q_journal = queue_journal(os.getenv("QUEUE_DB_PATH", "./queue.db"), sync_policy=os.getenv("QUEUE_SYNC_POLICY", "batch"))
+d_model = duration_model(os.getenv("DURATION_DB_PATH", "./durations.db"))
+q_man = queue_manager(journal=q_journal, duration_model=d_model, policy=get_policy(os.getenv("SCHEDULING_POLICY", "greedy")))
+printer_times_publisher = delta_publisher()
+t_store = telemetry_store(os.getenv("TELEMETRY_DB_PATH", "./telemetry.db"))
+d_exec = dispatch_executor(p_man)
+u_store = upload_store(app.config['UPLOAD_FOLDER'], keep_idle=True)
+s_man = storage_manager(u_store, q_man, p_man, max_bytes=int(os.getenv("UPLOAD_STORAGE_MAX_BYTES", 20 * 1024**3)),
+                        is_printer_busy=lambda printer_name: d_exec.is_busy(printer_name) or p_man.printers[printer_name].gcode_state not in ("FINISH", "FAILED", "IDLE"))
+c_uploads = chunked_upload_manager(os.path.join(app.config['UPLOAD_FOLDER'], ".partial"),
+                                   max_upload_size=app.config['MAX_CHUNKED_UPLOAD_SIZE'], chunk_size=app.config['UPLOAD_CHUNK_SIZE'])
  
 def allowed_file(filename):
     """Check if a file has an allowed extension."""
@@ -80,63 +108,193 @@ def allowed_file(filename):
 
 # === Scheduled Functions ===
 
-@scheduler.scheduled_job('interval', seconds=10, kwargs={"p_man": p_man, "q_man": q_man})
+PLATE_CLEANUP_REMINDER_INTERVAL = 10
+plate_cleanup_requested_at = {}
+
 def emit_new_printer_times(p_man, q_man):
-    updated_task_infos = p_man.get_tasks_info()
+    updated_task_infos = p_man.refresh_snapshot().tasks_info
 
     for printer_name, printer_info in updated_task_infos.items():
         printer_not_printing: bool = (printer_info["gcode_state"] == "FINISH" 
                                       or printer_info["gcode_state"] == "FAILED" 
                                       or printer_info["gcode_state"] == "IDLE")
         
+        # Still uploading or starting the last print sent to the printer, or it hasn't reported that it started yet.
+        # No plate cleanup prompt and no new print until then
+        if d_exec.is_busy(printer_name):
+            continue
+
         printer_plate_is_clean = p_man.printers[printer_name]._plate_clean
         if printer_not_printing and not printer_plate_is_clean:
-            
+            # Updates are pushed as often as printers report, so only remind about the plate every so often
+            if time.time() - plate_cleanup_requested_at.get(printer_name, 0) < PLATE_CLEANUP_REMINDER_INTERVAL:
+                continue
+            plate_cleanup_requested_at[printer_name] = time.time()
+
             socketio.emit("request_plate_cleanup", {"msg": f"{printer_name} has status: {printer_info["gcode_state"]}. Please clean plate!", "printer_name": printer_name})
 
 
         elif printer_not_printing and printer_plate_is_clean:
-            next_print = q_man.get_next_print()
+            # Taken out of the queue before uploading so no other printer can get it, put back if the upload fails
+            # Only prints the printer has the nozzle and filament for
+            next_print, next_print_info = q_man.claim_next_print(p_man.get_capabilities(printer_name))
 
 
             p_man.printers[printer_name]._currently_printing = {"print_id": None, "owner": None, "filename": None}
 
             if next_print:
-                new_file_path = f'/cache/{q_man.prints[next_print]["file_path"].split("\\")[-1]}'
-                
-                p_man.upload_print(printer_name, q_man.prints[next_print]["file_path"], f"{new_file_path}")
-                # time.sleep(1) Might need to let upload finish 
+                print(f"Print, {next_print}, has been removed from queue.")
+                next_print_filename = next_print_info["filename"]
+                next_print_digest = next_print_info["digest"]
+
+                # Skip uploading if the printer already has the exact same file from an earlier print
+                new_file_path = u_store.get_printer_file(printer_name, next_print_digest) if next_print_digest else None
+                needs_upload = new_file_path is None
+                if needs_upload:
+                    new_file_path = printer_file_path_for(next_print_digest, next_print_filename) if next_print_digest else f'/cache/{next_print_filename}'
+
+                p_man.printers[printer_name]._currently_printing = {"print_id": next_print, "owner": next_print_info["owner"], "filename": next_print_filename}
+                p_man.printers[printer_name]._plate_clean = False
+
                 print(f"trying to print, {next_print}")
-                p_man.start_print_on_printer(printer_name, new_file_path)
+                d_exec.submit(printer_name, next_print, next_print_info["file_path"], new_file_path,
+                              on_done=lambda job, print_info=next_print_info: on_dispatch_done(job, print_info),
+                              upload=needs_upload, requirements=next_print_info["requirements"])
 
-                next_print_owner = q_man.prints[next_print]["owner"] 
-                next_print_filename = q_man.prints[next_print]["file_path"].split("\\")[-1]
-                
-                p_man.printers[printer_name]._currently_printing = {"print_id": next_print, "owner": next_print_owner, "filename": next_print_filename}
 
-                file_path_to_delete = Path(q_man.prints[next_print]["file_path"])
-                file_path_to_delete.unlink()
-                print_not_in_q = q_man.remove_print(next_print)
+    printer_times_patch = printer_times_publisher.publish(updated_task_infos)
+    if printer_times_patch:
+        socketio.emit("update_printer_times_patch", printer_times_patch)
 
-                if print_not_in_q:
-                    print(f"Print, {next_print}, has been removed from queue.")
+def on_dispatch_done(job, print_info):
+    """
+    Called from the dispatch executor when a print has been started on a printer, or failed to.
+    """
+    printer_name = job["printer_name"]
 
-                p_man.printers[printer_name]._plate_clean = False
+    if job["state"] == "started":
+        # Estimates that were replaced can't be compared to how long the print takes
+        d_model.start_job(printer_name, job["print_id"], print_info["slicer_estimated_time"], print_info["filament_type"],
+                          print_info["filament_grams"], learn=not print_info["estimate_flags"])
 
+        if print_info["digest"]:
+            u_store.set_printer_file(printer_name, print_info["digest"], job["printer_file_path"])
+        u_store.release(print_info["digest"], job["local_file_path"])
+        return
 
-    socketio.emit("update_printer_times", updated_task_infos)
+    # The file might not be on the printer anymore, upload it again next time
+    if print_info["digest"]:
+        u_store.forget_printer_file(printer_name, print_info["digest"])
+
+    # Nothing was printed, so the plate is still clean and the print goes back to its place in the queue
+    print(f"Print, {job['print_id']}, could not be started on {printer_name}. Putting it back in queue. Reason: {job['error']}")
+    q_man.restore_print(job["print_id"], print_info)
+    p_man.printers[printer_name]._currently_printing = {"print_id": None, "owner": None, "filename": None}
+    p_man.printers[printer_name]._plate_clean = True
 
-@scheduler.scheduled_job('interval', seconds=10, kwargs={"q_man": q_man, "p_man":p_man})
 def send_new_prelim_queue(q_man, p_man):
-    tasks_info = p_man.get_tasks_info()
+    task_times = p_man.get_snapshot().time_remaining
+
+    prelim_queue_diff = q_man.get_prelim_queue_diff(task_times)
+
+    if prelim_queue_diff:
+        socketio.emit("prelim_queue_diff", prelim_queue_diff)
+
+
+def dispatch_and_push_updates():
+    """
+    Start prints on printers that are done and push the new states and queue to the UI.
+    Called by the dispatcher, which makes sure only one call runs at a time.
+    """
+    emit_new_printer_times(p_man, q_man)
+    send_new_prelim_queue(q_man, p_man)
+
+dispatcher = update_dispatcher(dispatch_and_push_updates)
+
+
+def on_printer_update(printer_name, old_gcode_state, new_gcode_state):
+    """
+    Called on every MQTT report, a printer finishing/failing is dispatched right away, anything else is coalesced with other reports.
+    """
+    try:
+        t_store.record(printer_name, p_man.get_telemetry_sample(printer_name))
+    except Exception as e:
+        print(f"Failed to record telemetry of {printer_name}: {e}")
+
+    # A print finished, so the estimates of the prints in the queue might be corrected differently now
+    if d_model.observe(printer_name, new_gcode_state):
+        q_man.refresh_estimates()
+
+    printer_became_free = (new_gcode_state != old_gcode_state
+                           and new_gcode_state in ("FINISH", "FAILED", "IDLE"))
+    dispatcher.trigger(urgent=printer_became_free)
+
+p_man.register_update_callback(on_printer_update)
+
+
+@scheduler.scheduled_job('interval', seconds=30)
+def reconcile():
+    """
+    Fallback in case a printer stops sending reports, or something happens that doesn't trigger the dispatcher.
+    """
+    dispatcher.trigger()
+
+
+@scheduler.scheduled_job('interval', minutes=1)
+def flush_telemetry():
+    t_store.flush()
 
-    task_times = {}
-    for task_name, task_info in tasks_info.items():
-        task_times[task_name] = task_info["time_remaining"]
 
-    prelim_queue = q_man.get_prelim_queue(task_times)
+@scheduler.scheduled_job('interval', hours=1)
+def compact_queue_journal():
+    q_journal.compact()
 
-    socketio.emit("prelim_queue", prelim_queue)
+
+def should_connect_printer(device):
+    """
+    Decide what printers to connect to, for testing purposes only using one
+    """
+    return device["name"][:2] == "S4"
+
+
+@scheduler.scheduled_job('interval', minutes=5)
+def refresh_printers():
+    """
+    Connect to printers that have been bound to the cloud account since the server started.
+    """
+    try:
+        new_printers = p_man.refresh_devices(should_connect=should_connect_printer)
+    except Exception as e:
+        print(f"Failed to refresh printers from cloud: {e}")
+        return
+
+    if new_printers:
+        print(f"Connected to new printers: {new_printers}")
+        dispatcher.trigger(urgent=True)
+
+
+@scheduler.scheduled_job('interval', seconds=10)
+def sweep_uploads():
+    """
+    Delete files in the upload folder that nothing uses, a little at a time (see storage_manager.sweep).
+    """
+    deleted_files = s_man.sweep() + s_man.evict_expired()
+    if deleted_files:
+        print(f"Deleted {len(deleted_files)} unused files from the upload folder")
+
+
+@scheduler.scheduled_job('interval', hours=1)
+def prune_printer_caches():
+    pruned = s_man.prune_printer_caches()
+    for printer_name, deleted_files in pruned.items():
+        print(f"Deleted {len(deleted_files)} old uploads from the SD card of {printer_name}")
+
+
+@scheduler.scheduled_job('interval', minutes=10)
+def remove_stale_uploads():
+    removed_uploads = c_uploads.remove_stale()
+    if removed_uploads:
+        print(f"Removed {removed_uploads} chunked uploads that were never finished")
 
 
 # === Routes ===
@@ -215,6 +373,187 @@ def logout():
     return redirect(logout_url)
 
  
+def new_print_from_upload(metadata, owner, filename, stored_path, digest, file_uuid):
+    """
+    Make the params of q_man.add_new_print for an uploaded print, and the data about it that is sent to clients.
+
+    Return:
+        tuple:
+            (new_print, file_data)
+    """
+    estimated_time, estimate_flags = d_model.check_estimate(metadata)
+    if estimate_flags:
+        print(f"Estimated time of {filename} from {owner} is implausible ({', '.join(estimate_flags)}), using {estimated_time}s instead of {metadata.estimated_time}s")
+
+    new_print = {"owner": owner, "filepath": stored_path, "estim_time": estimated_time, "print_id": file_uuid, "filename": filename,
+                 "digest": digest, "filament_type": metadata.filament_type, "filament_grams": metadata.plate.filament_grams,
+                 "estimate_flags": estimate_flags, "requirements": requirements_from_metadata(metadata)}
+    file_data = {"filename": filename, "owner": owner, "uuid": str(file_uuid), "estimate_flags": estimate_flags}
+    return new_print, file_data
+
+
+def add_uploaded_print_to_queue(metadata, owner, filename, stored_path, digest, file_uuid):
+    """
+    Add an uploaded print to the queue once its metadata is known.
+    """
+    new_print, file_data = new_print_from_upload(metadata, owner, filename, stored_path, digest, file_uuid)
+    q_man.add_new_print(**new_print)
+
+    socketio.emit("file_added_to_queue", file_data)
+    dispatcher.trigger()
+
+
+def on_upload_metadata_parsed(metadata_future, owner, filename, stored_path, digest, file_uuid):
+    """
+    Called when the metadata of an uploaded file has been read, adds the print to the queue or releases the file if it isn't a valid print.
+    """
+    try:
+        metadata = metadata_future.result()
+        u_store.set_metadata(digest, metadata)
+        add_uploaded_print_to_queue(metadata, owner, filename, stored_path, digest, file_uuid)
+
+    except Exception as e:
+        print(f"Something went wrong adding file, {filename}, to queue. Failed. Error: {str(e)}")
+        if u_store.release(digest, stored_path):
+            print(f"File, {filename}, succcessfully deleted")
+
+        socketio.emit("upload_failed", {"filename": filename, "owner": owner, "uuid": str(file_uuid), "reason": str(e)})
+
+
+def queue_stored_upload(owner, filename, stored_path, digest, file_uuid):
+    """
+    Add a file that is saved in the upload store to the queue, and make the response to the upload.
+    """
+    # Same file has been uploaded before, no need to read it again
+    metadata = u_store.get_metadata(digest)
+    if metadata is not None:
+        add_uploaded_print_to_queue(metadata, owner, filename, stored_path, digest, file_uuid)
+        return jsonify({"status": "File uploaded successfully", "filename": filename, "uuid": file_uuid}), 200
+
+    # Reading the metadata is done in the background, the print is added to the queue when it's done
+    metadata_future = extract_print_metadata_async(stored_path)
+    metadata_future.add_done_callback(
+        lambda future: on_upload_metadata_parsed(future, owner, filename, stored_path, digest, file_uuid))
+
+    return jsonify({"status": "File uploaded, adding to queue", "filename": filename, "uuid": file_uuid}), 202
+
+
+def on_batch_metadata_parsed(batch_future, owner, parsed, unparsed):
+    """
+    Called when every file of a batch upload that wasn't parsed before has been read. All the valid prints are added to the queue at once,
+    and clients get one files_added_to_queue event for the whole batch.
+
+    Params:
+        batch_future (Future) - from extract_print_metadata_many_async, one result per file in unparsed
+        owner (str) - who uploaded the batch
+        parsed (list[tuple]) - (metadata, filename, stored_path, digest, file_uuid) of files whose metadata was already known
+        unparsed (list[tuple]) - (filename, stored_path, digest, file_uuid) of the files that were parsed
+    """
+    failed = []
+    for (filename, stored_path, digest, file_uuid), result in zip(unparsed, batch_future.result()):
+        if isinstance(result, Exception):
+            print(f"Something went wrong adding file, {filename}, to queue. Failed. Error: {str(result)}")
+            u_store.release(digest, stored_path)
+            failed.append({"filename": filename, "uuid": str(file_uuid), "reason": str(result)})
+            continue
+
+        u_store.set_metadata(digest, result)
+        parsed.append((result, filename, stored_path, digest, file_uuid))
+
+    files_data = []
+    try:
+        new_prints = []
+        for metadata, filename, stored_path, digest, file_uuid in parsed:
+            new_print, file_data = new_print_from_upload(metadata, owner, filename, stored_path, digest, file_uuid)
+            new_prints.append(new_print)
+            files_data.append(file_data)
+
+        q_man.add_new_prints(new_prints)
+
+    except Exception as e:
+        # Nothing of the batch is in the queue, see queue_manager.add_new_prints
+        print(f"Something went wrong adding a batch of {len(parsed)} files from {owner} to queue. Failed. Error: {str(e)}")
+        for _, filename, stored_path, digest, file_uuid in parsed:
+            u_store.release(digest, stored_path)
+            failed.append({"filename": filename, "uuid": str(file_uuid), "reason": str(e)})
+        files_data = []
+
+    socketio.emit("files_added_to_queue", {"owner": owner, "files": files_data, "failed": failed})
+    if files_data:
+        dispatcher.trigger()
+
+
+def save_batch_file(stream, filename, stored, rejected):
+    """
+    Save one file of a batch upload to the upload store, or note why it wasn't.
+    """
+    if len(stored) >= app.config['MAX_BATCH_FILES']:
+        rejected.append({"filename": filename, "reason": f"More than {app.config['MAX_BATCH_FILES']} files in batch"})
+        return
+    if not allowed_file(filename):
+        rejected.append({"filename": filename, "reason": "Invalid file type"})
+        return
+
+    filename = secure_filename(filename)
+    digest, stored_path = u_store.save_stream(stream, filename)
+    stored.append((filename, stored_path, digest, q_man.get_uuid()))
+
+
+def save_batch_archive(archive_file, stored, rejected):
+    """
+    Save every print file in a .zip of a batch upload, folders in it are ignored.
+    """
+    try:
+        archive = zipfile.ZipFile(archive_file.stream)
+    except zipfile.BadZipFile:
+        rejected.append({"filename": archive_file.filename, "reason": "Not a valid .zip file"})
+        return
+
+    with archive:
+        members = [info for info in archive.infolist() if not info.is_dir() and not os.path.basename(info.filename).startswith(".")]
+        # Checked before extracting anything, so a small archive can't fill the disk
+        extracted_size = sum(info.file_size for info in members)
+        if extracted_size > app.config['MAX_BATCH_UPLOAD_SIZE']:
+            rejected.append({"filename": archive_file.filename, "reason": "Archive is too big when extracted"})
+            return
+
+        # Room was only made for the compressed request, the extracted files can be much bigger
+        try:
+            s_man.make_room(extracted_size)
+        except storage_full as e:
+            rejected.append({"filename": archive_file.filename, "reason": f"Not enough storage: {str(e)}"})
+            return
+
+        for info in members:
+            with archive.open(info) as member:
+                save_batch_file(member, os.path.basename(info.filename), stored, rejected)
+
+
+def get_session_owner():
+    """
+    Get the email of the logged in user.
+
+    Return:
+        tuple:
+            (owner, None), or (None, error response) if the user isn't logged in
+    """
+    id_token = session.get("id_token")
+    if not id_token:
+        return None, (jsonify({"error": "User not authenticated"}), 401)
+
+    try:
+        decoded_id_token = validate_and_decode_jwt(id_token)
+        owner = decoded_id_token.get("email")
+
+        if not owner:
+            return None, (jsonify({"error": "Unable to determine file owner from ID token"}), 400)
+
+    except ValueError as e:
+        return None, (jsonify({"error": f"Token validation failed: {str(e)}"}), 401)
+
+    return owner, None
+
+
 @app.route("/upload", methods=["POST"])
 def upload_file():
     """
@@ -246,45 +585,204 @@ def upload_file():
     
     if allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
 
-        # Try to save file to upload dir
+        try:
+            s_man.make_room(request.content_length or 0)
+        except storage_full as e:
+            return jsonify({"error": f"Not enough storage for file: {str(e)}"}), 507
+
+        # Try to save file to upload dir, files are stored by their hash so the same file is only stored once
         try:
             file_uuid = q_man.get_uuid()
-            filepath_parts = filepath.split(".", 2)
-            filepath_with_uuid = f".{filepath_parts[1]}_{str(file_uuid)}.{filepath_parts[2]}"
+            digest, stored_path = u_store.save_stream(file.stream, filename)
 
-            file.save(filepath_with_uuid)
-        
         except Exception as e:
             print(f"Failed to save file, {filename}. Reason: {str(e)}")
-            
+
             return jsonify({"error": f"File saving error: {str(e)}"}), 500
 
-        try:
-            estimated_time = extract_bambulab_estimated_time(filepath_with_uuid)
+        return queue_stored_upload(owner, filename, stored_path, digest, file_uuid)
 
-            file_uuid, _ = q_man.add_new_print(owner, filepath, estimated_time, file_uuid)
-            file_data = {"filename": filename, "owner": owner}
+    return jsonify({"error": "Invalid file type"}), 400
 
-            socketio.emit("file_added_to_queue", file_data)
-            return jsonify({"status": "File uploaded successfully", "filename": file.filename, "uuid": file_uuid}), 200
 
-        except Exception as e:
-            print(f"Something went wrong adding file, {filename}, to queue. Failed. Error: {str(e)}")
-            print(f"Deleting file from server")
-            file_to_delete = Path(filepath_with_uuid)
-            file_to_delete.unlink()
-            if file_to_delete.is_file():
-                print("*** WARNING ***")
-                print("File not deleted???")
+@app.route("/upload/batch", methods=["POST"])
+def upload_batch():
+    """
+    Upload many files at once, as several "files" in the form and/or .zip archives of them. The files are parsed in the background and
+    every valid print is added to the queue at the same time, see on_batch_metadata_parsed.
+    """
+    owner, error_response = get_session_owner()
+    if error_response:
+        return error_response
 
+    # A batch is allowed to be bigger than a single upload, has to be set before the form is read
+    request.max_content_length = app.config['MAX_BATCH_UPLOAD_SIZE']
+    try:
+        s_man.make_room(request.content_length or 0)
+    except storage_full as e:
+        return jsonify({"error": f"Not enough storage for batch: {str(e)}"}), 507
+
+    files = [file for file in request.files.getlist("files") if file.filename]
+    if not files:
+        return jsonify({"error": "No files selected"}), 400
+
+    stored = []
+    rejected = []
+    try:
+        for file in files:
+            if file.filename.lower().endswith(".zip"):
+                save_batch_archive(file, stored, rejected)
             else:
-                print(f"File, {filename}, succcessfully deleted")
+                save_batch_file(file.stream, file.filename, stored, rejected)
 
-            return jsonify({"error": "Unable to add file to queue.", "reason": f"{str(e)}"}), 500
+    except Exception as e:
+        print(f"Failed to save batch from {owner}. Reason: {str(e)}")
+        for _, stored_path, digest, _ in stored:
+            u_store.release(digest, stored_path)
 
-    return jsonify({"error": "Invalid file type"}), 400
+        return jsonify({"error": f"File saving error: {str(e)}"}), 500
+
+    if not stored:
+        return jsonify({"error": "No valid print files in batch", "rejected": rejected}), 400
+
+    # Files that have been uploaded before don't have to be read again
+    parsed = []
+    unparsed = []
+    for filename, stored_path, digest, file_uuid in stored:
+        metadata = u_store.get_metadata(digest)
+        if metadata is not None:
+            parsed.append((metadata, filename, stored_path, digest, file_uuid))
+        else:
+            unparsed.append((filename, stored_path, digest, file_uuid))
+
+    batch_future = extract_print_metadata_many_async([stored_path for _, stored_path, _, _ in unparsed])
+    batch_future.add_done_callback(lambda future: on_batch_metadata_parsed(future, owner, parsed, unparsed))
+
+    return jsonify({"status": "Files uploaded, adding to queue",
+                    "files": [{"filename": filename, "uuid": file_uuid} for filename, _, _, file_uuid in stored],
+                    "rejected": rejected}), 202
+
+
+@app.route("/upload/chunked", methods=["POST"])
+def start_chunked_upload():
+    """
+    Start an upload that is sent in chunks, for files bigger than MAX_CONTENT_LENGTH.
+    Takes json {"filename": str, "size": int}, chunks are then sent with PUT /upload/chunked/<upload_id>?offset=<offset>.
+    The last chunk should be sent first, so a file that isn't a valid print is rejected before the rest is sent.
+    """
+    owner, error_response = get_session_owner()
+    if error_response:
+        return error_response
+
+    upload_request = request.get_json(silent=True) or {}
+    filename = secure_filename(str(upload_request.get("filename", "")))
+    if filename == "" or not allowed_file(filename):
+        return jsonify({"error": "Invalid file type"}), 400
+
+    try:
+        size = int(upload_request.get("size", 0))
+        s_man.make_room(size)
+        upload = c_uploads.create(owner, filename, size)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    except storage_full as e:
+        return jsonify({"error": f"Not enough storage for file: {str(e)}"}), 507
+
+    return jsonify(c_uploads.get_status(upload)), 201
+
+
+def get_owned_upload(upload_id):
+    """
+    Get a chunked upload that belongs to the logged in user.
+
+    Return:
+        tuple:
+            (upload, None), or (None, error response)
+    """
+    owner, error_response = get_session_owner()
+    if error_response:
+        return None, error_response
+
+    upload = c_uploads.get(upload_id)
+    if upload is None:
+        return None, (jsonify({"error": "Upload not found"}), 404)
+    if upload["owner"] != owner:
+        return None, (jsonify({"error": "Upload doesn't belong to user"}), 403)
+
+    return upload, None
+
+
+@app.route("/upload/chunked/<upload_id>", methods=["GET"])
+def chunked_upload_status(upload_id):
+    """
+    What has been received of an upload, used to resume it after losing connection.
+    """
+    upload, error_response = get_owned_upload(upload_id)
+    if error_response:
+        return error_response
+
+    return jsonify(c_uploads.get_status(upload)), 200
+
+
+@app.route("/upload/chunked/<upload_id>", methods=["PUT"])
+def upload_chunk(upload_id):
+    """
+    Receive a chunk of an upload, the body is the raw bytes of the chunk. When the last missing chunk arrives the file is added to the queue.
+    """
+    upload, error_response = get_owned_upload(upload_id)
+    if error_response:
+        return error_response
+
+    try:
+        offset = int(request.args.get("offset", ""))
+    except ValueError:
+        return jsonify({"error": "Missing offset"}), 400
+
+    if not request.content_length:
+        return jsonify({"error": "Missing chunk"}), 400
+
+    try:
+        complete = c_uploads.write_chunk(upload, offset, request.stream, request.content_length)
+
+    except upload_rejected as e:
+        print(f"Rejected chunked upload of {upload['filename']}. Reason: {str(e)}")
+        return jsonify({"error": str(e)}), 422
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    except Exception as e:
+        print(f"Failed to save chunk of {upload['filename']}. Reason: {str(e)}")
+        return jsonify({"error": f"File saving error: {str(e)}"}), 500
+
+    if not complete:
+        return jsonify(c_uploads.get_status(upload)), 200
+
+    try:
+        file_uuid = q_man.get_uuid()
+        temp_path, digest = c_uploads.finish(upload)
+        digest, stored_path = u_store.add_file(temp_path, upload["filename"], digest)
+
+    except ValueError:
+        # Another request has already finished the upload, e.g. the last chunk was sent again
+        return jsonify(c_uploads.get_status(upload)), 200
+
+    except Exception as e:
+        print(f"Failed to save file, {upload['filename']}. Reason: {str(e)}")
+        return jsonify({"error": f"File saving error: {str(e)}"}), 500
+
+    return queue_stored_upload(upload["owner"], upload["filename"], stored_path, digest, file_uuid)
+
+
+@app.route("/upload/chunked/<upload_id>", methods=["DELETE"])
+def cancel_chunked_upload(upload_id):
+    upload, error_response = get_owned_upload(upload_id)
+    if error_response:
+        return error_response
+
+    c_uploads.cancel(upload)
+    return jsonify({"status": "Upload cancelled"}), 200
 
 
 @app.route("/cancel/<print_id>", methods=["POST"])
@@ -303,8 +801,8 @@ def cancel_print(print_id):
         return jsonify({"error": f"Token validation failed: {str(e)}"}), 401
     
 
-    if print_id in q_man.prints:
-        print_in_queue = q_man.prints[print_id]
+    print_in_queue = q_man.get_print(print_id)
+    if print_in_queue:
 
         print_owner = print_in_queue["owner"]
 
@@ -313,12 +811,14 @@ def cancel_print(print_id):
 
         # needs to verify that owner sent request
 
-        filepath_to_delete = Path(print_in_queue["file_path"])
-        filepath_to_delete.unlink()
-        
-        q_man.remove_print(print_id)
+        # Only delete the file if the print was still in queue, it might have been claimed by a printer since it was looked up
+        removed, _ = q_man.remove_print(print_id)
+        if not removed:
+            return "Print has already been sent to a printer", 409
 
-        send_new_prelim_queue(q_man, p_man)
+        u_store.release(print_in_queue["digest"], print_in_queue["file_path"])
+
+        dispatcher.trigger(urgent=True)
 
         return "Print succesfully removed", 200
 
@@ -340,6 +840,76 @@ def cancel_print(print_id):
         
 
 
+@app.route("/printers/health", methods=["GET"])
+def printers_health():
+    """
+    Connection health of every printer, see printer_manager.get_connection_health
+    """
+    return jsonify(p_man.get_connection_health()), 200
+
+
+@app.route("/printers/files", methods=["GET"])
+def find_printer_files():
+    """
+    Find files on the SD cards of the printers by ?name= and/or ?digest=, answered from the cache (see sdcard_cache.py).
+    """
+    name = request.args.get("name")
+    digest = request.args.get("digest")
+    if not name and not digest:
+        return jsonify({"error": "name or digest is required"}), 400
+
+    return jsonify(p_man.find_sdcard_files(name, digest)), 200
+
+
+@app.route("/storage", methods=["GET"])
+def storage_usage():
+    """
+    How much of the upload folder's budget is used.
+    """
+    return jsonify(s_man.get_usage()), 200
+
+
+@app.route("/queue/owners", methods=["GET"])
+def queue_owner_stats():
+    """
+    How many seconds of printing every owner has in the queue and has printed, see queue_manager.get_owner_stats.
+    """
+    return jsonify(q_man.get_owner_stats()), 200
+
+
+@app.route("/durations", methods=["GET"])
+def print_durations():
+    """
+    How much longer than their estimate prints take, per printer and filament, as learned by the duration_model.
+    """
+    return jsonify(d_model.get_stats()), 200
+
+
+@app.route("/telemetry/<printer_name>", methods=["GET"])
+def printer_telemetry(printer_name):
+    """
+    History of a printer's reports, for graphs on the dashboard.
+    Query params: since (seconds back from now, default 3600), until (seconds back from now, default 0) and resolution ("raw", "minute" or "hour",
+    default is the most detailed one that covers the range). Returns columns, see telemetry_store.query
+    """
+    printer_name:str = printer_name.replace("_", " ")
+    if printer_name not in p_man.printers:
+        return jsonify({"error": "No printer with that name connected"}), 404
+
+    resolution = request.args.get("resolution")
+    if resolution is not None and resolution not in RESOLUTIONS:
+        return jsonify({"error": f"resolution has to be one of {RESOLUTIONS}"}), 400
+
+    try:
+        since = float(request.args.get("since", 3600))
+        until = float(request.args.get("until", 0))
+    except ValueError:
+        return jsonify({"error": "since and until have to be numbers of seconds"}), 400
+
+    now = time.time()
+    return jsonify(t_store.query(printer_name, now - since, now - until, resolution=resolution)), 200
+
+
 @app.route("/plate_is_clean/<printer_name>", methods=["POST"])
 def plate_clean_confirmation(printer_name):
     """
@@ -348,10 +918,15 @@ def plate_clean_confirmation(printer_name):
     printer_name:str = printer_name.replace("_", " ")
 
     try:
+        # Its reports are still from before the print it was just sent, the prompt was for that state
+        if d_exec.is_busy(printer_name):
+            return f"{printer_name} is starting a print", 409
+
         p_man.printers[printer_name]._plate_clean = True
         p_man.printers[printer_name]._currently_printing = {"print_id": None, "owner": None, "filename": None}
 
         socketio.emit("plate_is_clean", {"msg": f"{printer_name}'s plate has been cleaned", "printer_name": printer_name})
+        dispatcher.trigger(urgent=True)
 
         return "Thank You. +500 PrintEzCredit"
     
@@ -368,36 +943,69 @@ def plate_clean_confirmation(printer_name):
 @socketio.on("connect")
 def handle_connect():
     """Handle client connection."""
-    tasks_infos = p_man.get_tasks_info()
+    if not printer_times_publisher.has_published():
+        printer_times_publisher.publish(p_man.get_snapshot().tasks_info)
+
+    # New clients get the last published queue, since that's what the following diffs are based on
+    if q_man.get_published_prelim_queue()["version"] == 0:
+        send_new_prelim_queue(q_man, p_man)
+
+    emit("update_printer_times", printer_times_publisher.get_full())
+    emit("prelim_queue", q_man.get_published_prelim_queue())
 
-    task_times = {}
-    for task_name, task_info in tasks_infos.items():
-        task_times[task_name] = task_info["time_remaining"]
 
-    prelim_queue = q_man.get_prelim_queue(task_times)
-    emit("update_printer_times", tasks_infos)
-    emit("prelim_queue", prelim_queue)
+@socketio.on("update_printer_times_resync")
+def handle_printer_times_resync():
+    """Resend the whole state of all printers to a client that missed a patch."""
+    emit("update_printer_times", printer_times_publisher.get_full())
+
+
+@socketio.on("prelim_queue_resync")
+def handle_prelim_queue_resync():
+    """Resend the whole preliminary queue to a client that missed a diff."""
+    emit("prelim_queue", q_man.get_published_prelim_queue())
  
  
-if __name__ == "__main__":
+def start_background_services():
+    """
+    Load the queue, connect to the printers and start the scheduled functions, used by both the dev server below and wsgi.py.
+    """
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    # Chunked uploads only live in memory, so ones from before the restart can't be resumed
+    c_uploads.clear_partial_files()
+
+    # Get back the queue from before the server was restarted
+    prints_loaded = q_man.load_from_journal()
+    missing_prints = reconcile_with_upload_folder(q_man)
+    u_store.rebuild_refcounts(q_man.prints)
+    print(f"Loaded {prints_loaded} prints from queue journal, {len(missing_prints)} had lost their file, {u_store.get_usage()['idle_files']} idle uploads kept")
  
 
     devices = p_man.get_devices()
-    
-    # Decide what printers to connect to, for testing purposes only using one
-    printers_to_connect = []
-    for device in devices:
-        if device["name"][:2] == "S4":
-            printers_to_connect.append(device)
-
-    p_man.connect_printers(printers_to_connect)
-    time.sleep(1) # Should always do after connecting printers 
+    printers_ready = p_man.connect_printers([device for device in devices if should_connect_printer(device)])
+    print(f"Connected to {sum(printers_ready.values())}/{len(printers_ready)} printers")
+    p_man.start_supervisor()
 
 
+    dispatcher.start()
     scheduler.start()
+
+
+def stop_background_services():
+    scheduler.shutdown(wait=False)
+    p_man.stop_supervisor()
+    dispatcher.stop()
+    d_exec.shutdown()
+    q_journal.close()
+    t_store.close()
+    d_model.close()
+    p_man.disconnect_printers()
+
+
+if __name__ == "__main__":
+    start_background_services()
  
-    # Run Flask app with SocketIO
+    # Run Flask app with SocketIO, this is the dev server, see wsgi.py for running in production
     socketio.run(app, debug=True, host="localhost")
     time.sleep(1)
-    p_man.disconnect_printers()
+    stop_background_services()
@@ -15,6 +15,10 @@ from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.serialization import load_pem_public_key
 from cryptography.hazmat.backends import default_backend
 from functools import wraps
+from collections import OrderedDict
+import hashlib
+import threading
+import time
 import os
 from dotenv import load_dotenv
 
@@ -27,7 +31,6 @@ AUTHORITY = f"https://login.microsoftonline.com/{TENANT_ID}"
 REDIRECT_PATH = os.getenv("REDIRECT_PATH")
 SCOPES = os.getenv("SCOPES").split(",")
 JWKS_URI = f"{AUTHORITY}/discovery/v2.0/keys"
-MICROSOFT_PUBLIC_KEYS = None
 
 def jwk_to_rsa_key(jwk):
     n = int.from_bytes(base64.urlsafe_b64decode(jwk["n"] + "=="), "big")
@@ -35,35 +38,163 @@ def jwk_to_rsa_key(jwk):
     return rsa.RSAPublicNumbers(e, n).public_key(default_backend())
 
 
+class jwks_key_store():
+    """
+    The public keys Microsoft signs tokens with, indexed by kid (key id) and already turned into RSA key objects.
+    The keys are fetched the first time they're needed, refreshed in the background every ttl seconds, and refetched right away when a
+    token uses a kid that isn't known (Microsoft rotates its keys). Only one thread fetches at a time, others wait for its result.
+    """
+    def __init__(self, jwks_uri: str, ttl: float = 3600, min_refetch_interval: float = 60, timeout: float = 10):
+        """
+        Params:
+            jwks_uri (str) - url to fetch the keys from
+            ttl (float) - seconds between background refreshes
+            min_refetch_interval (float) - shortest time in seconds between fetches caused by unknown kids, so bad tokens can't spam Microsoft
+            timeout (float) - timeout in seconds for fetching the keys
+        """
+        self.jwks_uri = jwks_uri
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+
+        self.jwks = None
+        self._keys = {}
+        self._fetched_at = 0
+
+        self._lock = threading.Lock()
+        self._fetch_in_flight = None
+        self._refresher = None
+
+    def refresh(self):
+        """
+        Fetch the keys. If another thread is already fetching them, wait for it instead of fetching again.
+        """
+        with self._lock:
+            fetch_done = self._fetch_in_flight
+            should_fetch = fetch_done is None
+            if should_fetch:
+                fetch_done = self._fetch_in_flight = threading.Event()
+
+        if not should_fetch:
+            fetch_done.wait(self.timeout)
+            return
+
+        try:
+            response = requests.get(self.jwks_uri, timeout=self.timeout)
+            response.raise_for_status()
+            jwks = response.json()["keys"]
+
+            keys = {}
+            for jwk in jwks:
+                if jwk.get("kty") == "RSA" and "kid" in jwk:
+                    keys[jwk["kid"]] = jwk_to_rsa_key(jwk)
+
+            # Swapped in as a whole, so readers never see half of the new keys
+            self.jwks = jwks
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+
+        finally:
+            with self._lock:
+                self._fetch_in_flight = None
+            fetch_done.set()
+
+    def get_key(self, kid: str):
+        """
+        Get the public key with the given kid.
+
+        Return:
+            RSAPublicKey | None:
+                the key, None if Microsoft doesn't have a key with that kid
+        """
+        key = self._keys.get(kid)
+        if key is not None:
+            return key
+
+        if self.jwks is None or time.monotonic() - self._fetched_at > self.min_refetch_interval:
+            self.refresh()
+            self._start_background_refresh()
+
+        return self._keys.get(kid)
+
+    def _start_background_refresh(self):
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_periodically, name="jwks_refresh", daemon=True)
+        self._refresher.start()
+
+    def _refresh_periodically(self):
+        while True:
+            time.sleep(self.ttl)
+            try:
+                self.refresh()
+            except Exception as e:
+                # Old keys are kept, they're most likely still valid
+                print(f"Failed to refresh Microsoft public keys. Error: {e}")
+
+
+class verified_token_cache():
+    """
+    Claims of tokens that have already been verified, so that the same token doesn't have to be verified with RSA on every request.
+    Tokens are stored by their sha256 and are never returned after they expire. Holds at most max_size tokens, least recently used is dropped first.
+    """
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._tokens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        token_hash = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            cached = self._tokens.get(token_hash)
+            if cached is None:
+                return None
+
+            claims, expires_at = cached
+            if expires_at <= time.time():
+                del self._tokens[token_hash]
+                return None
+
+            self._tokens.move_to_end(token_hash)
+            return dict(claims)
+
+    def put(self, token: str, claims: dict):
+        if "exp" not in claims:
+            return
+
+        token_hash = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            self._tokens[token_hash] = (dict(claims), claims["exp"])
+            self._tokens.move_to_end(token_hash)
+            while len(self._tokens) > self.max_size:
+                self._tokens.popitem(last=False)
+
+
+key_store = jwks_key_store(JWKS_URI)
+token_cache = verified_token_cache()
+
+
 def get_public_keys():
     """
     Fetch the public keys from Microsoft.
     """
-    global MICROSOFT_PUBLIC_KEYS
-    if MICROSOFT_PUBLIC_KEYS is None:
-        response = requests.get(JWKS_URI)
-        response.raise_for_status()
-        MICROSOFT_PUBLIC_KEYS = response.json()["keys"]
-    return MICROSOFT_PUBLIC_KEYS
+    if key_store.jwks is None:
+        key_store.refresh()
+    return key_store.jwks
 
 
 def validate_and_decode_jwt(token):
     """
     Validate and decode the given JWT.
     """
-    try:
-        # Decode without signature verification for debugging
-        unverified_token = jwt_decode(token, options={"verify_signature": False})
+    cached_claims = token_cache.get(token)
+    if cached_claims is not None:
+        return cached_claims
 
-        # Fetch and match the JWKS keys
-        get_public_keys()
+    try:
         unverified_header = get_unverified_header(token)
-        rsa_key = None
-
-        for key in MICROSOFT_PUBLIC_KEYS:
-            if key["kid"] == unverified_header["kid"]:
-                rsa_key = jwk_to_rsa_key(key)
-                break
+        rsa_key = key_store.get_key(unverified_header.get("kid"))
 
         if not rsa_key:
             raise ValueError("Unable to find a matching key for token validation.")
@@ -76,6 +207,7 @@ def validate_and_decode_jwt(token):
             audience=CLIENT_ID,
             issuer=f"{AUTHORITY}/v2.0",
         )
+        token_cache.put(token, decoded_token)
         return decoded_token
 
     except ExpiredSignatureError:
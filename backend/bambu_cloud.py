@@ -0,0 +1,307 @@
+"""
+File: bambu_cloud.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-03-03
+Description: Module with the bambu_cloud_client class, a client for the Bambu Lab cloud API used by printer_manager.
+
+All requests go through one requests.Session, so the TLS connection to the cloud is kept alive and reused instead of being set up again
+for every request. Requests have a timeout, and requests that fail because of the connection, rate limiting (429) or the server (5xx) are
+retried with exponential backoff. When the access token has expired (401) it's refreshed with the refresh token and the request is sent again.
+The device list is cached for cache_ttl seconds, and after that only fetched again if it has changed (ETag), if the server supports it.
+"""
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+DEVICES_ENDPOINT = "/v1/iot-service/api/user/bind"
+REFRESH_TOKEN_ENDPOINT = "/v1/user-service/user/refreshtoken"
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class cloud_error(Exception):
+    """
+    Raised when a request to the cloud fails, after it has been retried.
+    """
+
+
+class cloud_auth_error(cloud_error):
+    """
+    Raised when the cloud doesn't accept the access token, and it couldn't be refreshed.
+    """
+
+
+class bambu_cloud_client():
+    def __init__(self, access_token: str, refresh_token: str | None = None, host: str = "https://api.bambulab.com",
+                 timeout: tuple[float, float] = (5, 15), max_retries: int = 4, backoff: float = 0.5, max_backoff: float = 8,
+                 cache_ttl: float = 60, on_token_refreshed=None):
+        """
+        Params:
+            access_token (str) - token used for all requests
+            refresh_token (str | None) - token used to get a new access_token when it expires, without it the access_token is never refreshed
+            host (str) - url of the cloud
+            timeout (tuple) - (connect, read) timeout in seconds of every request
+            max_retries (int) - times a request is retried before giving up
+            backoff (float) - seconds to wait before the first retry, doubled for every retry after it
+            max_backoff (float) - most seconds to wait before a retry
+            cache_ttl (float) - seconds the device list is used without asking the cloud again
+            on_token_refreshed (function | None) - called with (access_token, refresh_token) after the tokens have been refreshed
+        """
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.host = host
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cache_ttl = cache_ttl
+        self.on_token_refreshed = on_token_refreshed
+
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self._session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        # User agent needs to be specified to something, ohterwise bambulabs blocks it for some reason?!??!?!
+        self._session.headers["User-Agent"] = "curl/7.68.0"
+
+        self._token_lock = threading.Lock()
+        self._devices_lock = threading.Lock()
+        self._devices = None
+        self._devices_etag = None
+        self._devices_fetched_at = 0.0
+
+    def request(self, method: str, endpoint: str, authenticated: bool = True, **kwargs):
+        """
+        Send a request to the cloud, retrying it if it fails and refreshing the access token if it has expired.
+
+        Params:
+            method (str) - HTTP method
+            endpoint (str) - path of the endpoint, e.g. "/v1/iot-service/api/user/bind"
+            authenticated (bool) - whether to send the access token
+            kwargs - passed on to requests
+
+        Return:
+            requests.Response:
+                the response, can be 2xx or 304
+
+        Exceptions:
+            - cloud_auth_error if the access token isn't accepted and couldn't be refreshed
+            - cloud_error if the request failed every time it was tried
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        refreshed_token = False
+        attempt = 0
+
+        while True:
+            headers = dict(kwargs.pop("headers", None) or {})
+            if authenticated:
+                headers["Authorization"] = f"Bearer {self.access_token}"
+            used_access_token = self.access_token
+
+            try:
+                response = self._session.request(method, f"{self.host}{endpoint}", headers=headers, **kwargs)
+                error = None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response = None
+                error = e
+            kwargs["headers"] = headers
+
+            if response is not None and response.status_code == 401 and authenticated:
+                if refreshed_token or not self.refresh_token:
+                    raise cloud_auth_error(f"Cloud didn't accept the access token for {endpoint}, it has probably expired")
+                self.refresh_access_token(used_access_token)
+                refreshed_token = True
+                continue
+
+            if response is not None and response.status_code not in RETRY_STATUS_CODES:
+                if not response.ok:
+                    raise cloud_error(f"Request to {endpoint} failed with status {response.status_code}")
+                return response
+
+            if attempt >= self.max_retries:
+                raise cloud_error(f"Request to {endpoint} failed after {attempt + 1} tries: "
+                                  f"{error if error is not None else f'status {response.status_code}'}")
+
+            time.sleep(self._retry_delay(attempt, response))
+            attempt += 1
+
+    def _retry_delay(self, attempt: int, response):
+        # The server knows best when it wants to be asked again
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            return min(float(response.headers["Retry-After"]), self.max_backoff)
+
+        # Jitter so that many clients that failed at the same time don't all retry at the same time
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def refresh_access_token(self, expired_access_token: str | None = None):
+        """
+        Get a new access token with the refresh token.
+
+        Params:
+            expired_access_token (str | None) - the token that was rejected, if another thread has already replaced it nothing is done
+
+        Exceptions:
+            - cloud_auth_error if there is no refresh token or the cloud didn't accept it
+        """
+        with self._token_lock:
+            if expired_access_token is not None and self.access_token != expired_access_token:
+                return
+
+            if not self.refresh_token:
+                raise cloud_auth_error("No refresh token to refresh the access token with")
+
+            try:
+                response = self.request("POST", REFRESH_TOKEN_ENDPOINT, authenticated=False, json={"refreshToken": self.refresh_token})
+                tokens = response.json()
+                access_token = tokens["accessToken"]
+            except (cloud_error, ValueError, KeyError) as e:
+                raise cloud_auth_error(f"Unable to refresh access token: {e}")
+
+            self.access_token = access_token
+            self.refresh_token = tokens.get("refreshToken") or self.refresh_token
+
+        print(f"Refreshed cloud access token, it expires in {tokens.get('expiresIn', '?')} seconds")
+        if self.on_token_refreshed:
+            self.on_token_refreshed(self.access_token, self.refresh_token)
+
+    def get_bound_devices(self, force_refresh: bool = False):
+        """
+        Get all devices bound to the cloud user.
+
+        Params:
+            force_refresh (bool) - ask the cloud even if the cached list is newer than cache_ttl
+
+        Return:
+            list[dict]:
+                devices, in the format the cloud returns them (see printer_manager.get_devices)
+        """
+        with self._devices_lock:
+            if not force_refresh and self._devices is not None and time.monotonic() - self._devices_fetched_at < self.cache_ttl:
+                return self._devices
+
+            headers = {}
+            if self._devices_etag and self._devices is not None:
+                headers["If-None-Match"] = self._devices_etag
+
+            response = self.request("GET", DEVICES_ENDPOINT, headers=headers)
+            if response.status_code != 304:
+                try:
+                    self._devices = response.json()["devices"]
+                except (ValueError, KeyError) as e:
+                    raise cloud_error(f"Unexpected response from {DEVICES_ENDPOINT}: {e}")
+                self._devices_etag = response.headers.get("ETag")
+
+            self._devices_fetched_at = time.monotonic()
+            return self._devices
+
+    def close(self):
+        self._session.close()
+
+
+# #BadTestingRules
+if __name__ == "__main__":
+    # Runs the client against a local stub of the cloud
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    stub_state = {"connections": 0, "requests": [], "access_token": None, "fail_next": 0,
+                  "devices": [{"dev_id": "01P00A000000001", "name": "S4 Printer 1", "dev_access_code": "12345678"}]}
+
+    class stub_cloud(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            stub_state["connections"] += 1
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            stub_state["requests"].append(("GET", self.path))
+            if stub_state["fail_next"]:
+                stub_state["fail_next"] -= 1
+                self.send_json(503, {"message": "try again"})
+            elif self.headers.get("Authorization") != f"Bearer {stub_state['access_token']}":
+                self.send_json(401, {"message": "token expired"})
+            else:
+                etag = f'"{len(stub_state["devices"])}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                else:
+                    self.send_json(200, {"devices": stub_state["devices"]}, {"ETag": etag})
+
+        def do_POST(self):
+            stub_state["requests"].append(("POST", self.path))
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if self.path == REFRESH_TOKEN_ENDPOINT and body.get("refreshToken") == "refresh":
+                stub_state["access_token"] = "fresh"
+                self.send_json(200, {"accessToken": "fresh", "refreshToken": "refresh", "expiresIn": 7776000})
+            else:
+                self.send_json(401, {"message": "bad refresh token"})
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), stub_cloud)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = f"http://127.0.0.1:{server.server_address[1]}"
+
+    refreshed = []
+    client = bambu_cloud_client("expired", "refresh", host=host, backoff=0.01, cache_ttl=0,
+                                on_token_refreshed=lambda access_token, refresh_token: refreshed.append(access_token))
+
+    # Expired token is refreshed, and the request sent again
+    devices = client.get_bound_devices()
+    assert [device["name"] for device in devices] == ["S4 Printer 1"] and refreshed == ["fresh"]
+    print(f"401 -> refreshed token -> {len(devices)} device(s)")
+
+    # Unchanged list is answered with 304 and the cached list is used
+    stub_state["requests"].clear()
+    assert client.get_bound_devices() == devices
+    print("unchanged device list, got 304 and used cached list")
+
+    # Server errors are retried
+    stub_state["fail_next"] = 2
+    stub_state["devices"].append({"dev_id": "01P00A000000002", "name": "S4 Printer 2", "dev_access_code": "87654321"})
+    devices = client.get_bound_devices()
+    assert len(devices) == 2
+    print(f"2x 503 -> retried -> {len(devices)} device(s)")
+
+    # Cached for cache_ttl seconds without asking the cloud
+    client.cache_ttl = 60
+    requests_before = len(stub_state["requests"])
+    for _ in range(100):
+        client.get_bound_devices()
+    assert len(stub_state["requests"]) == requests_before
+
+    # Keep-alive, everything above went over the same connection or two
+    start = time.perf_counter()
+    for _ in range(200):
+        client.get_bound_devices(force_refresh=True)
+    print(f"200 requests in {time.perf_counter() - start:.3f}s over {stub_state['connections']} connection(s) in total")
+
+    # Refresh token that isn't accepted
+    stub_state["access_token"] = "something else"
+    bad_client = bambu_cloud_client("expired", "wrong", host=host, backoff=0.01)
+    try:
+        bad_client.get_bound_devices()
+        print("bad refresh token was accepted???")
+    except cloud_auth_error as e:
+        print(f"bad refresh token: {e}")
+
+    server.shutdown()
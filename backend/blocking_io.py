@@ -0,0 +1,35 @@
+"""
+File: blocking_io.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-02-26
+Description: Helper for running blocking calls without stopping the event loop when the server runs on gevent (see wsgi.py).
+
+With gevent every request, socket and "thread" is a greenlet sharing one OS thread, so anything that blocks without going through a socket
+stops the whole server until it returns. Sockets are patched by gevent, so requests (JWKS, the Bambu cloud), MSAL, MQTT and the FTPS uploads
+to printers already give way to other greenlets while they wait. What isn't patched is C code that blocks: SQLite commits (which wait for
+fsync) and decompressing/parsing print files. Those go through run_blocking, which runs them in gevent's pool of real OS threads.
+Without gevent (the dev server) run_blocking just calls the function.
+"""
+try:
+    import gevent
+    from gevent import monkey
+except ImportError:
+    gevent = None
+
+
+def is_gevent_patched():
+    """
+    Whether the server is running on gevent, i.e. wsgi.py has monkey patched the standard library.
+    """
+    return gevent is not None and monkey.is_module_patched("threading")
+
+
+def run_blocking(function, *args, **kwargs):
+    """
+    Call function(*args, **kwargs) and return what it returns, in a real OS thread if the server runs on gevent.
+    Exceptions are raised in the caller like a normal call.
+    """
+    if is_gevent_patched():
+        return gevent.get_hub().threadpool.apply(function, args, kwargs)
+
+    return function(*args, **kwargs)
@@ -0,0 +1,448 @@
+"""
+File: chunked_uploads.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-02-24
+Description: Module with the chunked_upload_manager class, which receives big print files in chunks that can be sent in any order and resumed.
+
+Every chunk is written straight to a preallocated temp file at its offset, so memory use doesn't depend on the size of the file.
+A .3mf file is a zip, and a zip ends with its central directory (the list of files in it). Clients should send the last chunk first, then the
+central directory is checked as soon as it arrives, and a file that isn't a sliced print is rejected before the rest is sent. As soon as the
+bytes of a plate's gcode header (or slice_info) have arrived, the time estimate is checked too.
+When every byte has arrived the file is moved into the upload_store with an atomic rename. A finished upload is kept (without its file)
+until it goes stale, so a client that resends the last chunk, because it never got the answer, is told that the upload is complete.
+"""
+import hashlib
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+from uuid import uuid4
+
+from printing_utils import plate_metadata, GCODE_HEADER_READ_BYTES, SLICE_INFO_MAX_BYTES, SLICE_INFO_PATH, _parse_gcode_header, _parse_slice_info
+from upload_store import file_suffix
+
+_EOCD_SIGNATURE = b"PK\x05\x06"
+_CENTRAL_DIRECTORY_SIGNATURE = b"PK\x01\x02"
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+_EOCD_SIZE = 22
+# End of central directory record plus the longest possible zip comment
+ZIP_TAIL_SIZE = _EOCD_SIZE + 0xFFFF
+
+
+class upload_rejected(Exception):
+    """
+    Raised when an upload turns out not to be a valid print file, the upload is deleted.
+    """
+
+
+class chunked_upload_manager():
+    def __init__(self, temp_folder: str, max_upload_size: int = 500 * 1024 * 1024, chunk_size: int = 8 * 1024 * 1024, session_ttl: float = 3600):
+        """
+        Params:
+            temp_folder (str) - folder to write uploads to while they're being received, should be on the same disk as the upload_store
+            max_upload_size (int) - biggest file in bytes that can be uploaded
+            chunk_size (int) - size of chunks clients are told to send
+            session_ttl (float) - seconds an upload can go without receiving anything before it's deleted
+        """
+        self.temp_folder = temp_folder
+        self.max_upload_size = max_upload_size
+        self.chunk_size = chunk_size
+        self.session_ttl = session_ttl
+
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def clear_partial_files(self):
+        """
+        Delete everything in the temp folder, used on startup since uploads can't be resumed after a restart.
+        """
+        shutil.rmtree(self.temp_folder, ignore_errors=True)
+        os.makedirs(self.temp_folder, exist_ok=True)
+
+    def create(self, owner: str, filename: str, size: int):
+        """
+        Start a new upload.
+
+        Params:
+            owner (str) - owner of the upload, only they can send chunks to it
+            filename (str) - secured filename
+            size (int) - total size of the file in bytes
+
+        Return:
+            dict:
+                the upload, "upload_id" is used to send chunks
+        """
+        if size <= 0:
+            raise ValueError("File is empty")
+        if size > self.max_upload_size:
+            raise ValueError(f"File is bigger than the limit of {self.max_upload_size // (1024*1024)} MB")
+
+        os.makedirs(self.temp_folder, exist_ok=True)
+        upload_id = str(uuid4())
+        temp_path = os.path.join(self.temp_folder, f"{upload_id}.part")
+
+        # Preallocated so chunks can be written at their offset in any order
+        with open(temp_path, "wb") as temp_file:
+            temp_file.truncate(size)
+
+        upload = {"upload_id": upload_id,
+                  "owner": owner,
+                  "filename": filename,
+                  "size": size,
+                  "temp_path": temp_path,
+                  "received": [],
+                  "is_zip": file_suffix(filename).endswith(".3mf"),
+                  "central_directory": None,
+                  "time_checked": False,
+                  "estimated_time": None,
+                  "sha256": hashlib.sha256(),
+                  "hashed_up_to": 0,
+                  "finished": False,
+                  "lock": threading.Lock(),
+                  "updated_at": time.monotonic()}
+
+        with self._lock:
+            self._uploads[upload_id] = upload
+
+        return upload
+
+    def get(self, upload_id: str):
+        with self._lock:
+            return self._uploads.get(upload_id)
+
+    def get_status(self, upload: dict):
+        """
+        Status of an upload, tells a client that reconnects which parts it still has to send.
+        """
+        with upload["lock"]:
+            return {"upload_id": upload["upload_id"],
+                    "filename": upload["filename"],
+                    "size": upload["size"],
+                    "chunk_size": self.chunk_size,
+                    "received": [list(received_range) for received_range in upload["received"]],
+                    "received_bytes": sum(end - start for start, end in upload["received"]),
+                    "complete": self._is_complete(upload)}
+
+    def write_chunk(self, upload: dict, offset: int, stream, length: int):
+        """
+        Write a chunk of an upload, reading it from stream a bit at a time.
+
+        Params:
+            upload (dict) - upload from create/get
+            offset (int) - where in the file the chunk starts
+            stream (file-like) - the chunk's content
+            length (int) - length of the chunk in bytes
+
+        Return:
+            bool:
+                whether the whole file has been received
+
+        Exceptions:
+            - ValueError if the chunk doesn't fit in the file
+            - upload_rejected if the file turns out not to be a valid print file, the upload is deleted
+        """
+        if offset < 0 or length <= 0 or offset + length > upload["size"]:
+            raise ValueError("Chunk is outside of the file")
+
+        with upload["lock"]:
+            # Sent again after the upload was finished, the file has already been moved into the upload_store
+            if upload["finished"]:
+                return True
+
+            written = 0
+            with open(upload["temp_path"], "r+b") as temp_file:
+                temp_file.seek(offset)
+                while written < length:
+                    data = stream.read(min(1024 * 1024, length - written))
+                    if not data:
+                        break
+                    temp_file.write(data)
+
+                    # Hashed on the way in when the chunks come in order, so the file doesn't have to be read again
+                    if upload["hashed_up_to"] == offset + written:
+                        upload["sha256"].update(data)
+                        upload["hashed_up_to"] += len(data)
+                    written += len(data)
+
+            if written != length:
+                raise ValueError(f"Chunk was {written} bytes, expected {length}")
+
+            self._add_received_range(upload, offset, offset + length)
+            upload["updated_at"] = time.monotonic()
+
+            try:
+                self._validate(upload)
+            except upload_rejected:
+                self._delete(upload)
+                raise
+
+            return self._is_complete(upload)
+
+    def finish(self, upload: dict):
+        """
+        Finish a fully received upload, only once. The upload is kept until it goes stale, see remove_stale.
+
+        Return:
+            tuple:
+                (temp_path, sha256 digest) of the file, the caller should move it into the upload_store
+
+        Exceptions:
+            - ValueError if the upload isn't complete, or has already been finished
+        """
+        with upload["lock"]:
+            if upload["finished"]:
+                raise ValueError("Upload has already been finished")
+            if not self._is_complete(upload):
+                raise ValueError("Upload isn't complete")
+
+            self._hash_received(upload)
+            upload["finished"] = True
+            upload["updated_at"] = time.monotonic()
+
+            return upload["temp_path"], upload["sha256"].hexdigest()
+
+    def cancel(self, upload: dict):
+        with upload["lock"]:
+            self._delete(upload)
+
+    def remove_stale(self):
+        """
+        Delete uploads that haven't received anything for session_ttl seconds, and forget finished ones session_ttl seconds after they finished.
+
+        Return:
+            int:
+                number of uploads deleted
+        """
+        now = time.monotonic()
+        with self._lock:
+            stale_uploads = [upload for upload in self._uploads.values() if now - upload["updated_at"] > self.session_ttl]
+
+        for upload in stale_uploads:
+            self.cancel(upload)
+        return len(stale_uploads)
+
+    def _delete(self, upload: dict):
+        with self._lock:
+            self._uploads.pop(upload["upload_id"], None)
+        if os.path.exists(upload["temp_path"]):
+            os.remove(upload["temp_path"])
+
+    def _add_received_range(self, upload: dict, start: int, end: int):
+        merged = []
+        for received_start, received_end in sorted(upload["received"] + [(start, end)]):
+            if merged and received_start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], received_end))
+            else:
+                merged.append((received_start, received_end))
+        upload["received"] = merged
+
+    def _has_range(self, upload: dict, start: int, end: int):
+        return any(received_start <= start and end <= received_end for received_start, received_end in upload["received"])
+
+    def _is_complete(self, upload: dict):
+        return upload["received"] == [(0, upload["size"])]
+
+    def _read(self, upload: dict, start: int, length: int):
+        with open(upload["temp_path"], "rb") as temp_file:
+            temp_file.seek(start)
+            return temp_file.read(length)
+
+    def _hash_received(self, upload: dict):
+        for start, end in upload["received"]:
+            if start <= upload["hashed_up_to"] < end:
+                with open(upload["temp_path"], "rb") as temp_file:
+                    temp_file.seek(upload["hashed_up_to"])
+                    while upload["hashed_up_to"] < end:
+                        data = temp_file.read(min(1024 * 1024, end - upload["hashed_up_to"]))
+                        upload["sha256"].update(data)
+                        upload["hashed_up_to"] += len(data)
+
+    def _validate(self, upload: dict):
+        if not upload["is_zip"]:
+            self._validate_gcode(upload)
+            return
+
+        size = upload["size"]
+        if upload["central_directory"] is None:
+            tail_start = max(0, size - ZIP_TAIL_SIZE)
+            if not self._has_range(upload, tail_start, size):
+                return
+            upload["central_directory"] = self._read_central_directory(upload, tail_start)
+            if upload["central_directory"] is None:
+                return
+
+        if not upload["time_checked"]:
+            self._validate_zip_time(upload)
+
+    def _read_central_directory(self, upload: dict, tail_start: int):
+        tail = self._read(upload, tail_start, upload["size"] - tail_start)
+        eocd_position = tail.rfind(_EOCD_SIGNATURE)
+        if eocd_position == -1 or len(tail) - eocd_position < _EOCD_SIZE:
+            raise upload_rejected("The provided file is not a valid .3mf archive.")
+
+        _, _, _, _, entry_count, directory_size, directory_offset, _ = struct.unpack("<4sHHHHIIH", tail[eocd_position:eocd_position + _EOCD_SIZE])
+
+        # Zip64 files keep the real values elsewhere, those are checked when the file is complete instead
+        if directory_offset == 0xFFFFFFFF or directory_size == 0xFFFFFFFF or entry_count == 0xFFFF:
+            upload["time_checked"] = True
+            return {}
+
+        if directory_offset + directory_size > tail_start + eocd_position:
+            raise upload_rejected("The provided file is not a valid .3mf archive.")
+
+        if not self._has_range(upload, directory_offset, directory_offset + directory_size):
+            return None
+
+        directory = self._read(upload, directory_offset, directory_size)
+        members = {}
+        position = 0
+        for _ in range(entry_count):
+            if directory[position:position + 4] != _CENTRAL_DIRECTORY_SIGNATURE:
+                raise upload_rejected("The provided file is not a valid .3mf archive.")
+
+            (method, compressed_size, name_length, extra_length, comment_length,
+             local_header_offset) = struct.unpack("<6xH8xI4xHHH8xI", directory[position + 4:position + 46])
+            name = directory[position + 46:position + 46 + name_length].decode("utf-8", errors="replace")
+            members[name] = {"method": method, "compressed_size": compressed_size, "local_header_offset": local_header_offset}
+            position += 46 + name_length + extra_length + comment_length
+
+        if not any(name.endswith(".gcode") for name in members):
+            raise upload_rejected("No gcode_file found")
+
+        return members
+
+    def _read_member_start(self, upload: dict, member: dict, max_bytes: int):
+        """
+        Read and decompress up to max_bytes from the start of a member of the zip.
+
+        Return:
+            bytes | None:
+                the start of the member, None if those bytes haven't arrived yet, b"" if it's compressed in a way that isn't checked early
+        """
+        header_offset = member["local_header_offset"]
+        if not self._has_range(upload, header_offset, header_offset + 30):
+            return None
+
+        local_header = self._read(upload, header_offset, 30)
+        if local_header[:4] != _LOCAL_HEADER_SIGNATURE:
+            raise upload_rejected("The provided file is not a valid .3mf archive.")
+
+        name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+        data_offset = header_offset + 30 + name_length + extra_length
+        # Deflate never makes text more than slightly bigger, so max_bytes of compressed data is always enough for max_bytes of text
+        data_length = min(member["compressed_size"], max_bytes + 1024)
+        if not self._has_range(upload, data_offset, data_offset + data_length):
+            return None
+
+        data = self._read(upload, data_offset, data_length)
+        if member["method"] == 0:
+            return data[:max_bytes]
+        if member["method"] == 8:
+            try:
+                return zlib.decompressobj(-15).decompress(data, max_bytes)
+            except zlib.error:
+                raise upload_rejected("The provided file is not a valid .3mf archive.")
+
+        return b""
+
+    def _validate_zip_time(self, upload: dict):
+        members = upload["central_directory"]
+        gcode_files = sorted(name for name in members if name.endswith(".gcode"))
+        plate_gcode = next((name for name in gcode_files if name.startswith("Metadata/plate_")), gcode_files[0])
+
+        plate = plate_metadata(index=1)
+        header = self._read_member_start(upload, members[plate_gcode], GCODE_HEADER_READ_BYTES)
+        if header is not None:
+            _parse_gcode_header(header, plate)
+
+        # Depending on the slicer the gcode can be at the end of the file, slice_info has the time too
+        elif SLICE_INFO_PATH in members:
+            slice_info = self._read_member_start(upload, members[SLICE_INFO_PATH], SLICE_INFO_MAX_BYTES)
+            if slice_info is None:
+                return
+            header = slice_info
+            plates = {}
+            _parse_slice_info(slice_info, plates)
+            if plates:
+                plate = plates[min(plates)]
+
+        else:
+            return
+
+        # Compressed in some other way, the time is checked when the whole file has arrived instead
+        if header == b"":
+            upload["time_checked"] = True
+            return
+
+        if plate.estimated_time is None:
+            raise upload_rejected("Unable to find estimated time in file")
+
+        upload["estimated_time"] = plate.estimated_time
+        upload["time_checked"] = True
+
+    def _validate_gcode(self, upload: dict):
+        if upload["time_checked"]:
+            return
+
+        header_length = min(upload["size"], GCODE_HEADER_READ_BYTES)
+        if not self._has_range(upload, 0, header_length):
+            return
+
+        plate = plate_metadata(index=1)
+        _parse_gcode_header(self._read(upload, 0, header_length), plate)
+        if plate.estimated_time is None:
+            raise upload_rejected("Unable to find estimated time in file")
+
+        upload["estimated_time"] = plate.estimated_time
+        upload["time_checked"] = True
+
+
+# #BadTestingRules
+if __name__ == "__main__":
+    import io
+    import tempfile
+    import zipfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        three_mf_path = os.path.join(temp_dir, "test.gcode.3mf")
+        with zipfile.ZipFile(three_mf_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("Metadata/plate_1.gcode", "; HEADER_BLOCK_START\n; model printing time: 1h; total estimated time: 1h 2m 3s\n; HEADER_BLOCK_END\n"
+                             + "G1 X1 Y1\n" * 2_000_000)
+        with open(three_mf_path, "rb") as three_mf:
+            content = three_mf.read()
+
+        manager = chunked_upload_manager(os.path.join(temp_dir, ".partial"), chunk_size=64 * 1024)
+        upload = manager.create("owner", "test.gcode.3mf", len(content))
+
+        # Tail first, then the rest in order
+        chunks = [(offset, content[offset:offset + manager.chunk_size]) for offset in range(0, len(content), manager.chunk_size)]
+        chunks = chunks[-1:] + chunks[:-1]
+        for offset, chunk in chunks:
+            complete = manager.write_chunk(upload, offset, io.BytesIO(chunk), len(chunk))
+            if upload["central_directory"] is not None and offset == chunks[0][0]:
+                print(f"central directory checked after the first chunk: {sorted(upload['central_directory'])}")
+        print(f"estimated time {upload['estimated_time']}, complete {complete}")
+
+        temp_path, digest = manager.finish(upload)
+        assert digest == hashlib.sha256(content).hexdigest()
+        print(f"digest ok: {digest}")
+
+        # The last chunk sent again is answered as complete, and can't finish the upload a second time
+        shutil.move(temp_path, os.path.join(temp_dir, "stored.gcode.3mf"))
+        assert manager.write_chunk(upload, chunks[-1][0], io.BytesIO(chunks[-1][1]), len(chunks[-1][1]))
+        try:
+            manager.finish(upload)
+            raise AssertionError("upload was finished twice")
+        except ValueError:
+            pass
+        assert manager.get_status(upload)["complete"]
+
+        # A file that isn't a zip is rejected as soon as its tail arrives
+        bad_upload = manager.create("owner", "bad.gcode.3mf", 200_000)
+        try:
+            manager.write_chunk(bad_upload, 100_000, io.BytesIO(b"x" * 100_000), 100_000)
+            print("bad file was not rejected???")
+        except upload_rejected as e:
+            print(f"bad file rejected: {e}")
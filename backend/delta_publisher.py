@@ -0,0 +1,71 @@
+"""
+File: delta_publisher.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-02-12
+Description: Module with the delta_publisher class, used to only send what has changed in per-printer data to clients instead of all of it every time.
+
+Protocol:
+    On connect (or when a client asks to resync) the client gets the full state:
+        {"seq": int, "printers": {printer_name: {field: value, ...}, ...}}
+
+    After that it gets patches:
+        {"seq": int, "patches": {printer_name: {changed_field: new_value, ...}, ...}, "removed": [printer_name, ...]}
+
+    seq increases by exactly one per patch, so if a client gets a patch with a seq that isn't its own seq + 1 it has missed one and should resync.
+"""
+import threading
+
+
+class delta_publisher():
+    def __init__(self):
+        self._published = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def publish(self, printers: dict[str: dict]):
+        """
+        Compare the new state to the last published one, and make it the published state.
+
+        Params:
+            printers (dict[str: dict]) - printer names as keys and dicts of fields as values, won't be changed and shouldn't be changed afterwards
+
+        Return:
+            dict | None:
+                The patch to send to clients, None if nothing changed
+        """
+        with self._lock:
+            patches = {}
+            for printer_name, fields in printers.items():
+                previous_fields = self._published.get(printer_name)
+
+                if previous_fields is None:
+                    patches[printer_name] = dict(fields)
+                    continue
+
+                changed_fields = {key: value for key, value in fields.items() if key not in previous_fields or previous_fields[key] != value}
+                if changed_fields:
+                    patches[printer_name] = changed_fields
+
+            removed = [printer_name for printer_name in self._published if printer_name not in printers]
+
+            self._published = printers
+
+            if not patches and not removed and self._seq > 0:
+                return None
+
+            self._seq += 1
+            return {"seq": self._seq, "patches": patches, "removed": removed}
+
+    def get_full(self):
+        """
+        Get the full published state, which later patches apply to.
+
+        Return:
+            dict:
+                {"seq": int, "printers": dict}
+        """
+        with self._lock:
+            return {"seq": self._seq, "printers": self._published}
+
+    def has_published(self):
+        return self._seq > 0
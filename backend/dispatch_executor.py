@@ -0,0 +1,245 @@
+"""
+File: dispatch_executor.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-02-14
+Description: Module with the dispatch_executor class, which uploads prints to printers and starts them in the background.
+
+Uploading a file to a printer over FTPS can take several seconds, so it's done in a thread pool instead of in the dispatcher.
+Every printer has its own lane, meaning at most one job per printer is in flight at a time, while jobs for different printers run in parallel.
+
+States of a job:
+    "uploading" -> "starting" -> "started"
+    or "failed" at any point, with the reason in "error"
+
+A printer still counts as busy after its job has "started", until it reports a gcode_state other than FINISH, IDLE or FAILED (or
+start_timeout has passed). Until then its reports are from before the print command, and it would look like it's waiting for a new print.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+
+# States a printer reports when it isn't printing
+NOT_PRINTING_STATES = ("FINISH", "IDLE", "FAILED")
+
+
+class dispatch_executor():
+    def __init__(self, p_man, max_workers: int = 8, start_timeout: float = 60, forget_finished_after: float = 3600):
+        """
+        Params:
+            p_man (printer_manager) - used to upload and start prints
+            max_workers (int) - the most uploads running at the same time
+            start_timeout (float) - seconds a started printer counts as busy at most, if it never reports that it's printing
+            forget_finished_after (float) - seconds a job that started or failed is kept for get_jobs
+        """
+        self.p_man = p_man
+        self.start_timeout = start_timeout
+        self.forget_finished_after = forget_finished_after
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dispatch")
+        self._lock = threading.Lock()
+
+        self._jobs = {}
+        self._busy_printers = {}
+
+    def is_busy(self, printer_name: str):
+        """
+        Whether a job is currently being uploaded or started on a printer, or was started but the printer hasn't reported that it's printing yet.
+        """
+        with self._lock:
+            print_id = self._busy_printers.get(printer_name)
+            if print_id is None:
+                return False
+
+            job = self._jobs[print_id]
+            if job["state"] != "started":
+                return True
+
+            if self._printer_state(printer_name) in NOT_PRINTING_STATES and time.time() - job["updated_at"] < self.start_timeout:
+                return True
+
+            del self._busy_printers[printer_name]
+            return False
+
+    def _printer_state(self, printer_name: str):
+        printer = self.p_man.printers.get(printer_name)
+        return printer.gcode_state if printer is not None else None
+
+    def submit(self, printer_name: str, print_id: str, local_file_path: str, printer_file_path: str, on_done=None, upload: bool = True,
+               requirements: dict | None = None):
+        """
+        Upload a print to a printer and start it, without waiting for it to finish.
+
+        Params:
+            printer_name (str) - name of the printer to print on
+            print_id (str) - id of the print, used to look up the job
+            local_file_path (str) - path to the file on the server
+            printer_file_path (str) - path to upload the file to on the printer
+            on_done (function | None) - called from the worker thread with the job dict when the job is started or has failed
+            upload (bool) - False if the printer already has the file at printer_file_path, then the print is only started
+            requirements (dict | None) - what the print needs, used to pick the plate and AMS trays when starting it (see placement.py)
+
+        Return:
+            dict | None:
+                the job, None if the printer already has a job in flight
+        """
+        with self._lock:
+            if printer_name in self._busy_printers:
+                return None
+
+            job = {"print_id": print_id,
+                   "printer_name": printer_name,
+                   "local_file_path": local_file_path,
+                   "printer_file_path": printer_file_path,
+                   "state": "uploading" if upload else "starting",
+                   "upload": upload,
+                   "requirements": requirements,
+                   "error": None,
+                   "updated_at": time.time()}
+
+            self._forget_finished_jobs(self.forget_finished_after)
+            self._jobs[print_id] = job
+            self._busy_printers[printer_name] = print_id
+
+        self._pool.submit(self._run_job, job, on_done)
+        return job
+
+    def _set_state(self, job: dict, state: str, error: str | None = None):
+        with self._lock:
+            job["state"] = state
+            job["error"] = error
+            job["updated_at"] = time.time()
+
+    def _run_job(self, job: dict, on_done):
+        try:
+            if job["upload"]:
+                uploaded_path = self.p_man.upload_print(job["printer_name"], job["local_file_path"], job["printer_file_path"])
+                if uploaded_path in ("Invalid file extension", "No file uploaded."):
+                    raise Exception(uploaded_path)
+
+                self._set_state(job, "starting")
+
+            self.p_man.start_print_on_printer(job["printer_name"], job["printer_file_path"], job["requirements"])
+            self._set_state(job, "started")
+
+        except Exception as e:
+            print("***WARNING***")
+            print(f"Failed to dispatch print {job['print_id']} to {job['printer_name']}")
+            print(f"Recieved exception: {e}")
+            print("***WARNING***")
+            self._set_state(job, "failed", str(e))
+
+        try:
+            if on_done:
+                try:
+                    on_done(job)
+                except Exception as e:
+                    print(f"on_done for print {job['print_id']} failed with exception: {e}")
+
+        finally:
+            # Released after on_done, so a failed print is back in the queue before the printer can be given a new one.
+            # A started printer stays busy until is_busy sees that it's printing
+            with self._lock:
+                if job["state"] != "started":
+                    self._busy_printers.pop(job["printer_name"], None)
+
+    def _forget_finished_jobs(self, forget_finished_after: float):
+        # Called with self._lock held. Jobs of printers that are still busy are kept, is_busy looks them up
+        now = time.time()
+        busy_print_ids = set(self._busy_printers.values())
+        for print_id in [print_id for print_id, job in self._jobs.items()
+                         if job["state"] in ("started", "failed") and now - job["updated_at"] > forget_finished_after
+                         and print_id not in busy_print_ids]:
+            del self._jobs[print_id]
+
+    def get_jobs(self, forget_finished_after: float | None = None):
+        """
+        Get the state of all jobs, jobs that started or failed more than forget_finished_after seconds ago are forgotten.
+        Finished jobs are also forgotten when a new job is submitted, so they don't pile up if nobody asks for them.
+
+        Params:
+            forget_finished_after (float | None) - None to use the executor's forget_finished_after
+
+        Return:
+            dict[str: dict]:
+                print_ids as keys and copies of the jobs as values
+        """
+        with self._lock:
+            self._forget_finished_jobs(self.forget_finished_after if forget_finished_after is None else forget_finished_after)
+            return {print_id: dict(job) for print_id, job in self._jobs.items()}
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
+
+
+# #BadTestingRules
+if __name__ == "__main__":
+    class fake_printer():
+        gcode_state = "FINISH"
+
+    class fake_printer_manager():
+        """
+        Stand-in for printer_manager with a configurable upload time per printer.
+        """
+        def __init__(self, upload_latencies: dict[str: float], failing_printers: set = frozenset()):
+            self.upload_latencies = upload_latencies
+            self.failing_printers = failing_printers
+            self.started = {}
+            self.printers = {printer_name: fake_printer() for printer_name in upload_latencies}
+
+        def upload_print(self, printer_name, local_file_path, printer_file_path):
+            time.sleep(self.upload_latencies[printer_name])
+            if printer_name in self.failing_printers:
+                return "No file uploaded."
+            return printer_file_path
+
+        def start_print_on_printer(self, printer_name, filename, requirements=None):
+            self.started[printer_name] = filename
+
+    fake_p_man = fake_printer_manager({"slow": 2.0, "fast_1": 0.1, "fast_2": 0.1, "broken": 0.1}, failing_printers={"broken"})
+    executor = dispatch_executor(fake_p_man)
+
+    done = []
+    start = time.monotonic()
+    for printer_name in fake_p_man.upload_latencies:
+        executor.submit(printer_name, f"print_{printer_name}", "./uploads/x.gcode.3mf", f"/cache/{printer_name}.gcode.3mf",
+                        on_done=lambda job: done.append((job["printer_name"], job["state"], round(time.monotonic() - start, 2))))
+    submit_time = time.monotonic() - start
+
+    # A printer with a job in flight can't get another one
+    assert executor.submit("slow", "another_print", "", "") is None
+
+    while len(done) < 4:
+        time.sleep(0.01)
+
+    print(f"submitting took {submit_time:.4f}s")
+    print(done)
+    assert done[-1][0] == "slow", "fast printers should not wait for the slow one"
+    assert executor.get_jobs()["print_broken"]["state"] == "failed"
+    assert not executor.is_busy("broken")
+
+    # Started printers are busy until they report that they are printing, or start_timeout has passed
+    assert executor.is_busy("slow") and executor.is_busy("fast_1")
+    fake_p_man.printers["slow"].gcode_state = "PREPARE"
+    assert not executor.is_busy("slow")
+    fake_p_man.printers["slow"].gcode_state = "FINISH"
+    assert not executor.is_busy("slow"), "busy again after the print was confirmed"
+    executor.start_timeout = 0
+    assert not executor.is_busy("fast_1")
+
+    # A failed print is handled by on_done before the printer can get a new job
+    busy_in_on_done = []
+    executor.submit("broken", "broken_again", "./uploads/x.gcode.3mf", "/cache/broken.gcode.3mf",
+                    on_done=lambda job: busy_in_on_done.append(executor.submit("broken", "too_early", "", "") is None))
+    while executor.is_busy("broken") or not busy_in_on_done:
+        time.sleep(0.01)
+    assert busy_in_on_done == [True]
+
+    # Finished jobs are forgotten when new ones are submitted, without anybody calling get_jobs
+    executor.forget_finished_after = 0
+    fake_p_man.printers["fast_2"].gcode_state = "PRINTING"
+    for i in range(100):
+        executor.submit("fast_2", f"repeat_{i}", "./uploads/x.gcode.3mf", "/cache/fast_2.gcode.3mf", upload=False)
+        while executor.is_busy("fast_2"):
+            time.sleep(0.001)
+    assert len(executor._jobs) <= 2, executor._jobs
+    executor.shutdown()
@@ -0,0 +1,331 @@
+"""
+File: duration_model.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-03-07
+Description: Module with the duration_model class, which learns how long prints actually take compared to the slicer's estimate.
+
+The slicer's "total estimated time" is usually off by a fairly constant factor for a given printer and filament (e.g. printers that are tuned
+slower, or filaments that are printed slower than the profile says). The model keeps an exponentially weighted moving average (EWMA) of
+log(actual time / estimated time) for every completed print, at four levels:
+    (printer, filament), (printer, "*"), ("*", filament) and ("*", "*")
+A prediction uses the most specific level that has at least min_samples prints, and the estimate as it is if none has.
+The queue doesn't know what printer a print will end up on, so it uses the ("*", filament) level.
+
+The actual time of a print is measured from the gcode_state of the printer it was sent to, the time spent in PREPARE/SLICING/RUNNING is counted
+and the time spent paused isn't. A print that is running when the server restarts isn't learned from.
+
+The estimate in a file is written by the user's computer and can be edited to skip the queue (see printing_utils.extract_bambulab_estimated_time),
+so check_estimate compares it to what else is known about the file and flags it if it's implausibly short.
+"""
+import math
+import sqlite3
+import threading
+import time
+
+from blocking_io import run_blocking
+
+
+ANY = "*"
+UNKNOWN_FILAMENT = "UNKNOWN"
+ACTIVE_GCODE_STATES = ("PREPARE", "SLICING", "RUNNING")
+
+
+class duration_model():
+    def __init__(self, db_path: str = "./durations.db", half_life: float = 10, min_samples: int = 3, min_ratio: float = 0.25,
+                 max_ratio: float = 4.0, min_seconds_per_layer: float = 2.0, max_prediction_drift: float = 0.8):
+        """
+        Params:
+            db_path (str) - SQLite database the learned ratios are saved in
+            half_life (float) - number of prints after which a print only has half the weight it had when it was learned from
+            min_samples (int) - prints needed at a level before its ratio is used
+            min_ratio (float) - prints that took less than min_ratio * the estimate aren't learned from (e.g. cancelled and marked as finished)
+            max_ratio (float) - prints that took more than max_ratio * the estimate aren't learned from (e.g. paused over the weekend)
+            min_seconds_per_layer (float) - no printer prints a layer faster than this, used to flag estimates
+            max_prediction_drift (float) - estimates shorter than this fraction of the slicer's prediction in slice_info are flagged
+        """
+        self.db_path = db_path
+        self.alpha = 1 - 0.5 ** (1 / half_life)
+        self.min_samples = min_samples
+        self.min_ratio = min_ratio
+        self.max_ratio = max_ratio
+        self.min_seconds_per_layer = min_seconds_per_layer
+        self.max_prediction_drift = max_prediction_drift
+
+        self._lock = threading.Lock()
+        # (printer_name, filament_type): {"log_ratio", "samples", "log_seconds_per_gram", "gram_samples", "updated_at"}
+        self._stats = {}
+        # printer_name: job that was sent to it, see start_job
+        self._jobs = {}
+
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS duration_stats (
+                                        printer_name TEXT NOT NULL,
+                                        filament_type TEXT NOT NULL,
+                                        log_ratio REAL NOT NULL,
+                                        samples INTEGER NOT NULL,
+                                        log_seconds_per_gram REAL NOT NULL,
+                                        gram_samples INTEGER NOT NULL,
+                                        updated_at REAL NOT NULL,
+                                        PRIMARY KEY (printer_name, filament_type)
+                                    )""")
+
+        for printer_name, filament_type, log_ratio, samples, log_seconds_per_gram, gram_samples, updated_at in self._connection.execute(
+                "SELECT printer_name, filament_type, log_ratio, samples, log_seconds_per_gram, gram_samples, updated_at FROM duration_stats"):
+            self._stats[(printer_name, filament_type)] = {"log_ratio": log_ratio, "samples": samples, "log_seconds_per_gram": log_seconds_per_gram,
+                                                          "gram_samples": gram_samples, "updated_at": updated_at}
+
+    def _find_stats(self, printer_name: str | None, filament_type: str | None, samples_field: str = "samples"):
+        filament_type = (filament_type or UNKNOWN_FILAMENT).upper()
+        levels = [(ANY, filament_type), (ANY, ANY)]
+        if printer_name is not None:
+            levels = [(printer_name, filament_type), (printer_name, ANY)] + levels
+
+        for level in levels:
+            stats = self._stats.get(level)
+            if stats and stats[samples_field] >= self.min_samples:
+                return stats
+
+        return None
+
+    def get_ratio(self, filament_type: str | None = None, printer_name: str | None = None):
+        """
+        Get the learned ratio of actual time to estimated time.
+
+        Params:
+            filament_type (str | None) - type of filament, e.g. "PLA"
+            printer_name (str | None) - printer the print is printed on, None if it isn't known yet
+
+        Return:
+            float:
+                the ratio, 1.0 if not enough prints have been learned from
+        """
+        stats = self._find_stats(printer_name, filament_type)
+        return math.exp(stats["log_ratio"]) if stats else 1.0
+
+    def predict(self, estimated_time: int, filament_type: str | None = None, printer_name: str | None = None):
+        """
+        Get the corrected time to print of a print, in seconds.
+        """
+        return max(1, round(estimated_time * self.get_ratio(filament_type, printer_name)))
+
+    def check_estimate(self, metadata):
+        """
+        Check whether the estimated time of a print file is plausible, compared to the slicer's prediction, the layer count and the filament used.
+
+        Params:
+            metadata (printing_utils.print_metadata) - metadata of the file
+
+        Return:
+            tuple:
+                (estimated_time, flags), the estimate to use in seconds and a list of reasons it was replaced (empty if it's plausible).
+                A replaced estimate is the longest of the times it was compared to
+        """
+        plate = metadata.plate
+        estimated_time = plate.estimated_time
+        flags = []
+        lower_bounds = []
+
+        if estimated_time <= 0:
+            flags.append("estimate_not_positive")
+
+        if plate.predicted_time and plate.predicted_time > 0:
+            lower_bounds.append(plate.predicted_time)
+            if estimated_time < plate.predicted_time * self.max_prediction_drift:
+                flags.append("estimate_differs_from_slicer_prediction")
+
+        if plate.layer_count and plate.layer_count > 0:
+            lower_bounds.append(round(plate.layer_count * self.min_seconds_per_layer))
+            if estimated_time < lower_bounds[-1]:
+                flags.append("estimate_too_short_for_layers")
+
+        if plate.filament_grams and plate.filament_grams > 0:
+            with self._lock:
+                stats = self._find_stats(None, plate.filament_type, "gram_samples")
+            if stats:
+                expected_time = plate.filament_grams * math.exp(stats["log_seconds_per_gram"])
+                lower_bounds.append(round(expected_time))
+                if estimated_time * self.max_ratio < expected_time:
+                    flags.append("estimate_too_short_for_filament")
+
+        if flags:
+            estimated_time = max(lower_bounds, default=1)
+
+        return max(1, estimated_time), flags
+
+    def start_job(self, printer_name: str, print_id: str, estimated_time: int, filament_type: str | None = None,
+                  filament_grams: float | None = None, learn: bool = True, now: float | None = None):
+        """
+        Start measuring a print that was just started on a printer, replaces any earlier job on it.
+
+        Params:
+            printer_name (str) - printer the print was sent to
+            print_id (str) - id of the print
+            estimated_time (int) - the slicer's estimate in seconds
+            filament_type (str | None) - type of filament, e.g. "PLA"
+            filament_grams (float | None) - grams of filament the print uses
+            learn (bool) - False to only track the print, e.g. if its estimate was flagged and can't be trusted
+        """
+        with self._lock:
+            self._jobs[printer_name] = {"print_id": print_id,
+                                        "estimated_time": estimated_time,
+                                        "filament_type": (filament_type or UNKNOWN_FILAMENT).upper(),
+                                        "filament_grams": filament_grams,
+                                        "learn": learn,
+                                        "active_since": None,
+                                        "active_seconds": 0.0,
+                                        "started_at": time.time() if now is None else now}
+
+    def observe(self, printer_name: str, gcode_state: str, now: float | None = None):
+        """
+        Called on every report from a printer, measures the job sent to it and learns from it when it finishes. Cheap when nothing changes.
+
+        Return:
+            bool:
+                whether the model learned something, i.e. predictions might have changed
+        """
+        if printer_name not in self._jobs:
+            return False
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            job = self._jobs.get(printer_name)
+            if job is None:
+                return False
+
+            if gcode_state in ACTIVE_GCODE_STATES:
+                if job["active_since"] is None:
+                    job["active_since"] = now
+                return False
+
+            was_active = job["active_since"] is not None
+            if was_active:
+                job["active_seconds"] += now - job["active_since"]
+                job["active_since"] = None
+
+            # Printer still shows how the last print ended until the new one has started
+            if gcode_state == "PAUSE" or (not was_active and job["active_seconds"] == 0):
+                return False
+
+            del self._jobs[printer_name]
+            if gcode_state != "FINISH" or not job["learn"]:
+                return False
+
+            return self._learn(printer_name, job, now)
+
+    def _learn(self, printer_name: str, job: dict, now: float):
+        ratio = job["active_seconds"] / max(job["estimated_time"], 1)
+        if not self.min_ratio <= ratio <= self.max_ratio:
+            print(f"Not learning from print {job['print_id']} on {printer_name}, it took {ratio:.2f} times its estimate")
+            return False
+
+        log_ratio = math.log(ratio)
+        log_seconds_per_gram = math.log(job["active_seconds"] / job["filament_grams"]) if job["filament_grams"] else None
+
+        changed_rows = []
+        for level in ((printer_name, job["filament_type"]), (printer_name, ANY), (ANY, job["filament_type"]), (ANY, ANY)):
+            stats = self._stats.setdefault(level, {"log_ratio": 0.0, "samples": 0, "log_seconds_per_gram": 0.0, "gram_samples": 0, "updated_at": now})
+            # First print sets the average instead of being blended with the 0 it starts at
+            stats["log_ratio"] = log_ratio if stats["samples"] == 0 else stats["log_ratio"] + self.alpha * (log_ratio - stats["log_ratio"])
+            stats["samples"] += 1
+            if log_seconds_per_gram is not None:
+                stats["log_seconds_per_gram"] = (log_seconds_per_gram if stats["gram_samples"] == 0
+                                                 else stats["log_seconds_per_gram"] + self.alpha * (log_seconds_per_gram - stats["log_seconds_per_gram"]))
+                stats["gram_samples"] += 1
+            stats["updated_at"] = now
+
+            changed_rows.append((*level, stats["log_ratio"], stats["samples"], stats["log_seconds_per_gram"], stats["gram_samples"], now))
+
+        run_blocking(self._connection.executemany,
+                     "INSERT OR REPLACE INTO duration_stats (printer_name, filament_type, log_ratio, samples, log_seconds_per_gram, gram_samples, updated_at) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?)", changed_rows)
+
+        print(f"Print {job['print_id']} on {printer_name} took {ratio:.2f} times its estimate, "
+              f"{job['filament_type']} prints now take {self.get_ratio(job['filament_type']):.2f} times their estimate")
+        return True
+
+    def get_stats(self):
+        """
+        Get everything that has been learned, e.g. to show on the dashboard.
+
+        Return:
+            list[dict]:
+                {"printer_name", "filament_type", "ratio", "samples", "seconds_per_gram", "updated_at"} for every level, "*" means any
+        """
+        with self._lock:
+            return [{"printer_name": printer_name,
+                     "filament_type": filament_type,
+                     "ratio": round(math.exp(stats["log_ratio"]), 3),
+                     "samples": stats["samples"],
+                     "seconds_per_gram": round(math.exp(stats["log_seconds_per_gram"]), 1) if stats["gram_samples"] else None,
+                     "updated_at": stats["updated_at"]}
+                    for (printer_name, filament_type), stats in sorted(self._stats.items())]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+# #BadTestingRules
+if __name__ == "__main__":
+    # Simulated farm where every printer/filament has its own true ratio, the error of the corrected estimate should shrink as it learns
+    import os
+    import random
+    import tempfile
+    from printing_utils import plate_metadata, print_metadata
+
+    random.seed(1)
+    true_ratios = {("P1S 1", "PLA"): 1.08, ("P1S 1", "PETG"): 1.25, ("P1S 2", "PLA"): 0.95, ("P1S 2", "PETG"): 1.15}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_path = os.path.join(temp_dir, "durations.db")
+        model = duration_model(db_path)
+
+        now = 1_700_000_000.0
+        raw_errors = []
+        corrected_errors = []
+        for print_number in range(400):
+            printer_name, filament_type = random.choice(list(true_ratios))
+            estimated_time = random.randint(600, 6 * 3600)
+            actual_time = estimated_time * true_ratios[(printer_name, filament_type)] * random.lognormvariate(0, 0.05)
+
+            predicted_time = model.predict(estimated_time, filament_type, printer_name)
+            raw_errors.append(abs(estimated_time - actual_time) / actual_time)
+            corrected_errors.append(abs(predicted_time - actual_time) / actual_time)
+
+            model.start_job(printer_name, str(print_number), estimated_time, filament_type, filament_grams=estimated_time / 150, now=now)
+            # The old state is still reported for a moment, then it prepares, runs, pauses for a while and finishes
+            model.observe(printer_name, "FINISH", now)
+            model.observe(printer_name, "PREPARE", now + 1)
+            model.observe(printer_name, "PAUSE", now + 1 + actual_time / 2)
+            model.observe(printer_name, "RUNNING", now + 1 + actual_time / 2 + 3600)
+            assert model.observe(printer_name, "FINISH", now + 1 + actual_time + 3600)
+            now += actual_time + 4000
+
+        for start in (0, 20, 100, 300):
+            print(f"prints {start:3}-{start + 99:3}: mean error {sum(raw_errors[start:start + 100]) / 100 * 100:5.1f}% raw, "
+                  f"{sum(corrected_errors[start:start + 100]) / 100 * 100:5.1f}% corrected")
+        assert sum(corrected_errors[300:]) < sum(raw_errors[300:]) / 2
+
+        # A file where the header was edited to a few minutes is caught by the slicer's prediction, layer count and filament used
+        edited = print_metadata(plates=[plate_metadata(index=1, estimated_time=300, predicted_time=3 * 3600, layer_count=600,
+                                                       filament_grams=70, filament_type="PLA")])
+        print(model.check_estimate(edited))
+        assert model.check_estimate(edited)[0] >= 3 * 3600
+        honest = print_metadata(plates=[plate_metadata(index=1, estimated_time=3 * 3600, predicted_time=3 * 3600 - 40, layer_count=600,
+                                                       filament_grams=70, filament_type="PLA")])
+        assert model.check_estimate(honest) == (3 * 3600, [])
+
+        # Learned ratios survive a restart
+        model.close()
+        model = duration_model(db_path)
+        print(f"after restart: PLA {model.get_ratio('PLA'):.3f}, PETG on P1S 1 {model.get_ratio('PETG', 'P1S 1'):.3f}")
+        assert abs(model.get_ratio("PETG", "P1S 1") - 1.25) < 0.05
+
+        runs = 200_000
+        start = time.perf_counter()
+        for _ in range(runs):
+            model.observe("P1S 1", "RUNNING")
+        print(f"observe without a job: {(time.perf_counter() - start) / runs * 1e6:.2f} us per report")
+        model.close()
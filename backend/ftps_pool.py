@@ -0,0 +1,489 @@
+"""
+File: ftps_pool.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-03-21
+Description: Module with the ftps_pool class, which keeps FTPS connections to the printers open between file transfers and listings.
+
+bpm opens a new implicit TLS connection for every upload, listing and delete: TCP connect, a full TLS handshake, login, PROT P, the
+transfer and then it's closed again. The handshake is the slow part, the printers don't have much of a CPU. The pool keeps a few logged in
+connections per printer after they have been used, and the next transfer to the same printer takes one of them instead:
+    - Connections that have been idle for a while are checked with NOOP before they are handed out, dead ones are closed and replaced
+    - keepalive() (called by printer_manager's supervisor) sends NOOP on idle connections so the printer doesn't time them out, and closes
+      the ones idle for longer than idle_timeout
+    - New connections resume the TLS session of the last connection to the same printer, which skips most of the handshake
+    - Uploads are sent in block_size blocks from one reused buffer, instead of 1% of the file at a time
+A connection that fails while it's used is closed instead of being put back, so a half finished transfer can never be seen by the next user.
+"""
+from contextlib import contextmanager
+import socket
+import ssl
+import threading
+import time
+
+from bpm.ftpsclient.ftpsclient import ImplicitTLS
+
+
+FTPS_PORT = 990
+
+
+class resumable_tls(ImplicitTLS):
+    """
+    bpm's ImplicitTLS, but the control connection resumes tls_session if it's set. Data connections already resume the control connection's.
+    """
+    def __init__(self, *args, tls_session: ssl.SSLSession | None = None, **kwargs):
+        self.tls_session = tls_session
+        super().__init__(*args, **kwargs)
+
+    @property
+    def sock(self):
+        return self._sock
+
+    @sock.setter
+    def sock(self, value):
+        if value is not None and not isinstance(value, ssl.SSLSocket):
+            value = self.context.wrap_socket(value, session=self.tls_session)
+        self._sock = value
+
+
+class ftps_session():
+    """
+    A logged in connection to a printer from the pool. Has ftps_session like bpm's IoTFTPSClient, so it can be used where one is
+    (e.g. sdcard_cache.ftps_lister), and disconnect() gives it back to the pool instead of closing it.
+    """
+    def __init__(self, pool, printer_name: str, ftp: resumable_tls):
+        self.pool = pool
+        self.printer_name = printer_name
+        self.ftps_session = ftp
+        self.welcome = ftp.welcome or ""
+        self.last_used = time.monotonic()
+        # Last time anything was sent on it, keepalive's NOOPs included
+        self.last_active = self.last_used
+        # Whether the printer's FTP server supports MLSD, remembered for as long as the connection is
+        self.use_mlsd = True
+
+    def noop(self):
+        self.ftps_session.voidcmd("NOOP")
+        self.last_active = time.monotonic()
+
+    def upload_file(self, source: str, dest: str, callback = None):
+        """
+        Upload a file, like IoTFTPSClient.upload_file but in blocks of the pool's block_size.
+
+        Return:
+            str:
+                the printer's response
+        """
+        ftp = self.ftps_session
+        buffer = self.pool._get_buffer()
+        view = memoryview(buffer)
+
+        ftp.voidcmd("TYPE I")
+        with open(source, "rb", buffering=0) as file, ftp.transfercmd(f"STOR {dest}") as conn:
+            while True:
+                read = file.readinto(buffer)
+                if not read:
+                    break
+                conn.sendall(view[:read])
+                if callback:
+                    callback(view[:read])
+
+            # Same as in bpm, the printers' FTP servers don't all handle the TLS layer being shut down properly
+            if isinstance(conn, ssl.SSLSocket):
+                if "vsFTPd" in self.welcome:
+                    conn.unwrap()
+                else:
+                    conn.shutdown(socket.SHUT_RDWR)
+
+        return ftp.voidresp()
+
+    def delete_file(self, path: str):
+        self.ftps_session.delete(path)
+
+    def disconnect(self):
+        """
+        Give the connection back to the pool.
+        """
+        self.pool.release(self)
+
+    def discard(self):
+        """
+        Close the connection instead of giving it back, used when something failed while it was used.
+        """
+        self.pool.discard(self)
+
+    def close(self):
+        try:
+            self.ftps_session.quit()
+        except Exception:
+            try:
+                self.ftps_session.close()
+            except Exception:
+                pass
+
+
+class ftps_pool():
+    def __init__(self, max_idle_per_printer: int = 2, idle_timeout: float = 120, check_after: float = 5, keepalive_interval: float = 30,
+                 block_size: int = 1024 * 1024, timeout: float = 30):
+        """
+        Params:
+            max_idle_per_printer (int) - most connections kept open to one printer when nothing uses them
+            idle_timeout (float) - seconds a connection can be unused before it's closed
+            check_after (float) - connections unused for longer than this are checked with NOOP before being handed out
+            keepalive_interval (float) - seconds between NOOPs on idle connections, should be less than the printers' timeout
+            block_size (int) - bytes sent at a time when uploading
+            timeout (float) - seconds to wait for a printer when connecting and for every response
+        """
+        self.max_idle_per_printer = max_idle_per_printer
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.keepalive_interval = keepalive_interval
+        self.block_size = block_size
+        self.timeout = timeout
+
+        # Sessions can only be resumed with the context they were made with, so every connection uses this one.
+        # The printers' certificates are self signed, same as in bpm they aren't verified
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_NONE
+
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._tls_sessions = {}
+        self._buffers = threading.local()
+
+        self.stats = {"connected": 0, "resumed": 0, "reused": 0, "discarded": 0}
+
+    def _get_buffer(self):
+        buffer = getattr(self._buffers, "buffer", None)
+        if buffer is None or len(buffer) != self.block_size:
+            buffer = self._buffers.buffer = bytearray(self.block_size)
+        return buffer
+
+    def _count(self, stat: str):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def acquire(self, printer_name: str, host: str, user: str, password: str, port: int = FTPS_PORT):
+        """
+        Get a logged in connection to a printer, an idle one if there is one that still works, otherwise a new one.
+        Has to be given back with release() (or session.disconnect()), or discard() if something failed while it was used.
+
+        Return:
+            ftps_session
+        """
+        while True:
+            with self._lock:
+                idle = self._idle.get(printer_name)
+                session = idle.pop() if idle else None
+            if session is None:
+                break
+
+            now = time.monotonic()
+            if now - session.last_used > self.idle_timeout:
+                self.discard(session)
+                continue
+            if now - session.last_active > self.check_after:
+                try:
+                    session.noop()
+                except Exception:
+                    self.discard(session)
+                    continue
+
+            self._count("reused")
+            return session
+
+        return self._connect(printer_name, host, user, password, port)
+
+    def _connect(self, printer_name: str, host: str, user: str, password: str, port: int):
+        with self._lock:
+            tls_session = self._tls_sessions.get(printer_name)
+
+        ftp = resumable_tls(context=self.context, timeout=self.timeout, tls_session=tls_session)
+        try:
+            ftp.connect(host=host, port=port)
+            ftp.login(user=user, passwd=password)
+            ftp.prot_p()
+        except Exception:
+            ftp.close()
+            # The saved session might be what the printer didn't like
+            with self._lock:
+                self._tls_sessions.pop(printer_name, None)
+            raise
+
+        with self._lock:
+            self.stats["connected"] += 1
+            if ftp.sock.session_reused:
+                self.stats["resumed"] += 1
+            self._tls_sessions[printer_name] = ftp.sock.session
+
+        return ftps_session(self, printer_name, ftp)
+
+    def release(self, session: ftps_session):
+        """
+        Give a connection back to the pool, it's closed if the printer already has max_idle_per_printer idle connections.
+        """
+        session.last_used = session.last_active = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(session.printer_name, [])
+            if len(idle) < self.max_idle_per_printer:
+                idle.append(session)
+                return
+
+        session.close()
+
+    def discard(self, session: ftps_session):
+        self._count("discarded")
+        session.close()
+
+    @contextmanager
+    def session(self, printer_name: str, host: str, user: str, password: str, port: int = FTPS_PORT):
+        """
+        acquire() as a with statement, the connection is given back when the block is done, or closed if it raised.
+        """
+        session = self.acquire(printer_name, host, user, password, port)
+        try:
+            yield session
+        except BaseException:
+            self.discard(session)
+            raise
+        self.release(session)
+
+    def keepalive(self):
+        """
+        Send NOOP on idle connections nothing has been sent on for keepalive_interval, and close the ones unused for longer than
+        idle_timeout, or that don't answer. Meant to be called more often than keepalive_interval.
+
+        Return:
+            int:
+                number of connections closed
+        """
+        now = time.monotonic()
+        with self._lock:
+            to_check = []
+            for printer_name, idle in self._idle.items():
+                due = [session for session in idle
+                       if now - session.last_active > self.keepalive_interval or now - session.last_used > self.idle_timeout]
+                self._idle[printer_name] = [session for session in idle if session not in due]
+                to_check += due
+
+        closed = 0
+        for session in to_check:
+            if now - session.last_used > self.idle_timeout:
+                session.close()
+                closed += 1
+                continue
+            try:
+                # Only last_active is changed, so connections no one uses are still closed after idle_timeout
+                session.noop()
+            except Exception:
+                self.discard(session)
+                closed += 1
+                continue
+
+            with self._lock:
+                idle = self._idle.setdefault(session.printer_name, [])
+                if len(idle) < self.max_idle_per_printer:
+                    idle.insert(0, session)
+                    continue
+            session.close()
+
+        return closed
+
+    def close_printer(self, printer_name: str):
+        """
+        Close every idle connection to a printer and forget its TLS session, e.g. when it's disconnected.
+        """
+        with self._lock:
+            idle = self._idle.pop(printer_name, [])
+            self._tls_sessions.pop(printer_name, None)
+        for session in idle:
+            session.close()
+
+    def close(self):
+        with self._lock:
+            printer_names = list(self._idle)
+        for printer_name in printer_names:
+            self.close_printer(printer_name)
+
+
+# #BadTestingRules
+if __name__ == "__main__":
+    # Benchmark against a local stand-in for a printer's implicit FTPS server, compared to what bpm does (a new connection per transfer)
+    import datetime
+    import os
+    import socketserver
+    import tempfile
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+    from bpm.ftpsclient.ftpsclient import IoTFTPSClient
+
+    # Added to every full handshake on the control connection, stands in for the printer's slow CPU. Localhost handshakes are almost free,
+    # so without it only the saved round trips would show
+    FULL_HANDSHAKE_COST = 0.1
+
+    temp_dir = tempfile.TemporaryDirectory()
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "printer")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+                   .serial_number(1).not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1)).sign(key, hashes.SHA256()))
+    cert_path = os.path.join(temp_dir.name, "cert.pem")
+    with open(cert_path, "wb") as cert_file:
+        cert_file.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()))
+        cert_file.write(certificate.public_bytes(serialization.Encoding.PEM))
+
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(cert_path)
+    # The clients never read on data connections they send on, so session tickets sent there would be unread when they close (and reset it)
+    data_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    data_context.load_cert_chain(cert_path)
+    data_context.num_tickets = 0
+    server_stats = {"full_handshakes": 0, "resumed_handshakes": 0, "bytes_received": 0}
+    server_stats_lock = threading.Lock()
+
+    class stand_in_handler(socketserver.StreamRequestHandler):
+        def setup(self):
+            self.request = server_context.wrap_socket(self.request, server_side=True)
+            with server_stats_lock:
+                server_stats["resumed_handshakes" if self.request.session_reused else "full_handshakes"] += 1
+            if not self.request.session_reused:
+                time.sleep(FULL_HANDSHAKE_COST)
+            super().setup()
+
+        def reply(self, line):
+            self.wfile.write(f"{line}\r\n".encode())
+
+        def data_connection(self):
+            data_socket, _ = self.passive.accept()
+            self.passive.close()
+            return data_context.wrap_socket(data_socket, server_side=True)
+
+        def handle(self):
+            self.reply("220 stand-in FTPS ready")
+            for raw_line in self.rfile:
+                command, _, argument = raw_line.decode().strip().partition(" ")
+                command = command.upper()
+                if command == "USER":
+                    self.reply("331 Password required")
+                elif command == "PASS":
+                    self.reply("230 Logged in")
+                elif command in ("PBSZ", "PROT", "TYPE", "NOOP", "OPTS"):
+                    self.reply("200 OK")
+                elif command == "PASV":
+                    self.passive = socket.create_server(("127.0.0.1", 0))
+                    port = self.passive.getsockname()[1]
+                    self.reply(f"227 Entering Passive Mode (127,0,0,1,{port >> 8},{port & 255})")
+                elif command == "STOR":
+                    self.reply("150 Ok to send data")
+                    with self.data_connection() as data:
+                        received = 0
+                        while chunk := data.recv(1024 * 1024):
+                            received += len(chunk)
+                    with server_stats_lock:
+                        server_stats["bytes_received"] += received
+                    self.reply("226 Transfer complete")
+                elif command in ("MLSD", "LIST"):
+                    self.reply("150 Here comes the directory listing")
+                    with self.data_connection() as data:
+                        if command == "MLSD":
+                            lines = (f"type=file;size={i};modify=20250321101500; file_{i}.gcode.3mf" for i in range(50))
+                        else:
+                            lines = (f"-rw-r--r-- 1 root root {i} Mar 21 10:15 file_{i}.gcode.3mf" for i in range(50))
+                        data.sendall("".join(f"{line}\r\n" for line in lines).encode())
+                        data.unwrap()
+                    self.reply("226 Directory send OK")
+                elif command == "QUIT":
+                    self.reply("221 Goodbye")
+                    return
+                else:
+                    self.reply("502 Command not implemented")
+
+    class stand_in_server(socketserver.ThreadingTCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    server = stand_in_server(("127.0.0.1", 0), stand_in_handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    file_path = os.path.join(temp_dir.name, "print.gcode.3mf")
+    with open(file_path, "wb") as print_file:
+        print_file.write(os.urandom(8 * 1024 * 1024))
+    transfers = 20
+
+    def reset_server_stats():
+        with server_stats_lock:
+            for stat in server_stats:
+                server_stats[stat] = 0
+
+    # What bpm does, a new connection for every upload and listing
+    reset_server_stats()
+    start = time.perf_counter()
+    for i in range(transfers):
+        client = IoTFTPSClient("127.0.0.1", port, "bblp", "access_code", ssl_implicit=True)
+        client.upload_file(file_path, f"/cache/print_{i}.gcode.3mf")
+        list(client.ftps_session.mlsd("/cache"))
+        client.disconnect()
+    bpm_time = time.perf_counter() - start
+    bpm_stats = dict(server_stats)
+
+    pool = ftps_pool()
+    reset_server_stats()
+    start = time.perf_counter()
+    for i in range(transfers):
+        with pool.session("printer", "127.0.0.1", "bblp", "access_code", port=port) as session:
+            session.upload_file(file_path, f"/cache/print_{i}.gcode.3mf")
+            list(session.ftps_session.mlsd("/cache"))
+    pool_time = time.perf_counter() - start
+    pool_stats = dict(server_stats)
+
+    assert pool_stats["bytes_received"] == bpm_stats["bytes_received"] == transfers * 8 * 1024 * 1024
+    megabytes = transfers * 8
+    print(f"new connection every time: {bpm_time:.2f}s, {megabytes / bpm_time:.0f} MB/s, "
+          f"{bpm_stats['full_handshakes']} full and {bpm_stats['resumed_handshakes']} resumed handshakes")
+    print(f"pooled:                    {pool_time:.2f}s, {megabytes / pool_time:.0f} MB/s, "
+          f"{pool_stats['full_handshakes']} full and {pool_stats['resumed_handshakes']} resumed handshakes, {pool.stats}")
+
+    # A connection that was closed on the printer's side is replaced, and new connections resume the TLS session
+    with pool.session("printer", "127.0.0.1", "bblp", "access_code", port=port) as session:
+        pass
+    session.ftps_session.sock.shutdown(socket.SHUT_RDWR)
+    session.last_active -= pool.check_after + 1
+    reset_server_stats()
+    with pool.session("printer", "127.0.0.1", "bblp", "access_code", port=port) as new_session:
+        new_session.noop()
+    assert new_session is not session and pool.stats["discarded"] == 1 and pool.stats["resumed"] == 1
+    print(f"after the connection was lost: {dict(server_stats)}, {pool.stats}")
+
+    # keepalive sends one NOOP per keepalive_interval on an idle connection, however often it's called, and closes it after idle_timeout
+    new_session.last_active -= pool.keepalive_interval + 1
+    noops = []
+    new_session.noop = lambda: (noops.append(1), setattr(new_session, "last_active", time.monotonic()))
+    for _ in range(5):
+        assert pool.keepalive() == 0
+    assert len(noops) == 1 and pool._idle["printer"] == [new_session]
+    new_session.last_used -= pool.idle_timeout + 1
+    assert pool.keepalive() == 1 and not pool._idle["printer"]
+
+    # Uploading only, on one connection, with the pool's blocks compared to bpm's (1% of the file)
+    for block_size in (max(8192, os.path.getsize(file_path) // 100), pool.block_size):
+        pool.block_size = block_size
+        with pool.session("printer", "127.0.0.1", "bblp", "access_code", port=port) as session:
+            start = time.perf_counter()
+            for i in range(transfers):
+                session.upload_file(file_path, f"/cache/print_{i}.gcode.3mf")
+            print(f"upload throughput with {block_size // 1024} KB blocks: {megabytes / (time.perf_counter() - start):.0f} MB/s")
+
+    # Listings for sdcard_cache use pooled connections too
+    from sdcard_cache import ftps_lister
+    reused = pool.stats["reused"]
+    lister = ftps_lister(pool.acquire("printer", "127.0.0.1", "bblp", "access_code", port=port))
+    assert len(lister.list("/cache")) == 50
+    lister.close()
+    assert pool.stats["reused"] == reused + 1 and len(pool._idle["printer"]) == 1
+
+    pool.close()
+    server.shutdown()
+    temp_dir.cleanup()
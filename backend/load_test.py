@@ -0,0 +1,173 @@
+"""
+File: load_test.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-02-26
+Description: Load test of a running server, shows how many dashboards can be connected at the same time and how many uploads per second it keeps up with.
+
+Dashboards are simulated with python-socketio clients that connect and then listen, like the real dashboard does.
+Uploads need a logged in session, copy the value of the "session" cookie from a browser that is logged in and pass it with --session-cookie,
+without it only dashboards are tested. Every upload is a small, unique .gcode file, so it's really stored and parsed and not just deduplicated.
+The uploads are added to the queue, so run it against a server with its own QUEUE_DB_PATH and no printers that should print them.
+
+Run with, e.g.:
+    python backend/wsgi.py
+    python backend/load_test.py --url http://localhost:5000 --clients 500 --upload-workers 8 --session-cookie <cookie>
+"""
+import argparse
+import statistics
+import threading
+import time
+from uuid import uuid4
+
+import requests
+import socketio
+
+
+def percentile(values: list[float], fraction: float):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_dashboards(url: str, clients: int, duration: float):
+    """
+    Connect clients dashboards and keep them connected for duration seconds.
+
+    Return:
+        dict:
+            connected, failed, connect times and events received
+    """
+    results = {"connected": 0, "failed": 0, "connect_times": [], "events": 0}
+    results_lock = threading.Lock()
+    connected_clients = []
+    stop = threading.Event()
+
+    def dashboard():
+        client = socketio.Client(reconnection=False)
+
+        @client.on("*")
+        def on_any_event(event, data):
+            with results_lock:
+                results["events"] += 1
+
+        start = time.perf_counter()
+        try:
+            client.connect(url, wait_timeout=30)
+        except Exception:
+            with results_lock:
+                results["failed"] += 1
+            return
+
+        with results_lock:
+            results["connected"] += 1
+            results["connect_times"].append(time.perf_counter() - start)
+            connected_clients.append(client)
+
+        stop.wait()
+        client.disconnect()
+
+    threads = [threading.Thread(target=dashboard, daemon=True) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+        # Not all at the exact same time, like dashboards opening over a few seconds
+        time.sleep(0.005)
+
+    time.sleep(duration)
+    with results_lock:
+        results["still_connected"] = sum(1 for client in connected_clients if client.connected)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    return results
+
+
+def make_upload(size_kb: int):
+    """
+    Make a small unique gcode file with a header the server can read the time from.
+    """
+    header = ("; HEADER_BLOCK_START\n"
+              "; model printing time: 10m 0s; total estimated time: 10m 30s\n"
+              "; total layer number: 100\n"
+              "; HEADER_BLOCK_END\n"
+              f"; load test {uuid4()}\n")
+    return (header + "G1 X100.123 Y100.456 E0.01234\n" * (size_kb * 1024 // 31)).encode()
+
+
+def run_uploads(url: str, session_cookie: str, workers: int, duration: float, size_kb: int):
+    """
+    Upload files from workers threads as fast as the server accepts them for duration seconds.
+
+    Return:
+        dict:
+            successful uploads, failed uploads and their latencies
+    """
+    results = {"ok": 0, "failed": 0, "latencies": []}
+    results_lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def uploader():
+        http = requests.Session()
+        http.cookies.set("session", session_cookie)
+
+        while time.perf_counter() < deadline:
+            content = make_upload(size_kb)
+            start = time.perf_counter()
+            try:
+                response = http.post(f"{url}/upload", files={"file": ("load_test.gcode", content)}, timeout=60)
+                ok = response.status_code in (200, 202)
+            except requests.RequestException:
+                ok = False
+
+            with results_lock:
+                if ok:
+                    results["ok"] += 1
+                    results["latencies"].append(time.perf_counter() - start)
+                else:
+                    results["failed"] += 1
+
+    threads = [threading.Thread(target=uploader, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test a running PrintEz server")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--clients", type=int, default=200, help="dashboards to connect")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to keep everything running")
+    parser.add_argument("--session-cookie", default=None, help="session cookie of a logged in user, needed to test uploads")
+    parser.add_argument("--upload-workers", type=int, default=4, help="uploads sent at the same time")
+    parser.add_argument("--upload-kb", type=int, default=256, help="size of every uploaded file")
+    args = parser.parse_args()
+
+    upload_results = None
+    upload_thread = None
+    if args.session_cookie:
+        def uploads():
+            global upload_results
+            upload_results = run_uploads(args.url, args.session_cookie, args.upload_workers, args.duration, args.upload_kb)
+        upload_thread = threading.Thread(target=uploads)
+        upload_thread.start()
+
+    dashboard_results = run_dashboards(args.url, args.clients, args.duration)
+    connect_times = dashboard_results["connect_times"]
+    print(f"dashboards: {dashboard_results['connected']}/{args.clients} connected, {dashboard_results['failed']} failed, "
+          f"{dashboard_results['still_connected']} still connected after {args.duration:.0f}s")
+    if connect_times:
+        print(f"    connect time: median {statistics.median(connect_times)*1000:.0f} ms, p95 {percentile(connect_times, 0.95)*1000:.0f} ms")
+    print(f"    events received: {dashboard_results['events']} ({dashboard_results['events'] / args.duration:.0f}/s over all dashboards)")
+
+    if upload_thread:
+        upload_thread.join()
+        latencies = upload_results["latencies"]
+        print(f"uploads: {upload_results['ok'] / args.duration:.1f}/s sustained, {upload_results['ok']} ok, {upload_results['failed']} failed")
+        if latencies:
+            print(f"    latency: median {statistics.median(latencies)*1000:.0f} ms, p95 {percentile(latencies, 0.95)*1000:.0f} ms")
+    else:
+        print("uploads: not tested, pass --session-cookie to test them")
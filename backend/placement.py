@@ -0,0 +1,221 @@
+"""
+File: placement.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-03-12
+Description: Functions for matching what a print needs (nozzle diameter, filaments) with what a printer has, and the placement_index that
+             makes it cheap to find the prints a printer can print.
+
+A print's requirements are read from its 3mf (see printing_utils) when it's uploaded and saved in its print_dict:
+    requirements = {
+        "plate_index": plate_to_print:int,
+        "plate_type": build_plate_in_slicer:str | None,
+        "nozzle_diameter": nozzle_diameter:float | None,
+        "filaments": [{"slot": filament_number_in_slicer:int, "type": filament_type:str, "colour": "#RRGGBB"}, ...]
+    }
+A printer's capabilities come from its reports (loaded spools, nozzle) and the cloud's device list (nozzle_diameter):
+    capabilities = {
+        "nozzle_diameter": nozzle_diameter:float | None,
+        "spools": [{"tray": ams_tray_id:int, "type": filament_type:str, "colour": "#RRGGBB"}, ...]
+    }
+
+A print can be printed on a printer if the nozzle diameter is the same and every filament type it uses is loaded. The colour isn't required,
+but a spool with the same colour is preferred when making the AMS mapping. Anything that isn't known (a .gcode file, a printer that doesn't
+report its spools) matches anything, like before there was placement.
+
+Prints with the same nozzle diameter and set of filament types are in the same group (requirement_key), and printers with the same nozzle
+diameter and set of loaded types have the same capability_key. There are only a few of each, so which groups every capability_key can print
+is worked out once and remembered, and finding the prints a free printer can print only looks at the groups it can print.
+"""
+import webcolors
+
+
+# Build plate names in BambuStudio and the bambutools.PlateType they are
+PLATE_TYPES = {"Cool Plate": "COOL_PLATE",
+               "Engineering Plate": "ENG_PLATE",
+               "High Temp Plate": "HOT_PLATE",
+               "Smooth PEI Plate": "HOT_PLATE",
+               "Textured PEI Plate": "TEXTURED_PLATE"}
+# What every print was printed with before the plate type was read from the file
+DEFAULT_PLATE_TYPE = "TEXTURED_PLATE"
+EXTERNAL_SPOOL_TRAY = 254
+
+
+def requirements_from_metadata(metadata):
+    """
+    Get the requirements of the plate that gets printed.
+
+    Params:
+        metadata (printing_utils.print_metadata) - metadata of the file
+
+    Return:
+        dict:
+            requirements, see the top of this file
+    """
+    plate = metadata.plate
+    return {"plate_index": plate.index,
+            "plate_type": plate.plate_type,
+            "nozzle_diameter": plate.nozzle_diameter,
+            "filaments": [dict(filament) for filament in plate.filaments]}
+
+
+def normalize_colour(colour: str | None):
+    """
+    Get a colour as "#RRGGBB", printers report either a hex code (sometimes with alpha) or the name of the colour.
+    """
+    if not colour:
+        return None
+
+    colour = colour.strip()
+    if not colour.startswith("#"):
+        try:
+            return webcolors.name_to_hex(colour).upper()
+        except ValueError:
+            colour = f"#{colour}"
+
+    return colour[:7].upper() if len(colour) >= 7 else None
+
+
+def _round_diameter(nozzle_diameter: float | None):
+    return round(float(nozzle_diameter), 2) if nozzle_diameter else None
+
+
+def requirement_key(requirements: dict | None):
+    """
+    Key of the group a print is in, (nozzle_diameter, frozenset of filament types). Prints without known requirements are in (None, frozenset()).
+    """
+    if not requirements:
+        return (None, frozenset())
+    return (_round_diameter(requirements.get("nozzle_diameter")),
+            frozenset(filament["type"] for filament in requirements.get("filaments", ()) if filament.get("type")))
+
+
+def capability_key(capabilities: dict | None):
+    """
+    Key of what a printer can print, (nozzle_diameter, frozenset of loaded filament types, or None if the printer hasn't said).
+    """
+    if not capabilities:
+        return (None, None)
+    types = frozenset(spool["type"] for spool in capabilities.get("spools", ()) if spool.get("type"))
+    return (_round_diameter(capabilities.get("nozzle_diameter")), types or None)
+
+
+def can_print(capability: tuple, requirement: tuple):
+    """
+    Whether a printer with capability_key capability can print prints with requirement_key requirement.
+    """
+    printer_nozzle, printer_types = capability
+    print_nozzle, print_types = requirement
+
+    if printer_nozzle is not None and print_nozzle is not None and printer_nozzle != print_nozzle:
+        return False
+    return printer_types is None or print_types <= printer_types
+
+
+def make_ams_mapping(requirements: dict | None, capabilities: dict | None):
+    """
+    Decide which AMS tray every filament in a print is taken from.
+
+    Return:
+        tuple:
+            (use_ams, ams_mapping) for BambuPrinter.print_3mf_file. ams_mapping is a list with a tray id for every filament slot in the file
+            (slot 1 first), -1 for slots that aren't used. (False, []) if the print should use the external spool or it isn't known
+    """
+    if not requirements or not requirements.get("filaments") or not capabilities:
+        return False, []
+
+    ams_spools = [spool for spool in capabilities.get("spools", ()) if spool.get("type") and spool["tray"] != EXTERNAL_SPOOL_TRAY]
+    if not ams_spools:
+        return False, []
+
+    mapping = [-1] * max(filament["slot"] for filament in requirements["filaments"])
+    used_trays = set()
+    for filament in requirements["filaments"]:
+        same_type = [spool for spool in ams_spools if spool["type"] == filament["type"]]
+        if not same_type:
+            # One of the filaments is only on the external spool (or not loaded at all), the AMS can't be used for the print
+            return False, []
+
+        colour = normalize_colour(filament.get("colour"))
+        # Same colour first, then a tray that no other filament in the print uses, then the lowest tray
+        best = min(same_type, key=lambda spool: (spool["colour"] != colour, spool["tray"] in used_trays, spool["tray"]))
+        mapping[filament["slot"] - 1] = best["tray"]
+        used_trays.add(best["tray"])
+
+    return True, mapping
+
+
+def plate_type_name(requirements: dict | None):
+    """
+    Name of the bambutools.PlateType to print with.
+    """
+    if not requirements or not requirements.get("plate_type"):
+        return DEFAULT_PLATE_TYPE
+    return PLATE_TYPES.get(requirements["plate_type"], "AUTO")
+
+
+class placement_index():
+    """
+    Remembers which groups of prints (requirement_key) every kind of printer (capability_key) can print.
+    """
+    def __init__(self):
+        self._groups = set()
+        self._compatible = {}
+
+    def add_group(self, group: tuple):
+        """
+        Called when the queue gets a print in a group it has never had, the group is checked against every capability seen so far.
+        """
+        if group in self._groups:
+            return
+        self._groups.add(group)
+        for capability, groups in self._compatible.items():
+            if can_print(capability, group):
+                groups.add(group)
+
+    def compatible_groups(self, capability: tuple):
+        """
+        Get the groups a printer with capability can print, only checked against every group the first time capability is seen.
+
+        Return:
+            set[tuple]:
+                requirement_keys, the set must not be changed
+        """
+        groups = self._compatible.get(capability)
+        if groups is None:
+            groups = self._compatible[capability] = {group for group in self._groups if can_print(capability, group)}
+        return groups
+
+
+# #BadTestingRules
+if __name__ == "__main__":
+    import random
+    import time
+
+    requirements = {"plate_index": 2, "plate_type": "Cool Plate", "nozzle_diameter": 0.4,
+                    "filaments": [{"slot": 1, "type": "PLA", "colour": "#FFFFFF"}, {"slot": 3, "type": "PETG", "colour": "#000000"}]}
+    capabilities = {"nozzle_diameter": 0.4,
+                    "spools": [{"tray": 0, "type": "PLA", "colour": normalize_colour("black")},
+                               {"tray": 1, "type": "PLA", "colour": normalize_colour("FFFFFFFF")},
+                               {"tray": 2, "type": "PETG", "colour": "#000000"},
+                               {"tray": EXTERNAL_SPOOL_TRAY, "type": "TPU", "colour": "#FF0000"}]}
+    assert can_print(capability_key(capabilities), requirement_key(requirements))
+    assert make_ams_mapping(requirements, capabilities) == (True, [1, -1, 2])
+    assert plate_type_name(requirements) == "COOL_PLATE" and plate_type_name(None) == DEFAULT_PLATE_TYPE
+    assert not can_print(capability_key(dict(capabilities, nozzle_diameter=0.6)), requirement_key(requirements))
+    assert can_print(capability_key(None), requirement_key(requirements)) and can_print(capability_key(capabilities), requirement_key(None))
+    print("matching ok")
+
+    # A farm with a few kinds of printers and a queue with a few kinds of prints, the compatible groups are looked up per dispatch
+    types = ("PLA", "PETG", "ABS", "TPU", "ASA")
+    index = placement_index()
+    for _ in range(10000):
+        index.add_group(requirement_key({"nozzle_diameter": random.choice((0.2, 0.4, 0.6)),
+                                         "filaments": [{"type": random.choice(types)} for _ in range(random.randint(1, 2))]}))
+    printers = [{"nozzle_diameter": random.choice((0.4, 0.6)), "spools": [{"tray": tray, "type": random.choice(types)} for tray in range(4)]}
+                for _ in range(50)]
+
+    runs = 100_000
+    start = time.perf_counter()
+    for i in range(runs):
+        index.compatible_groups(capability_key(printers[i % len(printers)]))
+    print(f"{len(index._groups)} groups, compatible groups of a printer in {(time.perf_counter() - start) / runs * 1e6:.2f} us")
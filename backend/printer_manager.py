@@ -10,7 +10,6 @@ Description: Module with a class used to manage multiple printers (made for P1S
 import time
 import sys
 
-import requests
 from bpm.bambuconfig import BambuConfig
 from bpm.bambuprinter import BambuPrinter
 from bpm.bambutools import PrinterState, PlateType
@@ -18,12 +17,42 @@ from bpm.bambutools import parseStage
 from bpm.bambutools import parseFan
 
 import json
+import random
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from dotenv import load_dotenv
 import os
 
+from bambu_cloud import bambu_cloud_client, cloud_auth_error, cloud_error
+from placement import make_ams_mapping, plate_type_name, normalize_colour
+from sdcard_cache import sdcard_cache, ftps_lister, filter_3mf_files
+from ftps_pool import ftps_pool
+
+class frozen_dict(dict):
+    """
+    Dict that can't be changed after it's created, still a dict so it can be sent with socketio/jsonify as is.
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("frozen_dict can't be changed")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __ior__ = _readonly
+
+
+"""
+Snapshot of the telemetry of all printers, shared by everything that needs it during a tick:
+    version (int) - increases by one every time the snapshot is refreshed
+    taken_at (float) - timestamp of when the snapshot was taken
+    tasks_info (frozen_dict) - same format as get_tasks_info, with a frozen_dict per printer
+    time_remaining (frozen_dict) - printer names as keys and time_remaining as values
+"""
+printer_snapshot = namedtuple("printer_snapshot", ["version", "taken_at", "tasks_info", "time_remaining"])
+
+
 class printer_manager():
-    def __init__(self, uid: str, access_token: str, region: str = "Europe"):
+    def __init__(self, uid: str, access_token: str, region: str = "Europe", refresh_token: str | None = None):
         load_dotenv()
 
         # Get environment variables for printers
@@ -36,15 +65,41 @@ class printer_manager():
         self.devices = {}
         self.printers = {}
         self.files = {}
+        # What is on the printers' SD cards, see get_sdcard_files
+        # FTPS connections are kept open between uploads, listings and deletes (see ftps_pool.py)
+        self._ftps_pool = ftps_pool()
+        self._sdcard_cache = sdcard_cache(self._connect_ftps, ttl=300)
 
         self.cloud_host = "https://api.bambulab.com"
+        self.cloud = bambu_cloud_client(access_token, refresh_token, host=self.cloud_host, on_token_refreshed=self._on_token_refreshed)
+
+        self._snapshot = printer_snapshot(0, 0.0, frozen_dict(), frozen_dict())
+        self._snapshot_lock = threading.Lock()
+
+        self._update_callbacks = []
+        self._last_gcode_states = {}
+
+        # Connection health of every printer, see get_connection_health
+        self._health = {}
+        self._health_lock = threading.Lock()
+        self._ready_events = {}
+        self._connect_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="printer_connect")
+        self._supervisor = None
+        self._supervisor_stop = threading.Event()
 
-    def get_devices(self):
+        # Seconds to wait before reconnecting, doubled for every failed attempt
+        self.reconnect_backoff = 2
+        self.max_reconnect_backoff = 300
+        # A printer sends a report at least every few seconds, and the watchdog in bpm asks for one after 30s without any
+        self.stale_after = 90
+
+    def get_devices(self, force_refresh: bool = False):
         """
         Gets all devices connected to cloud user.
 
         Params:
-            No Params
+            - bool
+                force_refresh: Ask the cloud even if the device list was fetched less than a minute ago
 
         Return:
             - dict[str: str | float]
@@ -66,49 +121,75 @@ class printer_manager():
 
         Exceptions:
             - Unable to get devices
-                request to the endpoint resulted in res.ok being false, wont return anything
+                request to the endpoint failed, even after being retried and refreshing the access token
         """
 
-        endpoint = "/v1/iot-service/api/user/bind"
-        # User agent needs to be specified to something, ohterwise bambulabs blocks it for some reason?!??!?!
-        headers = {"Authorization": f"Bearer {self.access_token}",
-                   "User-Agent": "curl/7.68.0"}
-        res = requests.get(f"{self.cloud_host}{endpoint}", headers=headers)
+        try:
+            self.devices = self.cloud.get_bound_devices(force_refresh=force_refresh)
+            return self.devices
 
-        if not res.ok:
-            print(f"ERROR got response {res}")
+        except cloud_auth_error as e:
+            print(f"Status from get devices is {e}, this probably means that your access token is invalid, please check it")
+            raise Exception("Unable to get devices")
+
+        except cloud_error as e:
+            print(f"ERROR got response {e}")
             raise Exception("Unable to get devices")
-        elif res.status_code == 401:
-            print(f"Status from get devices is {res}, this probably means that your access token is invalid, please check it")
-        else:
-            self.devices = res.json()["devices"]
-            return res.json()["devices"]
 
-    def connect_printers(self, printers_to_connect: list[str]):
+    def refresh_devices(self, should_connect=None):
         """
-        Connects to all printers with the names of the printers. It is recommeded to use some sleeping function after calling this
+        Get the devices from the cloud again, and connect to printers that have been bound to the cloud user since the last time.
 
         Params:
+            - function | None
+                should_connect: Function taking a device dict, returns whether to connect to it. Connects to all new devices if None
+
+        Returns:
             - list[str]
-                - printers_to_connect: List of names of the printers to connect to, these names can be gotten with self.get_devices
+                Names of the printers that were connected
+        """
+        devices = self.get_devices(force_refresh=True)
+        new_printers = [device for device in devices
+                        if device["name"] not in self.printers and (should_connect is None or should_connect(device))]
+
+        if new_printers:
+            self.connect_printers(new_printers)
+        return [device["name"] for device in new_printers]
+
+    def _on_token_refreshed(self, access_token: str, refresh_token: str | None):
+        # Used by printers connected after this
+        self.access_token = access_token
+
+    def connect_printers(self, printers_to_connect: list[dict], ready_timeout: float = 10):
+        """
+        Connects to all printers at the same time, and waits until every printer has sent its first report or ready_timeout has passed.
+        Printers that aren't ready in time are still connected, and are reconnected by the supervisor (see start_supervisor) if they fail.
+
+        Params:
+            - list[dict]
+                - printers_to_connect: Devices to connect to, as returned by self.get_devices
+            - float
+                - ready_timeout: Most seconds to wait for all printers to send their first report
 
         Returns:
-            - None
+            - dict[str: bool]
+                Printer names as keys and whether the printer sent a report in time as values
 
-        example usage: printer_manager.connect_printers(["my_printer_1", "my_printer_2", "my_printer_3"])
+        example usage: printer_manager.connect_printers([device for device in printer_manager.get_devices() if device["name"].startswith("S4")])
         """
+        if not self.access_token or not self.cloud_username:
+            print("***WARNING***")
+            print("access_token and cloud_username need to be defined to use cloud services")
+            print("***WARNING***")
 
+        new_printers = {}
         for printer in printers_to_connect:
-            try: 
-                printer_ip = os.getenv(printer["name"].replace(" ", "_"))
-            except KeyError:
-                print("Printer Name and IP not found in .env")
-            
-            if not self.access_token or not self.cloud_username:
+            printer_ip = os.getenv(printer["name"].replace(" ", "_"))
+            if not printer_ip:
                 print("***WARNING***")
-                print("access_token and cloud_username need to be defined to use cloud services")
+                print(f"Printer Name and IP not found in .env, not connecting to {printer['name']}")
                 print("***WARNING***")
-
+                continue
 
             config = BambuConfig(ip=printer_ip, 
                                  access_code=printer["dev_access_code"], 
@@ -117,13 +198,191 @@ class printer_manager():
                                  mqtt_username_cloud=self.cloud_username)
             
             printer_instance = BambuPrinter(config=config)
+            printer_instance.on_update = partial(self._on_printer_update, printer["name"])
+            new_printers[printer["name"]] = printer_instance
+
+            self._ready_events[printer["name"]] = threading.Event()
+            with self._health_lock:
+                self._health[printer["name"]] = {"status": "connecting",
+                                                 "connected_since": None,
+                                                 "last_report_at": None,
+                                                 "last_attempt_at": None,
+                                                 "reconnect_attempts": 0,
+                                                 "next_reconnect_at": None,
+                                                 "last_error": None,
+                                                 "stopped": False}
+
+        # Replaced instead of changed, since printers can be added while other threads loop over self.printers
+        self.printers = {**self.printers, **new_printers}
+
+        # Connecting waits for the TCP and TLS handshakes, so it's done for all printers at the same time
+        for printer_name in new_printers:
+            self._connect_pool.submit(self._start_session, printer_name)
+
+        deadline = time.monotonic() + ready_timeout
+        ready = {}
+        for printer_name in new_printers:
+            ready[printer_name] = self._ready_events[printer_name].wait(max(0.0, deadline - time.monotonic()))
+            if not ready[printer_name]:
+                print(f"{printer_name} didn't send a report within {ready_timeout}s of connecting")
+
+        return ready
+
+    def _start_session(self, printer_name: str):
+        printer = self.printers[printer_name]
+
+        # A session that was lost has to be stopped completely before it's started again
+        if printer.client and printer.client.is_connected():
+            printer.client.disconnect()
+        for thread in (getattr(printer, "_mqtt_client_thread", None), getattr(printer, "_watchdog_thread", None)):
+            if thread and thread.is_alive() and thread is not threading.current_thread():
+                thread.join(timeout=5)
+
+        with self._health_lock:
+            self._health[printer_name]["last_attempt_at"] = time.time()
+
+        # start_session starts a watchdog that stops as soon as it sees the QUIT state the old session left behind
+        printer.state = PrinterState.NO_STATE
+        printer._internalException = None
+
+        try: 
+            printer.start_session()
+            error = printer._internalException
+        except Exception as e:
+            error = e
+
+        if error is not None or printer.state == PrinterState.QUIT:
+            print("***WARNING***")
+            print(f"Failed to connect to printer {printer_name}")
+            print(f"Recieved exception: {error}")
+            print("***WARNING***")
+            self._schedule_reconnect(printer_name, str(error or "unable to connect"))
+            return
+
+        with self._health_lock:
+            health = self._health[printer_name]
+            if health["status"] == "reconnecting":
+                health["status"] = "connecting"
+
+    def _schedule_reconnect(self, printer_name: str, error: str | None):
+        with self._health_lock:
+            self._schedule_reconnect_locked(self._health[printer_name], error)
+
+    def _schedule_reconnect_locked(self, health: dict, error: str | None):
+        if health["stopped"]:
+            return
+
+        # Jitter so that printers that dropped at the same time (e.g. the wifi went down) don't all reconnect at the same time
+        delay = min(self.reconnect_backoff * 2 ** health["reconnect_attempts"], self.max_reconnect_backoff)
+        health["status"] = "disconnected"
+        health["connected_since"] = None
+        health["last_error"] = error
+        health["reconnect_attempts"] += 1
+        health["next_reconnect_at"] = time.time() + delay / 2 + random.uniform(0, delay / 2)
+
+    def start_supervisor(self, interval: float = 5):
+        """
+        Start a thread that reconnects printers whose MQTT session has been lost, or that have stopped sending reports, with backoff.
+
+        Params:
+            - float
+                interval: Seconds between every check of the printers
+        """
+        if self._supervisor and self._supervisor.is_alive():
+            return
+
+        self._supervisor_stop.clear()
+        self._supervisor = threading.Thread(target=self._supervise, args=(interval,), name="printer_supervisor", daemon=True)
+        self._supervisor.start()
+
+    def stop_supervisor(self):
+        self._supervisor_stop.set()
+        if self._supervisor:
+            self._supervisor.join()
+
+    def _supervise(self, interval: float):
+        while not self._supervisor_stop.wait(interval):
+            now = time.time()
+            for printer_name, printer in self.printers.items():
+                with self._health_lock:
+                    health = self._health.get(printer_name)
+                    if health is None or health["stopped"] or health["status"] == "reconnecting":
+                        continue
+
+                    if health["status"] in ("connected", "connecting"):
+                        last_heard_from = max(health["last_report_at"] or 0, health["last_attempt_at"] or 0)
+                        if printer.state == PrinterState.QUIT:
+                            self._schedule_reconnect_locked(health, str(printer._internalException or "MQTT session ended"))
+                        elif last_heard_from and now - last_heard_from > self.stale_after:
+                            self._schedule_reconnect_locked(health, f"no report for {now - last_heard_from:.0f}s")
+                        continue
+
+                    if health["status"] != "disconnected" or now < health["next_reconnect_at"]:
+                        continue
+
+                    health["status"] = "reconnecting"
+
+                print(f"Reconnecting to {printer_name}, attempt {health['reconnect_attempts']}")
+                self._connect_pool.submit(self._start_session, printer_name)
+
+            self._ftps_pool.keepalive()
+
+    def get_connection_health(self):
+        """
+        Get the health of the connection to every printer.
 
-            self.printers[printer["name"]] = printer_instance
-            try: 
-                self.printers[printer["name"]].start_session()
+        Returns:
+            - dict[str: dict]
+                Printer names as keys and dicts as values with:
+                    "status": "connecting", "connected", "disconnected" (waiting to reconnect), "reconnecting" or "stopped"
+                    "connected_since", "last_report_at", "next_reconnect_at": timestamps or None
+                    "reconnect_attempts": failed attempts since the printer was last connected
+                    "last_error": why the last connection was lost, or None
+        """
+        with self._health_lock:
+            return {printer_name: {key: value for key, value in health.items() if key != "stopped"}
+                    for printer_name, health in self._health.items()}
+
+    def register_update_callback(self, callback):
+        """
+        Register a function to be called every time a printer sends a report over MQTT. The callback is called from the MQTT thread
+        of the printer, so it should return quickly.
+
+        Params:
+            - function
+                callback: Function taking (printer_name: str, old_gcode_state: str | None, new_gcode_state: str)
+
+        Returns:
+            - None
+        """
+        self._update_callbacks.append(callback)
+
+    def _on_printer_update(self, printer_name: str, printer: BambuPrinter):
+        with self._health_lock:
+            health = self._health.get(printer_name)
+            if health is not None and not health["stopped"]:
+                now = time.time()
+                if health["status"] != "connected":
+                    health["status"] = "connected"
+                    health["connected_since"] = now
+                    health["reconnect_attempts"] = 0
+                    health["next_reconnect_at"] = None
+                health["last_report_at"] = now
+
+        ready_event = self._ready_events.get(printer_name)
+        if ready_event is not None:
+            ready_event.set()
+
+        new_gcode_state = printer.gcode_state
+        old_gcode_state = self._last_gcode_states.get(printer_name)
+        self._last_gcode_states[printer_name] = new_gcode_state
+
+        for callback in self._update_callbacks:
+            try:
+                callback(printer_name, old_gcode_state, new_gcode_state)
             except Exception as e:
                 print("***WARNING***")
-                print("Failed to connect to printer")
+                print(f"Update callback failed for {printer_name}")
                 print(f"Recieved exception: {e}")
                 print("***WARNING***")
 
@@ -175,6 +434,62 @@ class printer_manager():
 
         return states
     
+    def get_telemetry_sample(self, printer_name: str):
+        """
+        Function to get the fields of a printer that are recorded in the telemetry_store.
+
+        Params:
+            printer_name: str - name of the printer
+        Return:
+            dict[str: int | float | str]:
+                fields with the same names as in telemetry_store.COLUMNS
+        """
+        printer = self.printers[printer_name]
+        return {"percent_complete": printer._percent_complete,
+                "current_layer": printer._current_layer,
+                "total_layers": printer._layer_count,
+                "time_remaining": printer._time_remaining,
+                "current_stage": printer._current_stage,
+                "gcode_state": printer.gcode_state,
+                "bed_temp": getattr(printer, "_bed_temp", None),
+                "tool_temp": getattr(printer, "_tool_temp", None)}
+
+    def refresh_snapshot(self):
+        """
+        Read the telemetry of all printers once and store it as the current snapshot, see get_snapshot.
+
+        Returns:
+            - printer_snapshot
+                The new snapshot
+        """
+        with self._snapshot_lock:
+            tasks_info = self.get_tasks_info()
+            snapshot = printer_snapshot(version=self._snapshot.version + 1,
+                                        taken_at=time.time(),
+                                        tasks_info=frozen_dict({name: frozen_dict(info) for name, info in tasks_info.items()}),
+                                        time_remaining=frozen_dict({name: info["time_remaining"] for name, info in tasks_info.items()}))
+            self._snapshot = snapshot
+
+        return snapshot
+
+    def get_snapshot(self, max_age: float | None = None):
+        """
+        Get the latest telemetry snapshot of all printers. The snapshot can't be changed, so it can be shared between threads without copying it.
+
+        Params:
+            - float | None
+                max_age: If set, the snapshot is refreshed first if it's older than this many seconds (or has never been taken)
+
+        Returns:
+            - printer_snapshot
+                namedtuple with version, taken_at, tasks_info and time_remaining
+        """
+        snapshot = self._snapshot
+        if snapshot.version == 0 or (max_age is not None and time.time() - snapshot.taken_at > max_age):
+            snapshot = self.refresh_snapshot()
+
+        return snapshot
+
     def get_printer_states(self, printers: list[str] | None = None):
         """
         Function to get the gcode_state (can be something like "RUNNING", "FINISHED", "FAILED" or "PREPARING")
@@ -215,27 +530,56 @@ class printer_manager():
 
         return infos
     
-    def get_sdcard_files(self, printers: list | None = None, only_3mf_files: bool = True, get_from_printer = True):
+    def _ftps_session(self, printer_name: str):
+        config = self.printers[printer_name].config
+        return self._ftps_pool.session(printer_name, config.hostname, config.mqtt_username, config.access_code)
+
+    def _connect_ftps(self, printer_name: str):
+        config = self.printers[printer_name].config
+        return ftps_lister(self._ftps_pool.acquire(printer_name, config.hostname, config.mqtt_username, config.access_code))
+
+    def get_sdcard_files(self, printers: list | None = None, only_3mf_files: bool = True, get_from_printer = True, max_age: float | None = None):
         """
-        Function to return get the files of all the printers specified, this uses ftps and needs to be done when connected to the same wifi as the printers
+        Function to return get the files of all the printers specified, this uses ftps and needs to be done when connected to the same wifi as the printers.
+        The files are cached (see sdcard_cache.py), printers are only listed again when their files are older than max_age, all at the same time.
+
+        params:
+            printers: list[str] | None - names of the printers, all printers if None
+            only_3mf_files: bool - only .3mf files (and the folders)
+            get_from_printer: bool - list printers whose files are older than max_age, if False only what is cached is returned
+            max_age: float | None - seconds, the cache's ttl if None and 0 to list every printer again
+
+        return:
+            dict[str: dict | None]:
+                printer names as keys and trees of the files as values (see sdcard_cache.py), None if a printer has never been listed
         """
         if printers == None:
             printers = list(self.printers.keys())
-        printer_files = {}
-        for printer in printers:
-            if not get_from_printer:
-                if not only_3mf_files:
-                    printer_files[printer] = self.printers[printer]._sdcard_contents
-
-                else:
-                    printer_files[printer] = self.printers[printer].get_sdcard_3mf_files()
 
+        if get_from_printer:
+            printer_files = self._sdcard_cache.get(printers, max_age)
+        else:
+            printer_files = {printer: self._sdcard_cache.get_cached(printer) for printer in printers}
 
-            else:    
-                printer_files[printer] = self.printers[printer].get_sdcard_contents()
+        if only_3mf_files:
+            printer_files = {printer: filter_3mf_files(files) for printer, files in printer_files.items()}
 
         self.files = printer_files
-        return printer_files    
+        return printer_files
+
+    def find_sdcard_files(self, name: str | None = None, digest: str | None = None):
+        """
+        Function to find files on the SD cards of all printers, from what was cached the last time they were listed
+
+        params:
+            name: str | None - file name without the folder, not case sensitive
+            digest: str | None - sha256 of a file the server has uploaded
+
+        return:
+            list[dict]:
+                {"printer_name": str, "path": str, "size": int | None} of every file that matches
+        """
+        return self._sdcard_cache.find(name, digest)
     
     def upload_print(self, printer_name:str, local_file_path:str, printer_file_path:str):
         """
@@ -255,24 +599,83 @@ class printer_manager():
                     or
                     "No file uploaded." if an error occured during upload (will also raise exception)
         """
-        return self.printers[printer_name].upload_sdcard_file(local_file_path, printer_file_path)
+        if not printer_file_path.endswith((".gcode", ".3mf")):
+            return "Invalid file extension"
 
-    def start_print_on_printer(self, printer_name:str, filename:str):
+        # Uploaded on a pooled connection instead of with BambuPrinter.upload_sdcard_file, which connects again and lists the whole SD card afterwards
+        with self._ftps_session(printer_name) as session:
+            session.upload_file(local_file_path, printer_file_path)
+
+        self._sdcard_cache.file_added(printer_name, printer_file_path, os.path.getsize(local_file_path))
+        return printer_file_path
+
+    def delete_sdcard_file(self, printer_name: str, printer_file_path: str):
+        """
+        Function to delete a file from a printer's SD card
+
+        params:
+            printer_name: str - Name of the printer
+            printer_file_path: str - Path of the file on the printer, e.g. "/cache/print.gcode.3mf"
+        """
+        with self._ftps_session(printer_name) as session:
+            session.delete_file(printer_file_path)
+        self._sdcard_cache.file_removed(printer_name, printer_file_path)
+
+    def get_capabilities(self, printer_name: str):
+        """
+        Function to get what a printer can print, from what it has reported and the device list from the cloud
+
+        params:
+            printer_name: str - Name of the printer
+
+        return:
+            dict:
+                {"nozzle_diameter": float | None, "spools": [{"tray": int, "type": str, "colour": str | None}, ...]}, see placement.py
+        """
+        printer = self.printers[printer_name]
+
+        nozzle_diameter = getattr(printer, "_nozzle_diameter", None)
+        if not nozzle_diameter:
+            device = next((device for device in self.devices or () if device.get("name") == printer_name), None)
+            nozzle_diameter = device.get("nozzle_diameter") if device else None
+
+        spools = [{"tray": spool.id, "type": (spool.type or "").upper(), "colour": normalize_colour(spool.color)}
+                  for spool in getattr(printer, "_spools", ())]
+
+        return {"nozzle_diameter": float(nozzle_diameter) if nozzle_diameter else None, "spools": spools}
+
+    def start_print_on_printer(self, printer_name:str, filename:str, requirements: dict | None = None):
         """
         Function to start a print on a printer
         params:
             printer_name: str - Name of the printer to print on, same as specified in .env
             file_name: str - Name of file to print
+            requirements: dict | None - what the print needs, the plate, build plate and AMS trays are taken from it (see placement.py).
+                                        Plate 1 on the textured plate from the external spool if None
 
         return:
             bool:
                 Whether successful
 
-        This function doesnt work, problem is believed to be that cloud connection is needed.
+        Exceptions:
+            - if the file isn't a .3mf or .gcode file
         """
-        if filename.split(".")[-1] == "3mf":
-            return self.printers[printer_name].print_3mf_file(filename, 1, PlateType.TEXTURED_PLATE, False)
-        
+        printer = self.printers[printer_name]
+
+        if filename.endswith(".3mf"):
+            use_ams, ams_mapping = make_ams_mapping(requirements, self.get_capabilities(printer_name))
+            plate_index = requirements["plate_index"] if requirements else 1
+            return printer.print_3mf_file(filename, plate_index, PlateType[plate_type_name(requirements)], use_ams,
+                                          json.dumps(ams_mapping) if ams_mapping else "")
+
+        if filename.endswith(".gcode"):
+            # bpm can only start 3mf files, plain gcode is started with the printer's own command for it
+            command = {"print": {"sequence_id": "0", "command": "gcode_file", "param": f"/sdcard{filename}"}}
+            printer.client.publish(f"device/{printer.config.serial_number}/request", json.dumps(command))
+            return True
+
+        raise Exception(f"Unable to print {filename}, only .3mf and .gcode files can be printed")
+
     def stop_print_on_printers(self, printer_names:list[str] = None):
         """
         Function to stop printing on printers
@@ -333,7 +736,17 @@ class printer_manager():
             printer_names = list(self.printers.keys())
 
         for printer_name in printer_names:
-            self.printers[printer_name].quit()
+            with self._health_lock:
+                if printer_name in self._health:
+                    self._health[printer_name]["stopped"] = True
+                    self._health[printer_name]["status"] = "stopped"
+
+            try:
+                self.printers[printer_name].quit()
+            except Exception as e:
+                print(f"Failed to disconnect from {printer_name}: {e}")
+            self._sdcard_cache.forget(printer_name)
+            self._ftps_pool.close_printer(printer_name)
 
 
 if __name__ == "__main__":
@@ -355,9 +768,8 @@ if __name__ == "__main__":
         if printer["name"][0] == "S" and printer["name"][1] != "6":
             printers_to_connect_to.append(printer)
 
-    p_man.connect_printers(printers_to_connect_to)
-    # Need to sleep for a small amount of time after connect
-    time.sleep(2)
+    print(p_man.connect_printers(printers_to_connect_to))
+    print(p_man.get_connection_health())
 
     # p_man.pushall()
 
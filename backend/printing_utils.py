@@ -1,6 +1,306 @@
 import zipfile
+import json
+import os
+import re
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
 
-def extract_bambulab_estimated_time(printfile_filepath:str) -> int | list[None, str]:
+from blocking_io import run_blocking
+from time_parser import parse_time_fields
+
+# The header block of a BambuStudio gcode file is well under this size, only this much of every gcode file is ever read
+GCODE_HEADER_READ_BYTES = 16 * 1024
+# slice_info.config is a few KB per plate, anything bigger than this isn't a file from a slicer
+SLICE_INFO_MAX_BYTES = 1024 * 1024
+SLICE_INFO_PATH = "Metadata/slice_info.config"
+# All the slicer's settings as JSON, tens of KB
+PROJECT_SETTINGS_MAX_BYTES = 4 * 1024 * 1024
+PROJECT_SETTINGS_PATH = "Metadata/project_settings.config"
+
+_PLATE_GCODE_PATTERN = re.compile(r"^Metadata/plate_(\d+)\.gcode$")
+
+# Parsing metadata reads and decompresses files, so it's done here instead of in the request thread
+metadata_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="metadata")
+
+
+@dataclass
+class plate_metadata():
+    """
+    What is known about one plate of a print file. Fields are None when the file doesn't say.
+    """
+    index: int
+    estimated_time: int | None = None
+    filament_grams: float | None = None
+    layer_count: int | None = None
+    gcode_file: str | None = None
+    # The slicer's prediction in slice_info, kept apart from estimated_time since it's only changed if the user edits both files
+    predicted_time: int | None = None
+    # Type of the filament the plate uses the most of, e.g. "PLA"
+    filament_type: str | None = None
+    # Parts of estimated_time from the gcode header, printing the model and preparing (heating, levelling etc.)
+    model_time: int | None = None
+    prepare_time: int | None = None
+    # Every filament the plate uses, {"slot": filament number in the slicer (from 1), "type": e.g. "PLA", "colour": e.g. "#FFFFFF"}
+    filaments: list[dict] = field(default_factory=list)
+    nozzle_diameter: float | None = None
+    # Name of the build plate in the slicer, e.g. "Textured PEI Plate"
+    plate_type: str | None = None
+
+
+@dataclass
+class print_metadata():
+    """
+    What is known about a print file, one plate_metadata per sliced plate in order of plate index.
+    """
+    plates: list[plate_metadata] = field(default_factory=list)
+
+    @property
+    def plate(self):
+        """The plate that gets printed, the first one that was sliced."""
+        return self.plates[0]
+
+    @property
+    def estimated_time(self):
+        return self.plate.estimated_time
+
+    @property
+    def filament_type(self):
+        return self.plate.filament_type
+
+
+def extract_print_metadata(printfile_filepath: str) -> print_metadata:
+    """
+    Function to get the metadata (estimated time, filament used and layer count per plate) of a .gcode.3mf or .gcode file.
+    Only Metadata/slice_info.config and the header of each plate's gcode are read, with one bounded read each, so the time it takes doesn't
+    depend on how big the file is.
+
+    Params:
+        - str:
+            printfile_filepath: Path to the print file
+
+    Returns:
+        - print_metadata:
+            metadata of every sliced plate in the file
+
+    Exceptions:
+        - ValueError
+            if the file isn't a sliced print file or has no time estimate
+    """
+    if not zipfile.is_zipfile(printfile_filepath):
+        if printfile_filepath.lower().endswith(".gcode"):
+            with open(printfile_filepath, "rb") as gcode:
+                plate = plate_metadata(index=1, gcode_file=os.path.basename(printfile_filepath))
+                _parse_gcode_header(gcode.read(GCODE_HEADER_READ_BYTES), plate)
+                return _checked(print_metadata(plates=[plate]))
+
+        raise ValueError("The provided file is not a valid .3mf archive.")
+
+    try:
+        return _extract_3mf_metadata(printfile_filepath)
+    except zipfile.BadZipFile:
+        raise ValueError("The provided file is not a valid .3mf archive.")
+
+
+def _extract_3mf_metadata(printfile_filepath: str) -> print_metadata:
+    with zipfile.ZipFile(printfile_filepath, 'r') as archive:
+        plates = {}
+
+        members = {info.filename: info for info in archive.infolist()}
+        slice_info = members.get(SLICE_INFO_PATH)
+        if slice_info and slice_info.file_size <= SLICE_INFO_MAX_BYTES:
+            with archive.open(slice_info, 'r') as slice_info_file:
+                _parse_slice_info(slice_info_file.read(SLICE_INFO_MAX_BYTES), plates)
+
+        project_settings = members.get(PROJECT_SETTINGS_PATH)
+        project_settings_values = {}
+        if project_settings and project_settings.file_size <= PROJECT_SETTINGS_MAX_BYTES:
+            with archive.open(project_settings, 'r') as project_settings_file:
+                project_settings_values = _parse_project_settings(project_settings_file.read(PROJECT_SETTINGS_MAX_BYTES))
+
+        for name in members:
+            match = _PLATE_GCODE_PATTERN.match(name)
+            if not match:
+                continue
+
+            plate = plates.setdefault(int(match.group(1)), plate_metadata(index=int(match.group(1))))
+            plate.gcode_file = name
+            with archive.open(name, 'r') as gcode:
+                _parse_gcode_header(gcode.read(GCODE_HEADER_READ_BYTES), plate)
+
+        # Files from other slicers don't name their gcode after the plate
+        if not any(plate.gcode_file for plate in plates.values()):
+            gcode_files = [name for name in members if name.endswith(".gcode")]
+            if gcode_files:
+                plate = plates.setdefault(1, plate_metadata(index=1))
+                plate.gcode_file = gcode_files[0]
+                with archive.open(gcode_files[0], 'r') as gcode:
+                    _parse_gcode_header(gcode.read(GCODE_HEADER_READ_BYTES), plate)
+
+        # Plates listed in slice_info but without any gcode weren't sliced, and can't be printed
+        sliced_plates = [plate for _, plate in sorted(plates.items()) if plate.gcode_file]
+        if not sliced_plates:
+            raise ValueError("No gcode_file found")
+
+        # Project settings are the same for every plate, slice_info is preferred since it's per plate
+        for plate in sliced_plates:
+            if plate.nozzle_diameter is None:
+                plate.nozzle_diameter = project_settings_values.get("nozzle_diameter")
+            plate.plate_type = plate.plate_type or project_settings_values.get("plate_type")
+
+        return _checked(print_metadata(plates=sliced_plates))
+
+
+def _checked(metadata: print_metadata):
+    if metadata.estimated_time is None:
+        raise ValueError("Unable to find estimated time in file")
+    return metadata
+
+
+def _parse_slice_info(slice_info: bytes, plates: dict[int: plate_metadata]):
+    try:
+        root = ElementTree.fromstring(slice_info)
+    except ElementTree.ParseError:
+        return
+
+    for plate_element in root.iter("plate"):
+        values = {metadata.get("key"): metadata.get("value") for metadata in plate_element.findall("metadata")}
+
+        try:
+            index = int(values["index"])
+        except (KeyError, TypeError, ValueError):
+            continue
+
+        plate = plates.setdefault(index, plate_metadata(index=index))
+        if values.get("prediction"):
+            plate.estimated_time = int(float(values["prediction"]))
+            plate.predicted_time = plate.estimated_time
+        if values.get("weight"):
+            plate.filament_grams = float(values["weight"])
+
+        if values.get("nozzle_diameters"):
+            try:
+                plate.nozzle_diameter = float(values["nozzle_diameters"].split(",")[0])
+            except ValueError:
+                pass
+
+        filaments = []
+        for filament_element in plate_element.findall("filament"):
+            try:
+                filaments.append((float(filament_element.get("used_g") or 0), int(filament_element.get("id")),
+                                  (filament_element.get("type") or "").upper(), (filament_element.get("color") or "").upper()))
+            except (TypeError, ValueError):
+                continue
+        filaments = [filament for filament in filaments if filament[2]]
+        if filaments:
+            plate.filament_type = max(filaments)[2]
+            plate.filaments = [{"slot": slot, "type": filament_type, "colour": colour} for _, slot, filament_type, colour in sorted(filaments, key=lambda filament: filament[1])]
+
+
+def _parse_project_settings(project_settings: bytes):
+    """
+    Get the build plate and nozzle diameter from project_settings.config.
+
+    Return:
+        dict:
+            "plate_type" and "nozzle_diameter", if they are in the file
+    """
+    try:
+        settings = json.loads(project_settings)
+    except ValueError:
+        return {}
+    if not isinstance(settings, dict):
+        return {}
+
+    values = {}
+    if isinstance(settings.get("curr_bed_type"), str):
+        values["plate_type"] = settings["curr_bed_type"]
+
+    nozzle_diameter = settings.get("nozzle_diameter")
+    if isinstance(nozzle_diameter, list) and nozzle_diameter:
+        nozzle_diameter = nozzle_diameter[0]
+    try:
+        values["nozzle_diameter"] = float(nozzle_diameter)
+    except (TypeError, ValueError):
+        pass
+
+    return values
+
+
+def _parse_gcode_header(header: bytes, plate: plate_metadata):
+    for line in header.decode("utf-8", errors="ignore").splitlines():
+        line = line.strip()
+        lower_line = line.lower()
+
+        # Time in the gcode is what the slicer shows the user, so it's preferred over the prediction in slice_info
+        if "time" in lower_line:
+            times = parse_time_fields(lower_line)
+            if "total_time" in times:
+                plate.estimated_time = times["total_time"]
+            plate.model_time = times.get("model_time", plate.model_time)
+            plate.prepare_time = times.get("prepare_time", plate.prepare_time)
+
+        elif lower_line.startswith("; total layer number:"):
+            try:
+                plate.layer_count = int(line.split(":")[1])
+            except ValueError:
+                pass
+
+        elif lower_line.startswith("; total filament weight [g] :"):
+            try:
+                plate.filament_grams = sum(float(weight) for weight in line.split(":")[1].split(","))
+            except ValueError:
+                pass
+
+        elif lower_line.startswith("; header_block_end"):
+            break
+
+
+def extract_print_metadata_async(printfile_filepath: str):
+    """
+    Same as extract_print_metadata, but runs in metadata_pool.
+
+    Returns:
+        - concurrent.futures.Future
+            resolves to a print_metadata, or raises ValueError
+    """
+    # On gevent the pool's threads are greenlets, so the parsing itself is moved to a real thread
+    return metadata_pool.submit(run_blocking, extract_print_metadata, printfile_filepath)
+
+
+def extract_print_metadata_many_async(printfile_filepaths: list[str]):
+    """
+    Same as extract_print_metadata_async for many files, they are parsed at the same time in metadata_pool.
+
+    Returns:
+        - concurrent.futures.Future
+            resolves when every file is parsed, to a list with the print_metadata, or the exception parsing raised, of every file in the same order
+    """
+    batch_future = Future()
+    futures = [extract_print_metadata_async(printfile_filepath) for printfile_filepath in printfile_filepaths]
+    if not futures:
+        batch_future.set_result([])
+        return batch_future
+
+    remaining = len(futures)
+    remaining_lock = threading.Lock()
+
+    def on_parsed(_):
+        nonlocal remaining
+        with remaining_lock:
+            remaining -= 1
+            if remaining:
+                return
+        batch_future.set_result([future.exception() or future.result() for future in futures])
+
+    for future in futures:
+        future.add_done_callback(on_parsed)
+    return batch_future
+
+
+def extract_bambulab_estimated_time(printfile_filepath:str) -> int:
     """
     Function to get the total time (prep and printing) for a 3mf file to print. Bambustudio and maybe other slicer make a comment somewhere at the top of the 3mf-file's gcode file
     with an estimate for the amount of time it will take to print a file. It's known that this is a bad way to do it, since a user can simply extract the
@@ -12,76 +312,79 @@ def extract_bambulab_estimated_time(printfile_filepath:str) -> int | list[None,
 
     Returns:
         - int:
-            an estimation for the total amount of seconds it will take to print the file
-    """
+            an estimation for the total amount of seconds it will take to print the file (the first sliced plate)
 
-    try:
-        with zipfile.ZipFile(printfile_filepath, 'r') as archive:
-            files = archive.namelist()
-            gcode_files = [f for f in files if f.endswith('.gcode')]
-            
-            if not gcode_files:
-                return None, "No gcode_file found"
-            
-            gcode_file = gcode_files[0] # Please, oh please, don't let this come and bite me in the ass
-            
-            # Read at most the first 50 lines of file
-            with archive.open(gcode_file, 'r') as gcode:
-                for _ in range(50):
-                    line = gcode.readline()
-                    line = line.decode('utf-8').strip()
-
-                    if "total estimated time:" in line.lower():
-                        estimated_time = parse_estimated_time_line(line)
-                        return estimated_time
-
-        
-    except zipfile.BadZipFile:
-        return None, "The provided file is not a valid .3mf archive."
+    Exceptions:
+        - ValueError
+            if the time couldn't be read from the file
+    """
+    return extract_print_metadata(printfile_filepath).estimated_time
 
-    except Exception as e:
-        return None, f"Error: {e}"
-    
 
 
 def parse_estimated_time_line(line: str):
     """
-    Simple function to parse time from a string of "{num_hs}h {num_mins}m {num_secs}s" to an int of number of seconds
+    Simple function to parse the total estimated time on a line of a gcode header to an int of number of seconds, see time_parser.py
 
     Params:
         - str:
-            line: the line to parse
+            line: the line to parse, e.g. "; model printing time: 5h 49m 54s; total estimated time: 1d 5h 56m 6s"
 
     Return:
         - int:
-            total_seconds: the total amount of seconds to print including preparations
+            total_seconds: the total amount of seconds to print including preparations, can be 0
+
+    Exceptions:
+        - ValueError
+            if there is no total estimated time on the line
     """
+    times = parse_time_fields(line)
+    if "total_time" not in times:
+        raise ValueError("Unable to parse time")
 
-    time_string = line.split("total estimated time: ")[1]
-    
-    total_seconds = 0
-    if "h" in time_string:
-        hours = int(time_string.split("h")[0].strip())
-        total_seconds += hours * 3600
-        time_string = time_string.split("h")[1].strip()
+    return times["total_time"]
 
-    if "m" in time_string:
-        minutes = int(time_string.split("m")[0].strip())
-        total_seconds += minutes * 60
-        time_string = time_string.split("m")[1].strip()
-    
-    if "s" in time_string:
-        seconds = int(time_string.split("s")[0].strip())
-        total_seconds += seconds
 
-    if total_seconds == 0:
-        raise Exception("Unable to parse time")
 
-    return total_seconds
+if __name__ == "__main__":
+    # Benchmark with a large, made up, multi-plate 3mf file
+    import tempfile
 
+    header = ("; HEADER_BLOCK_START\n"
+              "; BambuStudio 01.08.04.51\n"
+              "; model printing time: 5h 49m 54s; total estimated time: 5h 56m 6s\n"
+              "; total layer number: 790\n"
+              "; total filament weight [g] : 94.70\n"
+              "; HEADER_BLOCK_END\n")
+    slice_info = ('<?xml version="1.0" encoding="UTF-8"?>\n<config>\n'
+                  + "".join(f'<plate><metadata key="index" value="{i}"/><metadata key="prediction" value="{21000 + i}"/>'
+                            f'<metadata key="weight" value="94.70"/><metadata key="nozzle_diameters" value="0.4"/>'
+                            f'<filament id="1" type="PLA" color="#FFFFFF" used_g="90.1"/>'
+                            f'<filament id="3" type="PETG" color="#000000" used_g="4.6"/></plate>\n' for i in (1, 2))
+                  + "</config>\n")
+    gcode_body = "G1 X100.123 Y100.456 E0.01234\n" * 3_000_000
 
+    with tempfile.TemporaryDirectory() as temp_dir:
+        three_mf_filepath = os.path.join(temp_dir, "big.gcode.3mf")
+        with zipfile.ZipFile(three_mf_filepath, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(SLICE_INFO_PATH, slice_info)
+            archive.writestr(PROJECT_SETTINGS_PATH, json.dumps({"curr_bed_type": "Cool Plate", "nozzle_diameter": ["0.4"],
+                                                                "filament_settings_id": ["Bambu PLA Basic @BBL X1C"] * 4}))
+            archive.writestr("Metadata/plate_1.gcode", header + gcode_body)
+            archive.writestr("Metadata/plate_2.gcode", header.replace("5h 56m 6s", "1h 2m 3s") + gcode_body)
 
-if __name__ == "__main__":
-    three_mf_filepath = "backend/uploads/gear_crank.gcode.3mf" 
-    
-    print(extract_bambulab_estimated_time(three_mf_filepath))
\ No newline at end of file
+        uncompressed_mb = 2 * len(gcode_body) / 1024 / 1024
+        print(f"file: {os.path.getsize(three_mf_filepath) / 1024 / 1024:.1f} MB on disk, {uncompressed_mb:.0f} MB of gcode")
+
+        runs = 50
+        start = time.perf_counter()
+        for _ in range(runs):
+            metadata = extract_print_metadata(three_mf_filepath)
+        print(f"extract_print_metadata: {(time.perf_counter() - start) / runs * 1000:.2f} ms per file")
+        print(metadata)
+        assert metadata.estimated_time == 5*3600 + 56*60 + 6
+        assert metadata.plate.model_time == 5*3600 + 49*60 + 54 and metadata.plate.prepare_time == 372
+        assert metadata.plates[1].estimated_time == 3723
+        assert metadata.plate.predicted_time == 21001 and metadata.filament_type == "PLA"
+        assert metadata.plate.plate_type == "Cool Plate" and metadata.plate.nozzle_diameter == 0.4
+        assert [filament["slot"] for filament in metadata.plate.filaments] == [1, 3]
@@ -0,0 +1,229 @@
+"""
+File: queue_journal.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-02-17
+Description: Module with the queue_journal class, which saves the queue to disk so that it survives the server restarting.
+
+The journal is an SQLite database in WAL mode, every add/remove is appended to the write-ahead log and compact() folds the log back into
+the database file. When the log is synced to disk is decided by sync_policy:
+    "always" - every add/remove is committed and synced before it returns, nothing is ever lost
+    "batch"  - adds/removes are committed together by a background thread every batch_interval seconds (or batch_size changes),
+               at most batch_interval seconds of changes are lost on a crash
+    "off"    - like "batch", but SQLite doesn't sync at all and leaves it to the OS, a power loss can lose more
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from blocking_io import run_blocking
+
+
+SYNC_POLICIES = ("always", "batch", "off")
+
+
+class queue_journal():
+    def __init__(self, db_path: str = "./queue.db", sync_policy: str = "batch", batch_interval: float = 0.05, batch_size: int = 256):
+        if sync_policy not in SYNC_POLICIES:
+            raise ValueError(f"sync_policy has to be one of {SYNC_POLICIES}, got {sync_policy}")
+
+        self.db_path = db_path
+        self.sync_policy = sync_policy
+        self.batch_interval = batch_interval
+        self.batch_size = batch_size
+
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(f"PRAGMA synchronous={'OFF' if sync_policy == 'off' else 'FULL'}")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS prints (
+                                        print_id TEXT PRIMARY KEY,
+                                        enqueued_at INTEGER NOT NULL,
+                                        print_info TEXT NOT NULL
+                                    )""")
+
+        # Connection is shared between threads, so only one can use it at a time
+        self._connection_lock = threading.Lock()
+
+        self._pending = []
+        self._pending_condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._running = True
+        self._flusher = None
+
+        if sync_policy != "always":
+            self._flusher = threading.Thread(target=self._flush_periodically, name="queue_journal", daemon=True)
+            self._flusher.start()
+
+    def record_add(self, print_id: str, print_info: dict):
+        """
+        Save that a print was added to (or put back in) the queue.
+        """
+        self._record([("add", str(print_id), print_info["enqueued_at"], json.dumps(print_info))])
+
+    def record_adds(self, print_infos: dict[str: dict]):
+        """
+        Save that many prints were added to the queue, they are committed in the same transaction so either all of them are saved or none.
+        """
+        self._record([("add", str(print_id), print_info["enqueued_at"], json.dumps(print_info)) for print_id, print_info in print_infos.items()])
+
+    def record_remove(self, print_id: str):
+        """
+        Save that a print was removed from the queue.
+        """
+        self._record([("remove", str(print_id), None, None)])
+
+    def _record(self, changes: list[tuple]):
+        if self.sync_policy == "always":
+            self._commit(changes)
+            return
+
+        # Added together, so a flush takes all of them or none of them
+        with self._pending_condition:
+            self._pending.extend(changes)
+            if len(self._pending) >= self.batch_size:
+                self._pending_condition.notify()
+
+    def _commit(self, changes: list[tuple]):
+        with self._connection_lock:
+            # Committing waits for the disk, which would stop the whole server on gevent
+            run_blocking(self._commit_locked, changes)
+
+    def _commit_locked(self, changes: list[tuple]):
+        self._connection.execute("BEGIN")
+        try:
+            for operation, print_id, enqueued_at, print_info in changes:
+                if operation == "add":
+                    self._connection.execute("INSERT OR REPLACE INTO prints (print_id, enqueued_at, print_info) VALUES (?, ?, ?)",
+                                             (print_id, enqueued_at, print_info))
+                else:
+                    self._connection.execute("DELETE FROM prints WHERE print_id = ?", (print_id,))
+
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def flush(self):
+        """
+        Commit everything that is waiting to be committed, returns when it's on disk.
+        """
+        # Held while committing too, so two flushes can't commit their changes in the wrong order
+        with self._flush_lock:
+            with self._pending_condition:
+                changes = self._pending
+                self._pending = []
+
+            if changes:
+                self._commit(changes)
+
+    def _flush_periodically(self):
+        while True:
+            with self._pending_condition:
+                if self._running and len(self._pending) < self.batch_size:
+                    self._pending_condition.wait(self.batch_interval)
+                running = self._running
+
+            try:
+                self.flush()
+            except Exception as e:
+                print("***WARNING***")
+                print(f"Failed to save queue changes to {self.db_path}")
+                print(f"Recieved exception: {e}")
+                print("***WARNING***")
+
+            if not running:
+                return
+
+    def load(self):
+        """
+        Read the whole queue from disk.
+
+        Return:
+            dict[str: dict]:
+                print_ids as keys and print_dicts as values, in the order they were added
+        """
+        self.flush()
+        with self._connection_lock:
+            rows = self._connection.execute("SELECT print_id, print_info FROM prints ORDER BY enqueued_at").fetchall()
+
+        return {print_id: json.loads(print_info) for print_id, print_info in rows}
+
+    def compact(self):
+        """
+        Move the write-ahead log into the database file and give back the space of removed prints, so neither grows forever.
+        """
+        self.flush()
+        with self._connection_lock:
+            run_blocking(self._connection.execute, "PRAGMA wal_checkpoint(TRUNCATE)")
+            run_blocking(self._connection.execute, "PRAGMA incremental_vacuum")
+
+    def close(self):
+        with self._pending_condition:
+            self._running = False
+            self._pending_condition.notify()
+
+        if self._flusher:
+            self._flusher.join()
+
+        self.flush()
+        with self._connection_lock:
+            self._connection.close()
+
+
+def reconcile_with_upload_folder(q_man):
+    """
+    Make the queue agree with the upload folder after a restart, prints whose file is gone are removed from the queue.
+    Files that no print in the queue uses are left alone, they are either idle in the upload_store or deleted by storage_manager.sweep.
+
+    Params:
+        q_man (queue_manager) - queue to reconcile, already loaded from the journal
+
+    Return:
+        list[str]:
+            print_ids removed
+    """
+    missing_prints = [print_id for print_id, print_info in q_man.prints.items() if not os.path.isfile(print_info["file_path"])]
+    for print_id in missing_prints:
+        q_man.remove_print(print_id)
+
+    return missing_prints
+
+
+# #BadTestingRules
+if __name__ == "__main__":
+    # Benchmark of how many prints per second can be added with each sync policy, and how long recovery takes
+    import tempfile
+    from uuid import uuid4
+    from queue_manager import queue_manager
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for sync_policy in SYNC_POLICIES:
+            journal = queue_journal(os.path.join(temp_dir, f"{sync_policy}.db"), sync_policy=sync_policy)
+
+            prints_to_add = 1000 if sync_policy == "always" else 20000
+            start = time.perf_counter()
+            for i in range(prints_to_add):
+                journal.record_add(str(uuid4()), {"owner": f"owner_{i % 30}", "file_path": f"./uploads/print_{i}.gcode.3mf",
+                                                  "estimated_time_to_print": 600 + i % 5000, "enqueued_at": 1700000000 + i,
+                                                  "wait_to_end_of_day": False})
+            journal.flush()
+            elapsed = time.perf_counter() - start
+            print(f"{sync_policy:>6}: {prints_to_add/elapsed:10.0f} enqueues/s durable")
+            journal.close()
+
+        recovery_path = os.path.join(temp_dir, "recovery.db")
+        journal = queue_journal(recovery_path, sync_policy="off")
+        for i in range(50000):
+            print_id = str(uuid4())
+            journal.record_add(print_id, {"owner": "owner", "file_path": f"./uploads/print_{print_id}.gcode.3mf",
+                                          "estimated_time_to_print": 600 + i, "enqueued_at": 1700000000 + i, "wait_to_end_of_day": False})
+        journal.close()
+
+        start = time.perf_counter()
+        journal = queue_journal(recovery_path)
+        q_man = queue_manager(journal=journal)
+        q_man.load_from_journal()
+        print(f"recovered {len(q_man.prints)} prints in {time.perf_counter() - start:.3f}s")
+        journal.close()
@@ -10,197 +10,702 @@ Structure for a print_dict:
 print_id = {
     "owner": owner_of_print:str,
     "file_path": file_path:str,
-    "Estimated_time_to_print": est_time:int,
-    "Time_waited": time_waited:int,
-    "wait_to_end_of_day": wait_to_end_of_day:bool 
+    "filename": filename_shown_to_users:str,
+    "digest": sha256_of_file:str | None,
+    "estimated_time_to_print": est_time:int,
+    "slicer_estimated_time": est_time_from_file:int,
+    "filament_type": filament_type:str | None,
+    "filament_grams": filament_grams:float | None,
+    "estimate_flags": reasons_the_estimate_was_replaced:list[str],
+    "requirements": what_the_printer_needs:dict | None,
+    "enqueued_at": timestamp_when_added:int,
+    "wait_to_end_of_day": wait_to_end_of_day:bool
 }
+
+time_waited and time_diff are not stored, they are derived from enqueued_at when read (see get_time_waited and get_time_diff).
+Since time_diff = estimated_time_to_print - (now - enqueued_at), the order of two prints never changes as time passes,
+which means that the prints can be kept in heaps keyed on estimated_time_to_print + enqueued_at.
+What print a free printer gets is decided by a scheduling policy looking at the tops of those heaps, see scheduling.py.
+There are separate heaps for every group of prints with the same requirements (see placement.py), the policy picks a print from every group
+the printer can print and the best of those (policy.rank) is printed. The preliminary queue doesn't take requirements into account.
+
+How much every owner has in the queue and has been given to print is kept up to date as prints are added, claimed and removed, see get_owner_stats.
+Printed seconds are counted from when the server started.
+
+estimated_time_to_print is slicer_estimated_time corrected by the duration_model, if there is one. When the model learns from a finished print
+the estimates of every print in the queue are corrected again (refresh_estimates), which is the only time the keys change.
+
+The queue is used from request threads, the dispatcher and the scheduler at the same time. Everything that changes the queue holds self._lock
+and changes self._prints in place, so adding or removing a print doesn't copy the queue. Readers outside the lock use get_prints()
+(or queue_manager.prints), a snapshot that doesn't change under them. It is only copied when it's read after the queue has changed, so many
+changes between two reads cost one copy. get_print(print_id) looks up one print without any copy. The print_dicts must not be changed.
 """
 from uuid import uuid4
 from datetime import datetime
+import os
+import threading
+import time
+
+from queue_projection import queue_projection
+from scheduling import day_window, greedy_policy, simulate
+from placement import placement_index, requirement_key, capability_key
 
 class queue_manager():
-    def __init__(self):
-        self.prints = {}
-        self.max_time_during_day = 60*45
-        self.last_added_time = int(datetime.now().timestamp())
-        self.start_of_day_hour = 8
-        self.end_of_day_hour = 16
+    def __init__(self, journal = None, duration_model = None, policy = None):
+        """
+        Params:
+            journal (queue_journal | None) - if set, every change to the queue is saved to it, see load_from_journal
+            duration_model (duration_model | None) - if set, the estimated times of prints are corrected by it
+            policy (greedy_policy | makespan_policy | None) - decides what print a free printer gets, greedy if None (see scheduling.py)
+        """
+        self._prints = {}
+        # Copy of self._prints handed out by get_prints, None when the queue has changed since it was made
+        self._snapshot = None
+        self.journal = journal
+        self.duration_model = duration_model
+        self._lock = threading.RLock()
+        self.day_window = day_window(start_of_day_hour=8, end_of_day_hour=16, max_time_during_day=60*45)
+        self._owner_stats = {}
+        self._placement = placement_index()
+
+        self._projection = queue_projection()
+        self.set_policy(policy or greedy_policy())
+
+    @property
+    def max_time_during_day(self):
+        return self.day_window.max_time_during_day
+
+    @property
+    def start_of_day_hour(self):
+        return self.day_window.start_of_day_hour
+
+    @property
+    def end_of_day_hour(self):
+        return self.day_window.end_of_day_hour
+
+    def set_policy(self, policy):
+        """
+        Change the scheduling policy, the queue is kept as it is.
+
+        Params:
+            policy (greedy_policy | makespan_policy) - see scheduling.py
+        """
+        with self._lock:
+            self.policy = policy
+            self._load_heaps()
+
+            # Policies that look at the time of day can't be simulated incrementally, the projection simulates the whole queue with them
+            self._projection.simulator = self._simulate if policy.simulates_day else None
+            self._projection.load([(print_id, self._priority_key(print_info), print_info["estimated_time_to_print"],
+                                    print_info["filename"], print_info["owner"])
+                                   for print_id, print_info in self._prints.items()])
+
+    def _load_heaps(self):
+        """
+        Build the heaps of every group of prints from self._prints.
+        """
+        prints_by_group = {}
+        for print_id, print_info in self._prints.items():
+            prints_by_group.setdefault(requirement_key(print_info["requirements"]), {})[print_id] = print_info
+
+        self._group_heaps = {}
+        for group, group_prints in prints_by_group.items():
+            self._placement.add_group(group)
+            self._group_heaps[group] = self.policy.make_heaps(self._priority_key)
+            self._group_heaps[group].load(group_prints)
+
+    def _simulate(self, printer_free_at: dict[str: int]):
+        return simulate(self.policy, self._prints, printer_free_at, self.day_window, self._priority_key)
+
+    def get_prints(self):
+        """
+        Get a snapshot of the queue that can be read and iterated over without locking. It must not be changed.
+
+        Return:
+            dict[str: dict]:
+                print_ids as keys and print_dicts as values
+        """
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = dict(self._prints)
+            return self._snapshot
+
+    @property
+    def prints(self):
+        return self.get_prints()
+
+    def get_print(self, print_id: str):
+        """
+        Get the print_dict of one print, None if it isn't in the queue.
+        """
+        with self._lock:
+            return self._prints.get(print_id)
 
     def get_uuid(self):
         return uuid4()
 
-    def add_new_print(self, owner:str, filepath:str, estim_time:int, print_id: uuid4 = uuid4()):
+    def _priority_key(self, print_info: dict):
+        """
+        The key prints are sorted on, a lower key means the print should be printed earlier. Equal to time_diff + now for any now.
+        """
+        return print_info["estimated_time_to_print"] + print_info["enqueued_at"]
+
+    def _count_in_owner_stats(self, print_info: dict, queued: int = 0, printed: int = 0):
+        """
+        Add (or with -1, subtract) a print to the queued and/or printed stats of its owner.
+        """
+        stats = self._owner_stats.setdefault(print_info["owner"], {"queued_prints": 0, "queued_seconds": 0, "printed_prints": 0, "printed_seconds": 0})
+        stats["queued_prints"] += queued
+        stats["queued_seconds"] += queued * print_info["estimated_time_to_print"]
+        stats["printed_prints"] += printed
+        stats["printed_seconds"] += printed * print_info["estimated_time_to_print"]
+
+    def get_owner_stats(self):
+        """
+        Get how much every owner has in the queue and has printed, e.g. for the dashboard.
+
+        return:
+            dict[str: dict]:
+                owners as keys and {"queued_prints", "queued_seconds", "printed_prints", "printed_seconds"} as values
+        """
+        with self._lock:
+            return {owner: dict(stats) for owner, stats in self._owner_stats.items()
+                    if stats["queued_prints"] or stats["printed_prints"]}
+
+    def _corrected_estimate(self, slicer_estimated_time: int, filament_type: str | None):
+        if self.duration_model is None:
+            return slicer_estimated_time
+        return self.duration_model.predict(slicer_estimated_time, filament_type)
+
+    def is_day(self, now: datetime | None = None):
+        """
+        Whether it is currently during the day, when long prints should wait.
+        """
+        return self.day_window.is_day(now)
+
+    def get_time_waited(self, print_id: str, now: int | None = None):
+        """
+        Get for how many seconds a print has waited in queue.
+        """
+        if now is None:
+            now = int(datetime.now().timestamp())
+        return now - self.get_print(print_id)["enqueued_at"]
+
+    def get_time_diff(self, print_id: str, now: int | None = None):
+        """
+        Get the estimated time to print minus the time waited for a print.
+        """
+        if now is None:
+            now = int(datetime.now().timestamp())
+        return self._priority_key(self.get_print(print_id)) - now
+
+    def add_new_print(self, owner:str, filepath:str, estim_time:int, print_id: uuid4 = None, filename: str | None = None, digest: str | None = None,
+                      filament_type: str | None = None, filament_grams: float | None = None, estimate_flags: list[str] | None = None,
+                      requirements: dict | None = None):
         """
         Function to add new print to prints.
-        
-        Params: 
+
+        Params:
             owner (string) - owner of print,
             file_path (string) - path to print file,
             estim_time (int) - estimate for how long the print will take in seconds
             print_id (uuid4) - Unique identifier for print in queue, can be gotten through self.get_uuid(), defaults to a random uuid as it should.
-                               The primary function of having this as a param is that it allows one to save a file with a unique name, before adding 
-                               the corresponding print to the queue 
+                               The primary function of having this as a param is that it allows one to know the id before adding
+                               the corresponding print to the queue
+            filename (string) - name of the file to show to users, defaults to the name in file_path
+            digest (string) - sha256 of the file if it's stored in an upload_store
+            filament_type (string) - type of filament the print uses, e.g. "PLA", the estimate is corrected for it
+            filament_grams (float) - grams of filament the print uses
+            estimate_flags (list[string]) - reasons estim_time isn't the one in the file, see duration_model.check_estimate
+            requirements (dict) - what a printer needs to print it, see placement.py. Any printer can print it if None
 
         Return:
             print_id (uuid4) - same as the param, but in case one didn't choose one
             successful (bool) - whether print was added
         """
-        self.update_print_times()
-        wait_to_end_of_day = estim_time > self.max_time_during_day
-        filepath_parts = filepath.split('.', 2)  # Split into at most 3 parts
-        filepath_with_uuid = f".{filepath_parts[1]}_{str(print_id)}.{filepath_parts[2]}"
+        if print_id is None:
+            print_id = self.get_uuid()
+
+        print_info = self._make_print_info(owner, filepath, estim_time, filename, digest, filament_type, filament_grams, estimate_flags,
+                                           requirements)
+        self._insert_print(str(print_id), print_info)
 
-        self.prints[str(print_id)] = {
+        successful = True if self.get_print(str(print_id)) else False
+        return print_id, successful
+
+    def add_new_prints(self, prints: list[dict]):
+        """
+        Function to add many prints at once, e.g. every file in a batch upload. Either all of them are in the queue or none of them, they are
+        saved to the journal together and the projection is only updated once, instead of once per print.
+
+        Params:
+            prints (list[dict]) - the params of add_new_print for every print, e.g. [{"owner": ..., "filepath": ..., "estim_time": ...}, ...]
+
+        Return:
+            list[str]:
+                print_ids of the prints, in the same order as prints
+        """
+        print_infos = {}
+        for new_print in prints:
+            new_print = dict(new_print)
+            print_id = new_print.pop("print_id", None)
+            if print_id is None:
+                print_id = self.get_uuid()
+
+            print_infos[str(print_id)] = self._make_print_info(new_print.pop("owner"), new_print.pop("filepath"), new_print.pop("estim_time"),
+                                                               **new_print)
+
+        self._insert_prints(print_infos)
+        return list(print_infos)
+
+    def _make_print_info(self, owner: str, filepath: str, estim_time: int, filename: str | None = None, digest: str | None = None,
+                         filament_type: str | None = None, filament_grams: float | None = None, estimate_flags: list[str] | None = None,
+                         requirements: dict | None = None):
+        corrected_time = self._corrected_estimate(estim_time, filament_type)
+        wait_to_end_of_day = corrected_time > self.max_time_during_day
+
+        return {
             "owner": owner,
-            "file_path": filepath_with_uuid,
-            "estimated_time_to_print": estim_time,
-            "time_waited": 0,
-            "wait_to_end_of_day": wait_to_end_of_day,
-            "time_diff": estim_time
+            "file_path": filepath,
+            "filename": filename or os.path.basename(filepath),
+            "digest": digest,
+            "estimated_time_to_print": corrected_time,
+            "slicer_estimated_time": estim_time,
+            "filament_type": filament_type,
+            "filament_grams": filament_grams,
+            "estimate_flags": estimate_flags or [],
+            "requirements": requirements,
+            "enqueued_at": int(datetime.now().timestamp()),
+            "wait_to_end_of_day": wait_to_end_of_day
         }
 
+    def restore_print(self, print_id: str, print_info: dict):
+        """
+        Put a print back in the queue, e.g. after it failed to be sent to a printer. It keeps its place since enqueued_at is kept.
 
+        Params:
+            print_id (str) - id of the print
+            print_info (dict) - the print_dict the print had in the queue
+        """
+        with self._lock:
+            self._insert_print(str(print_id), dict(print_info))
+            # Nothing was printed, so the owner gets back what they were charged when it was claimed
+            self._group_heaps[requirement_key(print_info["requirements"])].refund(str(print_id), print_info)
+            self._count_in_owner_stats(print_info, printed=-1)
+
+    def _insert_print(self, print_id: str, print_info: dict):
+        self._insert_prints({print_id: print_info})
+
+    def _insert_prints(self, print_infos: dict[str: dict]):
+        with self._lock:
+            for print_id, print_info in print_infos.items():
+                if print_id in self._prints:
+                    self._count_in_owner_stats(self._prints[print_id], queued=-1)
+                    self._remove_from_heaps(print_id, self._prints[print_id])
+                self._count_in_owner_stats(print_info, queued=1)
+                self._prints[print_id] = print_info
+
+                group = requirement_key(print_info["requirements"])
+                if group not in self._group_heaps:
+                    self._placement.add_group(group)
+                    self._group_heaps[group] = self.policy.make_heaps(self._priority_key)
+                self._group_heaps[group].push(print_id, print_info)
+
+            self._snapshot = None
+
+            self._projection.insert_many([(print_id, self._priority_key(print_info), print_info["estimated_time_to_print"],
+                                           print_info["filename"], print_info["owner"])
+                                          for print_id, print_info in print_infos.items()])
+
+            if self.journal:
+                self.journal.record_adds(print_infos)
+
+    def load_from_journal(self):
+        """
+        Replace the queue with the one saved in the journal, used when starting the server.
 
-        successful = True if self.prints[str(print_id)] else False
-        return print_id, successful
+        Return:
+            int:
+                number of prints loaded
+        """
+        saved_prints = self.journal.load()
+        for print_info in saved_prints.values():
+            # Saved before filename and digest were stored
+            print_info.setdefault("filename", os.path.basename(print_info["file_path"]))
+            print_info.setdefault("digest", None)
+            # Saved before estimates were corrected
+            print_info.setdefault("slicer_estimated_time", print_info["estimated_time_to_print"])
+            print_info.setdefault("filament_type", None)
+            print_info.setdefault("filament_grams", None)
+            print_info.setdefault("estimate_flags", [])
+            # Saved before requirements were read from files
+            print_info.setdefault("requirements", None)
+
+        with self._lock:
+            self._prints = saved_prints
+            self._snapshot = None
+            self._rebuild_indexes()
+
+        self.refresh_estimates()
+        return len(saved_prints)
+
+    def _rebuild_indexes(self):
+        """
+        Build the heaps, the projection and the queued stats of owners from self._prints, used when all the prints (or their keys) change at once.
+        """
+        for stats in self._owner_stats.values():
+            stats["queued_prints"] = stats["queued_seconds"] = 0
+        for print_info in self._prints.values():
+            self._count_in_owner_stats(print_info, queued=1)
+
+        self._load_heaps()
+        self._projection.load([(print_id, self._priority_key(print_info), print_info["estimated_time_to_print"],
+                                print_info["filename"], print_info["owner"])
+                               for print_id, print_info in self._prints.items()])
+
+    def refresh_estimates(self):
+        """
+        Correct the estimated time of every print in the queue again, after the duration_model has learned something.
+
+        Return:
+            int:
+                number of prints whose estimate changed
+        """
+        if self.duration_model is None:
+            return 0
+
+        with self._lock:
+            changed_prints = []
+            for print_id, print_info in self._prints.items():
+                corrected_time = self._corrected_estimate(print_info["slicer_estimated_time"], print_info["filament_type"])
+                if corrected_time != print_info["estimated_time_to_print"]:
+                    changed_prints.append((print_id, dict(print_info, estimated_time_to_print=corrected_time,
+                                                          wait_to_end_of_day=corrected_time > self.max_time_during_day)))
+
+            if not changed_prints:
+                return 0
+
+            # print_dicts are replaced, not changed, snapshots handed out before still have the old ones
+            self._prints.update(changed_prints)
+            self._snapshot = None
+            self._rebuild_indexes()
+
+            if self.journal:
+                self.journal.record_adds(dict(changed_prints))
+
+        return len(changed_prints)
 
     def remove_print(self, print_to_remove: str):
         """
         Remove print from prints by the id.
-        Params: 
+        Params:
             print_to_remove (uuid4) - uuid of the print to remove
 
-        Return: 
+        Return:
             bool:
                 whether removing was successful
-            
+
             str:
                 reason for failure (if known), empty string on success
-        """ 
-        try:
-            self.prints.pop(print_to_remove)
-        except KeyError:
-            return False, "print_not_found"
-        except Exception as e:
-            return False, str(e)
-        
-        successful = True if print_to_remove not in self.prints else False
+        """
+        with self._lock:
+            try:
+                removed_print_info = self._prints.pop(print_to_remove)
+            except KeyError:
+                return False, "print_not_found"
+            except Exception as e:
+                return False, str(e)
+
+            self._snapshot = None
+
+            self._count_in_owner_stats(removed_print_info, queued=-1)
+            self._remove_from_heaps(print_to_remove, removed_print_info)
+            self._projection.remove(print_to_remove)
+
+            if self.journal:
+                self.journal.record_remove(print_to_remove)
+
+            successful = True if print_to_remove not in self._prints else False
         return successful, ""
-        
 
-    def update_print_times(self):
+    def _remove_from_heaps(self, print_id: str, print_info: dict):
+        group = requirement_key(print_info["requirements"])
+        heaps = self._group_heaps.get(group)
+        if heaps is None:
+            return
+
+        heaps.remove(print_id)
+        # Printers only look at groups that have heaps, so empty ones are dropped
+        if not heaps:
+            del self._group_heaps[group]
+
+    def get_next_print(self, capabilities: dict | None = None):
         """
-        Update the times for all prints in the list, based on how much time has passed since the last update.
+        Function to get the next print to print based on the expected time to print and for how long it has been waiting, as decided by the policy.
 
         params:
-            None
+            capabilities (dict | None) - what the printer that is free has, see placement.py. None to pick from every print
 
         return:
-            None
+            if queue_manager.prints is empty, or the policy wants the printer to wait:
+                None
+
+            else:
+                uuid/string - uuid of print to print
         """
-        now_time = int(datetime.now().timestamp())
-        for print_id in self.prints:
-            self.prints[print_id]["time_waited"] += now_time - self.last_added_time
-            self.prints[print_id]["time_diff"] = self.prints[print_id]["estimated_time_to_print"] - self.prints[print_id]["time_waited"]
-            
+        with self._lock:
+            if capabilities is None:
+                groups = list(self._group_heaps)
+            else:
+                groups = self._placement.compatible_groups(capability_key(capabilities))
+
+            now = time.time()
+            best = None
+            for group in groups:
+                heaps = self._group_heaps.get(group)
+                if heaps is None:
+                    continue
+
+                print_id = self.policy.pick(heaps, self._prints, self.day_window, now)
+                if print_id is None:
+                    continue
 
-        self.last_added_time = now_time
+                rank = self.policy.rank(self._prints[print_id], self.day_window, now, self._priority_key)
+                if best is None or rank < best[0]:
+                    best = (rank, print_id)
 
-    def get_next_print(self):
+            return best[1] if best else None
+
+    def claim_next_print(self, capabilities: dict | None = None):
         """
-        Function to get the next print to print based on the expected time to print and for how long it has been waiting.
+        Get the next print to print and remove it from the queue in one go, so that two printers can never get the same print.
 
         params:
-            None
+            capabilities (dict | None) - what the printer that is free has, see placement.py. None to pick from every print
+
+        return:
+            tuple:
+                (print_id, print_dict) of the print, (None, None) if the queue is empty or the policy wants the printer to wait
+        """
+        with self._lock:
+            next_print = self.get_next_print(capabilities)
+            if next_print is None:
+                return None, None
+
+            print_info = self._prints[next_print]
+            # Takes it out of the heaps and charges its owner for it, which remove_print doesn't
+            self._group_heaps[requirement_key(print_info["requirements"])].claim(next_print)
+            self._count_in_owner_stats(print_info, printed=1)
+            self.remove_print(next_print)
+
+        return next_print, print_info
 
-        return: 
-            if queue_manager.prints is empty:
-                None
 
-            else:
-                uuid/string - uuid of print to print 
-        """
-        self.update_print_times()
-        if datetime.now().hour < self.end_of_day_hour and datetime.now().hour > self.start_of_day_hour: 
-            filtered_prints = [
-                (print_name, print_info)
-                for print_name, print_info in self.prints.items()
-                if not print_info.get('wait_to_end_of_day', True)
-            ]
-
-        else:
-            filtered_prints = [
-                (print_name, print_info) 
-                for print_name, print_info in self.prints.items()
-            ]
-
-        
-        if not filtered_prints:
-            filtered_prints = self.prints
-
-        try:
-            next_print = min(filtered_prints, key=lambda x: x[1]['time_diff'])
-
-        except ValueError:
-            return None
-        
-        if next_print:
-            return next_print[0]
-
-        return None
-
-    
     def get_prelim_queue(self, current_prints: dict[str:int]):
         """
-        Function to sort prints in que in order of time diff to give an estimation of queue order
-        """
-        try:
-            sorted_queue = dict(sorted(self.prints.items(), key=lambda x: x[1]['time_diff']))
-            time_waited_total = 0
-            _printers = {key:val*60 for key, val in current_prints.items()}
-            prelim_queue = []
-            # Should be revised to use a while loop to skip prints based on the estimated_time of day
-            for next_uuid, next_values in sorted_queue.items():
-                next_print_to_finish = min(_printers.items(), key=lambda x: x[1])
+        Function to get the prints in queue in the order they will be printed, with an estimation of when each of them will be finished.
+        With the greedy policy the simulation doesn't take the time of day into account, with policies that do it's done in scheduling.simulate.
 
-                time_waited_since_swap = next_print_to_finish[1]
-                time_waited_total += next_print_to_finish[1]
+        params:
+            current_prints (dict[str: int]) - printer names as keys and the time remaining on their current print in minutes as values
 
-                filename = next_values["file_path"].split("\\")[-1]
+        return:
+            list[dict[str: dict]]:
+                [{print_id: {"estimated_completion_at": timestamp rounded down to the minute, "filename": str, "owner": str}}, ...]
+        """
+        now = int(datetime.now().timestamp())
+        with self._lock:
+            self._projection.set_printer_times(current_prints, now)
+            return self._projection.get_queue()
 
-                prelim_queue.append({str(next_uuid):{"estimated_time_to_completion": (next_values["estimated_time_to_print"] + time_waited_total)//60,
-                                                     "filename": filename,
-                                                     "owner": next_values["owner"]}})
+    def get_prelim_queue_diff(self, current_prints: dict[str:int]):
+        """
+        Same as get_prelim_queue, but only returns what changed since the last time this was called, to avoid sending the whole queue.
 
-                sorted_queue[next_uuid] = float("inf")
-                _printers[next_print_to_finish[0]] = next_values["estimated_time_to_print"]
+        return:
+            dict | None:
+                None if nothing changed, otherwise {"version": int, "length": int, "changed": {position: {print_id: {...}}}}
+        """
+        now = int(datetime.now().timestamp())
+        with self._lock:
+            self._projection.set_printer_times(current_prints, now)
+            return self._projection.get_diff()
+
+    def get_published_prelim_queue(self):
+        """
+        Get the whole preliminary queue that the diffs from get_prelim_queue_diff are based on, used to sync new clients. Doesn't lock.
 
-                _printers = {key:val-time_waited_since_swap for key, val in _printers.items()}
-        except Exception as e:
-            print("Something is fucked", str(e))
-        return prelim_queue
+        return:
+            dict:
+                {"version": int, "queue": list}
+        """
+        return self._projection.get_published()
 
 
 # #BadTestingRules
 if __name__ == "__main__":
     from time import sleep
     q_man = queue_manager()
-    print_id1, succ_1 = q_man.add_new_print("1", "", 3600)
+    print_id1, succ_1 = q_man.add_new_print("1", "./uploads/1.gcode.3mf", 3600)
     sleep(3)
     print("1")
-    print_id2, succ_2 = q_man.add_new_print("2", "", 1800)
+    print_id2, succ_2 = q_man.add_new_print("2", "./uploads/2.gcode.3mf", 1800)
     sleep(2)
     print("2")
-    print_id3, succ_3 = q_man.add_new_print("3", "", 1800)
+    print_id3, succ_3 = q_man.add_new_print("3", "./uploads/3.gcode.3mf", 1800)
     sleep(1)
     print("3")
-    print_id4, succ_4 = q_man.add_new_print("4", "", 1800, 0)
+    print_id4, succ_4 = q_man.add_new_print("4", "./uploads/4.gcode.3mf", 1800, 0)
     sleep(5)
     print("4")
-    print_id5, succ_5 = q_man.add_new_print("5", "", 2701)
-    # print_id = q_man.get_next_print()
-    q_man.get_prelim_queue({"1": 5, "2": 3, "3": 1})
-    # print(q_man.prints)
-    # print(print_id)
-
-    
\ No newline at end of file
+    print_id5, succ_5 = q_man.add_new_print("5", "./uploads/5.gcode.3mf", 2701)
+    print(q_man.get_prelim_queue({"1": 5, "2": 3, "3": 1}))
+    print(q_man.get_prelim_queue_diff({"1": 5, "2": 3, "3": 1}))
+    q_man.add_new_print("6", "./uploads/6.gcode.3mf", 600)
+    # Only the positions from where the new print was inserted should be in the diff
+    print(q_man.get_prelim_queue_diff({"1": 5, "2": 3, "3": 1}))
+
+    # Removing the print at the top should make the next one come up, the stale heap entry is skipped
+    next_print = q_man.get_next_print()
+    q_man.remove_print(next_print)
+    print(next_print, q_man.get_next_print())
+
+    # Same queue with the makespan policy, the preliminary queue is simulated with the time of day and plates not being cleaned at night
+    from scheduling import makespan_policy
+    q_man.set_policy(makespan_policy())
+    print(q_man.get_prelim_queue({"1": 5, "2": 3, "3": 1}))
+    print(q_man.get_prelim_queue_diff({"1": 5, "2": 3, "3": 1}))
+
+    # Hammer the queue from many threads, no print can be claimed twice and every print has to be claimed or removed exactly once
+    from concurrent.futures import ThreadPoolExecutor
+    import random
+
+    stress_q_man = queue_manager()
+    prints_per_thread = 500
+    threads = 16
+    claimed = []
+    removed = []
+
+    def producer(thread_index):
+        for i in range(prints_per_thread):
+            print_id, _ = stress_q_man.add_new_print(str(thread_index), f"./uploads/{thread_index}_{i}.gcode.3mf", random.randint(60, 6000))
+            if random.random() < 0.2:
+                if stress_q_man.remove_print(str(print_id))[0]:
+                    removed.append(str(print_id))
+
+    def consumer(_):
+        idle_rounds = 0
+        while idle_rounds < 1000:
+            print_id, _ = stress_q_man.claim_next_print()
+            if print_id is None:
+                idle_rounds += 1
+                continue
+            idle_rounds = 0
+            claimed.append(print_id)
+
+    def reader(_):
+        for _ in range(200):
+            # Iterating while others write must never raise "dictionary changed size during iteration"
+            sum(print_info["estimated_time_to_print"] for print_info in stress_q_man.prints.values())
+            stress_q_man.get_prelim_queue({"a": 5, "b": 0})
+
+    with ThreadPoolExecutor(max_workers=threads*2 + 4) as pool:
+        futures = [pool.submit(producer, i) for i in range(threads)]
+        futures += [pool.submit(consumer, i) for i in range(threads)]
+        futures += [pool.submit(reader, i) for i in range(4)]
+        for future in futures:
+            future.result()
+
+    while True:
+        print_id, _ = stress_q_man.claim_next_print()
+        if print_id is None:
+            break
+        claimed.append(print_id)
+
+    assert len(claimed) == len(set(claimed)), "a print was claimed twice"
+    assert len(claimed) + len(removed) == threads*prints_per_thread
+    assert not set(claimed) & set(removed)
+    owner_stats = stress_q_man.get_owner_stats()
+    assert sum(stats["printed_prints"] for stats in owner_stats.values()) == len(claimed)
+    assert not any(stats["queued_prints"] or stats["queued_seconds"] for stats in owner_stats.values())
+    print(f"stress test ok, {len(claimed)} claimed and {len(removed)} removed")
+
+    # One owner adding many prints doesn't keep the others waiting with fair_share
+    from scheduling import fair_share_policy
+    fair_q_man = queue_manager(policy=fair_share_policy())
+    for i in range(1000):
+        fair_q_man.add_new_print("flooder", f"./uploads/flood_{i}.gcode.3mf", 600)
+    for owner in ("a", "b", "c"):
+        fair_q_man.add_new_print(owner, f"./uploads/{owner}.gcode.3mf", 1200)
+    first_owners = [fair_q_man.claim_next_print()[1]["owner"] for _ in range(6)]
+    print(first_owners, fair_q_man.get_owner_stats()["flooder"])
+    assert {"a", "b", "c"} <= set(first_owners)
+
+    # The virtual times are shared by the requirement groups, what an owner is given in one group counts in the others
+    pla = {"nozzle_diameter": 0.4, "filaments": [{"type": "PLA"}]}
+    petg = {"nozzle_diameter": 0.4, "filaments": [{"type": "PETG"}]}
+    groups_q_man = queue_manager(policy=fair_share_policy())
+    for owner in ("a", "b"):
+        for i in range(3):
+            groups_q_man.add_new_print(owner, f"./uploads/{owner}_pla_{i}.gcode.3mf", 3000, requirements=pla)
+    for i in range(10):
+        groups_q_man.add_new_print("a", f"./uploads/a_petg_{i}.gcode.3mf", 3000, requirements=petg)
+    petg_printer = {"nozzle_diameter": 0.4, "spools": [{"type": "PETG"}]}
+    pla_printer = {"nozzle_diameter": 0.4, "spools": [{"type": "PLA"}]}
+    for _ in range(10):
+        assert groups_q_man.claim_next_print(petg_printer)[1]["owner"] == "a"
+    pla_owners = [groups_q_man.claim_next_print(pla_printer)[1]["owner"] for _ in range(4)]
+    print(pla_owners, groups_q_man.policy.virtual_times)
+    assert pla_owners == ["b", "b", "b", "a"]
+
+    # A class set added as one batch is in the queue in the same order as if the prints had been added one by one,
+    # but is committed to the journal once instead of once per print
+    import tempfile
+    from queue_journal import queue_journal
+    batch = [{"owner": "teacher", "filepath": f"./uploads/class_{i}.gcode.3mf", "estim_time": random.randint(600, 6000)} for i in range(30)]
+    with tempfile.TemporaryDirectory() as journal_dir:
+        batch_q_man = queue_manager(journal=queue_journal(os.path.join(journal_dir, "batch.db"), sync_policy="always"))
+        single_q_man = queue_manager(journal=queue_journal(os.path.join(journal_dir, "single.db"), sync_policy="always"))
+        for q in (batch_q_man, single_q_man):
+            q.add_new_prints([{"owner": "other", "filepath": f"./uploads/other_{i}.gcode.3mf", "estim_time": 600 + i*30, "print_id": f"other_{i}"}
+                              for i in range(200)])
+
+        start = time.perf_counter()
+        batch_ids = batch_q_man.add_new_prints([dict(new_print, print_id=f"class_{i}") for i, new_print in enumerate(batch)])
+        batch_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for i, new_print in enumerate(batch):
+            single_q_man.add_new_print(print_id=f"class_{i}", **new_print)
+        single_time = time.perf_counter() - start
+
+        assert batch_ids == [f"class_{i}" for i in range(30)]
+        order = lambda q: [next(iter(entry)) for entry in q.get_prelim_queue({"a": 0})]
+        assert order(batch_q_man) == order(single_q_man)
+        assert batch_q_man.get_owner_stats()["teacher"]["queued_prints"] == 30
+        assert len(batch_q_man.journal.load()) == 230
+        batch_q_man.journal.close()
+        single_q_man.journal.close()
+    print(f"batch of 30 added in {batch_time*1000:.2f} ms, one by one in {single_time*1000:.2f} ms")
+
+    # Adding and removing one print doesn't copy the queue, so it costs the same with a long queue as with a short one
+    for queue_length in (1000, 20000):
+        long_q_man = queue_manager()
+        long_q_man.add_new_prints([{"owner": str(i % 30), "filepath": f"./uploads/long_{i}.gcode.3mf", "estim_time": random.randint(600, 6000),
+                                    "print_id": f"long_{i}"} for i in range(queue_length)])
+        start = time.perf_counter()
+        for i in range(1000):
+            print_id, _ = long_q_man.add_new_print("me", f"./uploads/me_{i}.gcode.3mf", 1200)
+            long_q_man.remove_print(str(print_id))
+        print(f"add and remove with {queue_length} prints in the queue: {(time.perf_counter() - start) / 1000 * 1e6:.1f} us")
+
+    # Entries have when prints are done, not minutes from now, so nothing is sent when only the time has passed
+    projection = queue_projection()
+    projection.insert("a", 1000, 3600, "a.gcode.3mf", "owner")
+    projection.insert("b", 2000, 1800, "b.gcode.3mf", "owner")
+    now = int(time.time())
+    projection.set_printer_times({"printer": 30}, now)
+    assert projection.get_diff()["length"] == 2
+    for minutes_passed in range(1, 10):
+        projection.set_printer_times({"printer": 30 - minutes_passed}, now + minutes_passed*60)
+        assert projection.get_diff() is None
+    print("no diffs while the estimates hold")
@@ -0,0 +1,252 @@
+"""
+File: queue_projection.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-02-10
+Description: Module with the queue_projection class, which keeps a cached estimate of when every print in the queue will be finished (the preliminary queue).
+
+The projection simulates handing out prints, in queue order, to whichever printer becomes free first. Every step of the simulation is saved
+together with the state of the printers before the step (a checkpoint), so that when a print is added or removed, or a printer reports a new
+time remaining, only the steps after the change have to be simulated again.
+
+All times are stored as absolute timestamps (seconds), and the queue has when every print will be done as a timestamp rounded down to the
+minute, clients work out how long that is from now themselves. That way an entry only changes when its estimate changes, not every minute.
+
+If simulator is set, the steps come from it instead, and the whole queue is simulated again whenever anything changes (see scheduling.simulate).
+"""
+from bisect import bisect_left, insort
+import heapq
+
+
+class queue_projection():
+    def __init__(self, printer_time_tolerance: int = 60):
+        # Sorted list of (priority_key, print_id), the order prints are handed out in
+        self._order = []
+        self._keys = {}
+        self._print_infos = {}
+
+        # One per position in self._order, {"print_id", "printer_name", "start", "end"}
+        self._steps = []
+        # Heap of (free_at, printer_name) before the step at each position was simulated, plus one for after the last step
+        self._checkpoints = []
+
+        self._printer_free_at = {}
+        self._printer_overrides = {}
+        self._dirty_from = 0
+
+        # Printers report time remaining in minutes, so their free_at moves around by up to a minute every time it's converted
+        self.printer_time_tolerance = printer_time_tolerance
+
+        # Replaced as a whole when publishing, never changed, so it can be read without locking
+        self._published = {"version": 0, "queue": []}
+
+        # function(printer_free_at) -> list of steps, for scheduling policies whose order depends on the time
+        self.simulator = None
+
+    def _mark_dirty(self, position: int):
+        self._dirty_from = min(self._dirty_from, position)
+
+    def insert(self, print_id: str, priority_key: int, estimated_time: int, filename: str, owner: str):
+        """
+        Add a print to the projection.
+
+        Params:
+            print_id (str) - id of the print in the queue
+            priority_key (int) - key the queue is sorted on, lowest is printed first
+            estimated_time (int) - estimated time to print in seconds
+            filename (str) - filename shown in the preliminary queue
+            owner (str) - owner shown in the preliminary queue
+        """
+        if print_id in self._keys:
+            self.remove(print_id)
+
+        entry = (priority_key, print_id)
+        position = bisect_left(self._order, entry)
+        insort(self._order, entry)
+
+        self._keys[print_id] = priority_key
+        self._print_infos[print_id] = {"estimated_time": estimated_time, "filename": filename, "owner": owner}
+        self._mark_dirty(position)
+
+    def insert_many(self, prints: list[tuple]):
+        """
+        Add many prints to the projection, the new ones are sorted and merged into the order in one pass instead of being inserted one by one.
+
+        Params:
+            prints (list[tuple]) - (print_id, priority_key, estimated_time, filename, owner) for every print
+        """
+        if len(prints) == 1:
+            self.insert(*prints[0])
+            return
+        if not prints:
+            return
+
+        for print_id, _, _, _, _ in prints:
+            if print_id in self._keys:
+                self.remove(print_id)
+
+        entries = sorted((priority_key, print_id) for print_id, priority_key, _, _, _ in prints)
+        position = bisect_left(self._order, entries[0])
+        self._order = list(heapq.merge(self._order, entries))
+
+        for print_id, priority_key, estimated_time, filename, owner in prints:
+            self._keys[print_id] = priority_key
+            self._print_infos[print_id] = {"estimated_time": estimated_time, "filename": filename, "owner": owner}
+        self._mark_dirty(position)
+
+    def load(self, prints: list[tuple]):
+        """
+        Replace all prints in the projection at once, faster than inserting them one by one.
+
+        Params:
+            prints (list[tuple]) - (print_id, priority_key, estimated_time, filename, owner) for every print
+        """
+        self._order = sorted((priority_key, print_id) for print_id, priority_key, _, _, _ in prints)
+        self._keys = {print_id: priority_key for print_id, priority_key, _, _, _ in prints}
+        self._print_infos = {print_id: {"estimated_time": estimated_time, "filename": filename, "owner": owner}
+                             for print_id, _, estimated_time, filename, owner in prints}
+        self._mark_dirty(0)
+
+    def remove(self, print_id: str):
+        """
+        Remove a print from the projection.
+
+        Return:
+            bool:
+                whether the print was in the projection
+        """
+        if print_id not in self._keys:
+            return False
+
+        position = bisect_left(self._order, (self._keys.pop(print_id), print_id))
+        del self._order[position]
+        del self._print_infos[print_id]
+        self._mark_dirty(position)
+        return True
+
+    def clear(self):
+        self._order = []
+        self._keys = {}
+        self._print_infos = {}
+        self._mark_dirty(0)
+
+    def set_printer_times(self, current_prints: dict[str:int], now: int):
+        """
+        Update how long every printer has left of its current print.
+
+        Params:
+            current_prints (dict[str: int]) - printer names as keys and time remaining in minutes as values
+            now (int) - current timestamp
+        """
+        new_free_at = {name: now + minutes*60 for name, minutes in current_prints.items()}
+
+        if set(new_free_at) != set(self._printer_free_at):
+            self._printer_free_at = new_free_at
+            self._printer_overrides = {}
+            self._mark_dirty(0)
+            return
+
+        for printer_name, free_at in new_free_at.items():
+            old_free_at = self._printer_free_at[printer_name]
+            if abs(free_at - old_free_at) < self.printer_time_tolerance:
+                continue
+
+            # Steps that started before the printer was free (both before and after the change) never picked that printer, so they still hold
+            starts = [step["start"] for step in self._steps]
+            self._mark_dirty(bisect_left(starts, min(free_at, old_free_at)))
+
+            self._printer_free_at[printer_name] = free_at
+            self._printer_overrides[printer_name] = free_at
+
+    def _recompute(self):
+        if self.simulator is not None:
+            self._steps = self.simulator(dict(self._printer_free_at))
+            self._checkpoints = []
+            self._printer_overrides = {}
+            self._dirty_from = len(self._order)
+            return
+
+        start_position = min(self._dirty_from, len(self._steps), len(self._order))
+
+        if start_position == 0 or start_position >= len(self._checkpoints):
+            printers = [(free_at, name) for name, free_at in self._printer_free_at.items()]
+            start_position = 0
+        else:
+            printers = list(self._checkpoints[start_position])
+            # Printers changed after the checkpoint was taken still haven't been picked at the checkpoint, so just swap out their times
+            printers = [(self._printer_overrides.get(name, free_at), name) for free_at, name in printers]
+
+        heapq.heapify(printers)
+
+        del self._steps[start_position:]
+        del self._checkpoints[start_position:]
+
+        if printers:
+            for priority_key, print_id in self._order[start_position:]:
+                self._checkpoints.append(tuple(printers))
+
+                start, printer_name = heapq.heappop(printers)
+                end = start + self._print_infos[print_id]["estimated_time"]
+                heapq.heappush(printers, (end, printer_name))
+
+                self._steps.append({"print_id": print_id, "printer_name": printer_name, "start": start, "end": end})
+
+            self._checkpoints.append(tuple(printers))
+
+        self._printer_overrides = {}
+        self._dirty_from = len(self._order)
+
+    def get_queue(self):
+        """
+        Get the preliminary queue.
+
+        Return:
+            list[dict[str: dict]]:
+                [{print_id: {"estimated_completion_at": timestamp, "filename": str, "owner": str}}, ...]
+                where estimated_completion_at is in seconds, rounded down to the minute
+        """
+        if self._dirty_from < len(self._order) or len(self._steps) != len(self._order):
+            self._recompute()
+
+        prelim_queue = []
+        for step in self._steps:
+            print_info = self._print_infos[step["print_id"]]
+            prelim_queue.append({step["print_id"]: {"estimated_completion_at": int(step["end"])//60*60,
+                                                    "filename": print_info["filename"],
+                                                    "owner": print_info["owner"]}})
+
+        return prelim_queue
+
+    def get_diff(self):
+        """
+        Get what has changed in the preliminary queue since it was last published, and mark the current queue as published.
+
+        Return:
+            dict | None:
+                None if nothing changed, otherwise
+                {"version": int, "length": int, "changed": {position: {print_id: {...}}}}
+                where a client holding the previous version truncates its queue to length and replaces the changed positions
+        """
+        prelim_queue = self.get_queue()
+        previous = self._published
+
+        changed = {}
+        for position, entry in enumerate(prelim_queue):
+            if position >= len(previous["queue"]) or previous["queue"][position] != entry:
+                changed[position] = entry
+
+        if previous["version"] > 0 and not changed and len(prelim_queue) == len(previous["queue"]):
+            return None
+
+        self._published = {"version": previous["version"] + 1, "queue": prelim_queue}
+        return {"version": previous["version"] + 1, "length": len(prelim_queue), "changed": changed}
+
+    def get_published(self):
+        """
+        Get the last published preliminary queue, which is what clients receiving diffs are in sync with.
+        The returned dict must not be changed.
+
+        Return:
+            dict:
+                {"version": int, "queue": list}
+        """
+        return self._published
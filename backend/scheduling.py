@@ -0,0 +1,615 @@
+"""
+File: scheduling.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-03-10
+Description: The scheduling policies queue_manager can use to decide which print a free printer gets, and a simulation of a whole queue with them.
+
+A policy never sorts the queue when a printer becomes free. Every print is pushed into a few heaps when it's added (print_heaps), with keys that
+don't change as time passes, and the policy looks at the tops of the heaps. The policies:
+
+    greedy   - the print with the lowest time_diff (estimated time minus time waited). Prints longer than max_time_during_day only get printed
+               during the day if there is nothing else to print.
+    makespan - tries to finish the whole queue sooner and make prints wait less, using that nobody cleans the plates after end_of_day_hour, so
+               every printer gets exactly one print from then until the next morning:
+                 - during the day it prints like greedy, but a long print is only started if it's done before the end of the day,
+                   otherwise the printer waits for its last print of the day
+                 - the last print of the day (when a short print wouldn't be done before end_of_day_hour) is the longest print,
+                   with time waited added so that long prints can't keep a shorter one waiting forever
+    fair_share - every owner gets their share of the printers, however many prints they have in the queue. Every owner has a virtual time,
+                 the seconds of printing they have been given divided by their weight, and the owner with the lowest virtual time gets the
+                 next printer (weighted fair queueing). Within an owner's prints it's like greedy. An owner that had nothing in the queue
+                 starts at the virtual time of the last owner that got a printer, so waiting doesn't save up printing time.
+                 Prints are kept in a heap per owner, and owners in heaps keyed on their virtual time (owner_heaps), so picking a print
+                 is O(log owners + log prints of the owner).
+
+simulate runs a policy over a whole queue, taking the time of day and the plates not being cleaned at night into account. queue_manager uses it for
+the preliminary queue with the makespan and fair_share policies. With greedy the order prints are handed out in doesn't depend on the time, so queue_projection
+keeps simulating it incrementally like before, without looking at the time of day.
+"""
+from datetime import datetime, timedelta
+import copy
+import heapq
+
+
+class day_window():
+    """
+    When the day is, i.e. when people are around to clean plates and long prints should wait.
+    """
+    def __init__(self, start_of_day_hour: int = 8, end_of_day_hour: int = 16, max_time_during_day: int = 60*45):
+        self.start_of_day_hour = start_of_day_hour
+        self.end_of_day_hour = end_of_day_hour
+        self.max_time_during_day = max_time_during_day
+
+    def is_day(self, now: datetime | None = None):
+        """
+        Whether it is currently during the day, when long prints should wait.
+        """
+        if now is None:
+            now = datetime.now()
+        return now.hour < self.end_of_day_hour and now.hour > self.start_of_day_hour
+
+    def is_staffed(self, timestamp: float):
+        """
+        Whether someone is around to clean a plate at timestamp.
+        """
+        hour = datetime.fromtimestamp(timestamp).hour
+        return self.start_of_day_hour <= hour < self.end_of_day_hour
+
+    def end_of_day(self, timestamp: float):
+        """
+        Timestamp of end_of_day_hour on the same date as timestamp.
+        """
+        day = datetime.fromtimestamp(timestamp)
+        return day.replace(hour=self.end_of_day_hour, minute=0, second=0, microsecond=0).timestamp()
+
+    def next_staffed_time(self, timestamp: float):
+        """
+        The first time at or after timestamp when someone is around to clean a plate.
+        """
+        moment = datetime.fromtimestamp(timestamp)
+        if moment.hour < self.start_of_day_hour:
+            return moment.replace(hour=self.start_of_day_hour, minute=0, second=0, microsecond=0).timestamp()
+        if moment.hour >= self.end_of_day_hour:
+            next_morning = moment + timedelta(days=1)
+            return next_morning.replace(hour=self.start_of_day_hour, minute=0, second=0, microsecond=0).timestamp()
+        return timestamp
+
+    def is_last_slot(self, timestamp: float):
+        """
+        Whether a print started at timestamp is the last one of the day, i.e. even a short print wouldn't be done before the end of the day.
+        """
+        return not self.is_staffed(timestamp) or timestamp + self.max_time_during_day >= self.end_of_day(timestamp)
+
+    def last_slot_start(self, timestamp: float):
+        return self.end_of_day(timestamp) - self.max_time_during_day
+
+
+class print_heaps():
+    """
+    Named heaps of (key, seq, print_id), each with its own key function. A key function returns None for prints that shouldn't be in its heap.
+    Removing a print only forgets its seq, its entries are skipped when they reach the top (lazy deletion).
+    """
+    def __init__(self, key_functions: dict):
+        """
+        Params:
+            key_functions (dict[str: function]) - heap names as keys, functions taking a print_dict and returning a key (or None) as values
+        """
+        self.key_functions = key_functions
+        self.heaps = {name: [] for name in key_functions}
+        self._seqs = {}
+        self._entry_counts = {}
+        self._live_entries = 0
+        self._next_seq = 0
+        self._stale_entries = 0
+
+    def push(self, print_id: str, print_info: dict):
+        self.remove(print_id)
+
+        seq = self._next_seq
+        self._next_seq += 1
+        self._seqs[print_id] = seq
+
+        entries = 0
+        for name, key_function in self.key_functions.items():
+            key = key_function(print_info)
+            if key is not None:
+                heapq.heappush(self.heaps[name], (key, seq, print_id))
+                entries += 1
+        self._entry_counts[print_id] = entries
+        self._live_entries += entries
+
+    def remove(self, print_id: str):
+        if self._seqs.pop(print_id, None) is None:
+            return
+
+        entries = self._entry_counts.pop(print_id)
+        self._live_entries -= entries
+        self._stale_entries += entries
+        # More than half of all entries are stale, rebuild so memory doesn't grow with removed prints
+        if self._stale_entries > self._live_entries:
+            self._compact()
+
+    def _compact(self):
+        for name, heap in self.heaps.items():
+            heap = [entry for entry in heap if self._seqs.get(entry[2]) == entry[1]]
+            heapq.heapify(heap)
+            self.heaps[name] = heap
+        self._stale_entries = 0
+
+    def peek(self, name: str):
+        """
+        Get the top entry of a heap that still belongs to a print, popping stale entries on the way.
+
+        Return:
+            tuple | None:
+                (key, seq, print_id) of the print with the lowest key, None if the heap is empty
+        """
+        heap = self.heaps[name]
+        while heap:
+            _, seq, print_id = heap[0]
+            if self._seqs.get(print_id) == seq:
+                return heap[0]
+
+            heapq.heappop(heap)
+            self._stale_entries -= 1
+
+        return None
+
+    def load(self, prints: dict):
+        """
+        Replace everything in the heaps with prints, faster than pushing them one by one.
+        """
+        self.heaps = {name: [] for name in self.key_functions}
+        self._seqs = {}
+        self._entry_counts = {}
+        self._live_entries = 0
+        self._stale_entries = 0
+
+        for print_id, print_info in prints.items():
+            seq = self._next_seq
+            self._next_seq += 1
+            self._seqs[print_id] = seq
+
+            entries = 0
+            for name, key_function in self.key_functions.items():
+                key = key_function(print_info)
+                if key is not None:
+                    self.heaps[name].append((key, seq, print_id))
+                    entries += 1
+            self._entry_counts[print_id] = entries
+            self._live_entries += entries
+
+        for heap in self.heaps.values():
+            heapq.heapify(heap)
+
+    def claim(self, print_id: str):
+        """
+        Remove a print that is being sent to a printer.
+        """
+        self.remove(print_id)
+
+    def refund(self, print_id: str, print_info: dict):
+        """
+        Called when a claimed print couldn't be printed and is put back in the queue.
+        """
+
+    def __len__(self):
+        return len(self._seqs)
+
+
+class owner_heaps():
+    """
+    A print_heaps per owner with the prints of that owner, and heaps of (virtual_time, seq, owner) of the owners that have prints.
+    Has the same methods as print_heaps, which the policy picks prints with. Owner entries are replaced when an owner's virtual time changes,
+    and skipped when they reach the top if they are old or the owner has no prints of that kind left (lazy deletion).
+    The virtual times are shared by the heaps of every requirement group, a claim in another group leaves an owner's entry here with an old
+    virtual time, so the entry is pushed back with the current one when it reaches the top.
+    """
+    KINDS = ("day", "night", "any")
+
+    def __init__(self, policy, priority_key):
+        """
+        Params:
+            policy (fair_share_policy) - holds the virtual times, and is charged when prints are claimed
+            priority_key (function) - see greedy_policy.heap_keys
+        """
+        self.policy = policy
+        self.key_functions = greedy_policy().heap_keys(priority_key)
+        self.key_functions["any"] = priority_key
+
+        self.owner_prints = {}
+        self.owners = {kind: [] for kind in self.KINDS}
+        self._owner_seqs = {}
+        self._next_seq = 0
+        # print_id: (owner, estimated_time_to_print)
+        self._print_owners = {}
+        self._seen_refunds = policy.refunds
+
+    def _push_owner(self, owner: str, kinds: tuple = KINDS):
+        virtual_time = self.policy.virtual_times[owner]
+        for kind in kinds:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._owner_seqs[(owner, kind)] = seq
+
+            heap = self.owners[kind]
+            heapq.heappush(heap, (virtual_time, seq, owner))
+            if len(heap) > 2 * len(self.owner_prints) + 16:
+                self.owners[kind] = [entry for entry in heap if self._owner_seqs.get((entry[2], kind)) == entry[1]]
+                heapq.heapify(self.owners[kind])
+
+    def push(self, print_id: str, print_info: dict):
+        self.remove(print_id)
+
+        owner = print_info["owner"]
+        prints = self.owner_prints.get(owner)
+        if prints is None:
+            prints = self.owner_prints[owner] = print_heaps(self.key_functions)
+            self.policy.activate(owner)
+
+        # Owner only needs new entries in the heaps it wasn't in
+        new_kinds = tuple(kind for kind in self.KINDS if prints.peek(kind) is None)
+        prints.push(print_id, print_info)
+        self._print_owners[print_id] = (owner, print_info["estimated_time_to_print"])
+        self._push_owner(owner, new_kinds)
+
+    def remove(self, print_id: str):
+        if print_id not in self._print_owners:
+            return
+
+        owner, _ = self._print_owners.pop(print_id)
+        prints = self.owner_prints[owner]
+        prints.remove(print_id)
+        if not prints:
+            del self.owner_prints[owner]
+
+    def claim(self, print_id: str):
+        if print_id not in self._print_owners:
+            return
+
+        owner, estimated_time = self._print_owners[print_id]
+        self.remove(print_id)
+        self.policy.charge(owner, estimated_time)
+        if owner in self.owner_prints:
+            self._push_owner(owner)
+
+    def refund(self, print_id: str, print_info: dict):
+        owner = print_info["owner"]
+        self.policy.charge(owner, -print_info["estimated_time_to_print"])
+        if owner in self.owner_prints:
+            self._push_owner(owner)
+
+    def peek_owner(self, kind: str):
+        """
+        Get the owner with the lowest virtual time that has a print of a kind ("day", "night" or "any").
+
+        Return:
+            str | None:
+                the owner, None if nobody has a print of that kind
+        """
+        # A refund lowers a virtual time, entries with a virtual time that is too high would never reach the top to be corrected.
+        # Refunds only happen when a print couldn't be sent to a printer, so every owner is pushed again
+        if self._seen_refunds != self.policy.refunds:
+            self._seen_refunds = self.policy.refunds
+            for owner in self.owner_prints:
+                self._push_owner(owner)
+
+        heap = self.owners[kind]
+        while heap:
+            virtual_time, seq, owner = heap[0]
+            prints = self.owner_prints.get(owner)
+            if self._owner_seqs.get((owner, kind)) == seq and prints is not None and prints.peek(kind) is not None:
+                if virtual_time == self.policy.virtual_times[owner]:
+                    return owner
+
+                # Charged in another group since the entry was pushed
+                self._push_owner(owner, (kind,))
+                continue
+
+            heapq.heappop(heap)
+            if self._owner_seqs.get((owner, kind)) == seq:
+                del self._owner_seqs[(owner, kind)]
+
+        return None
+
+    def peek_print(self, owner: str, kind: str):
+        entry = self.owner_prints[owner].peek(kind)
+        return entry[2] if entry else None
+
+    def load(self, prints: dict):
+        self.owner_prints = {}
+        self.owners = {kind: [] for kind in self.KINDS}
+        self._owner_seqs = {}
+        self._print_owners = {}
+
+        prints_by_owner = {}
+        for print_id, print_info in prints.items():
+            prints_by_owner.setdefault(print_info["owner"], {})[print_id] = print_info
+            self._print_owners[print_id] = (print_info["owner"], print_info["estimated_time_to_print"])
+
+        for owner, owner_prints in prints_by_owner.items():
+            self.owner_prints[owner] = print_heaps(self.key_functions)
+            self.owner_prints[owner].load(owner_prints)
+            self.policy.activate(owner)
+            self._push_owner(owner)
+
+    def __len__(self):
+        return len(self._print_owners)
+
+
+class greedy_policy():
+    name = "greedy"
+    # The preliminary queue is simulated incrementally by queue_projection, in priority order
+    simulates_day = False
+
+    def make_heaps(self, priority_key):
+        """
+        Make the heaps the policy picks prints from, queue_manager keeps them up to date with the queue.
+
+        Params:
+            priority_key (function) - print_dict -> key the queue is sorted on, see queue_manager._priority_key
+        """
+        return print_heaps(self.heap_keys(priority_key))
+
+    def heap_keys(self, priority_key):
+        """
+        Params:
+            priority_key (function) - print_dict -> key the queue is sorted on, see queue_manager._priority_key
+
+        Return:
+            dict[str: function]:
+                key functions for print_heaps
+        """
+        return {"day": lambda print_info: None if print_info["wait_to_end_of_day"] else priority_key(print_info),
+                "night": lambda print_info: priority_key(print_info) if print_info["wait_to_end_of_day"] else None}
+
+    def pick(self, heaps: print_heaps, prints: dict, window: day_window, now: float):
+        """
+        Get the print a printer that is free at now should print.
+
+        Return:
+            str | None:
+                print_id, None if the printer should wait
+        """
+        day_entry = heaps.peek("day")
+        night_entry = heaps.peek("night")
+
+        if window.is_day(datetime.fromtimestamp(now)):
+            # Long prints are only printed during the day if there is nothing else to print
+            next_entry = day_entry or night_entry
+
+        else:
+            candidates = [entry for entry in (day_entry, night_entry) if entry]
+            next_entry = min(candidates) if candidates else None
+
+        return next_entry[2] if next_entry else None
+
+    def rank(self, print_info: dict, window: day_window, now: float, priority_key):
+        """
+        Sort key for comparing prints picked from different heaps (e.g. groups of prints with different requirements), lowest is printed first.
+        Orders prints the same way pick does.
+        """
+        return (print_info["wait_to_end_of_day"] and window.is_day(datetime.fromtimestamp(now)), priority_key(print_info))
+
+
+class makespan_policy(greedy_policy):
+    name = "makespan"
+    simulates_day = True
+
+    def heap_keys(self, priority_key):
+        keys = super().heap_keys(priority_key)
+        # Longest print plus time waited first, for the last print of the day
+        keys["longest"] = lambda print_info: print_info["enqueued_at"] - print_info["estimated_time_to_print"]
+        # Shortest long print first, to know if any long print is done before the end of the day
+        keys["shortest_night"] = lambda print_info: print_info["estimated_time_to_print"] if print_info["wait_to_end_of_day"] else None
+        return keys
+
+    def pick(self, heaps: print_heaps, prints: dict, window: day_window, now: float):
+        if window.is_last_slot(now):
+            entry = heaps.peek("longest")
+            return entry[2] if entry else None
+
+        entry = heaps.peek("day")
+        if entry:
+            return entry[2]
+
+        # Only long prints left, the printer waits for the last print of the day unless one of them is done before it
+        entry = heaps.peek("shortest_night")
+        if entry and now + entry[0] <= window.end_of_day(now):
+            return entry[2]
+
+        return None
+
+    def rank(self, print_info: dict, window: day_window, now: float, priority_key):
+        if window.is_last_slot(now):
+            return (0, print_info["enqueued_at"] - print_info["estimated_time_to_print"])
+        if not print_info["wait_to_end_of_day"]:
+            return (0, priority_key(print_info))
+        return (1, print_info["estimated_time_to_print"])
+
+
+class fair_share_policy():
+    name = "fair_share"
+    simulates_day = True
+
+    def __init__(self, weights: dict[str: float] | None = None):
+        """
+        Params:
+            weights (dict[str: float] | None) - owners as keys and their share as values, owners that aren't in it have a weight of 1
+        """
+        self.weights = dict(weights or {})
+        self.virtual_times = {}
+        self.global_virtual_time = 0.0
+        # Counts the charges that lowered a virtual time, see owner_heaps.peek_owner
+        self.refunds = 0
+
+    def make_heaps(self, priority_key):
+        return owner_heaps(self, priority_key)
+
+    def activate(self, owner: str):
+        """
+        Called when an owner that had nothing in the queue adds a print.
+        """
+        self.virtual_times[owner] = max(self.virtual_times.get(owner, 0.0), self.global_virtual_time)
+
+    def charge(self, owner: str, seconds: float):
+        """
+        Add seconds of printing to what an owner has been given.
+        """
+        virtual_time = self.virtual_times.get(owner, self.global_virtual_time)
+        if seconds > 0:
+            self.global_virtual_time = max(self.global_virtual_time, virtual_time)
+        elif seconds < 0:
+            self.refunds += 1
+        self.virtual_times[owner] = virtual_time + seconds / self.weights.get(owner, 1)
+
+    def pick(self, heaps: owner_heaps, prints: dict, window: day_window, now: float):
+        if window.is_day(datetime.fromtimestamp(now)):
+            # Long prints are only printed during the day if nobody has anything else to print
+            for kind in ("day", "night"):
+                owner = heaps.peek_owner(kind)
+                if owner is not None:
+                    return heaps.peek_print(owner, kind)
+            return None
+
+        owner = heaps.peek_owner("any")
+        return heaps.peek_print(owner, "any") if owner is not None else None
+
+    def rank(self, print_info: dict, window: day_window, now: float, priority_key):
+        return (print_info["wait_to_end_of_day"] and window.is_day(datetime.fromtimestamp(now)),
+                self.virtual_times.get(print_info["owner"], self.global_virtual_time), priority_key(print_info))
+
+
+POLICIES = {policy.name: policy for policy in (greedy_policy, makespan_policy, fair_share_policy)}
+
+
+def get_policy(name: str):
+    """
+    Get a policy by its name, "greedy", "makespan" or "fair_share".
+    """
+    if name not in POLICIES:
+        raise ValueError(f"Scheduling policy has to be one of {tuple(POLICIES)}, got {name}")
+    return POLICIES[name]()
+
+
+def simulate(policy, prints: dict, printer_free_at: dict[str: float], window: day_window, priority_key):
+    """
+    Simulate handing out every print in the queue to the printers with a policy. A printer that becomes free when nobody is around
+    waits until the next morning for its plate to be cleaned.
+
+    Params:
+        policy (greedy_policy | makespan_policy) - the policy to simulate
+        prints (dict[str: dict]) - the queue, print_ids as keys and print_dicts as values
+        printer_free_at (dict[str: float]) - printer names as keys and timestamps when they are done with their current print as values
+        window (day_window) - when the day is
+        priority_key (function) - see greedy_policy.heap_keys
+
+    Return:
+        list[dict]:
+            {"print_id", "printer_name", "start", "end"} for every print, in the order they are started. Empty if there are no printers
+    """
+    # Picking changes the state of some policies (e.g. virtual times), the simulation works on a copy
+    policy = copy.deepcopy(policy)
+    heaps = policy.make_heaps(priority_key)
+    heaps.load(prints)
+
+    printers = [(window.next_staffed_time(free_at), printer_name) for printer_name, free_at in printer_free_at.items()]
+    heapq.heapify(printers)
+
+    steps = []
+    while heaps and printers:
+        start, printer_name = heapq.heappop(printers)
+
+        print_id = policy.pick(heaps, prints, window, start)
+        if print_id is None:
+            heapq.heappush(printers, (window.last_slot_start(start), printer_name))
+            continue
+
+        heaps.claim(print_id)
+        end = start + prints[print_id]["estimated_time_to_print"]
+        steps.append({"print_id": print_id, "printer_name": printer_name, "start": start, "end": end})
+        heapq.heappush(printers, (window.next_staffed_time(end), printer_name))
+
+    return steps
+
+
+# #BadTestingRules
+if __name__ == "__main__":
+    # Benchmark of the policies on synthetic queues, everything is enqueued on a Monday morning and printed on 20 printers
+    import random
+    import time
+
+    def synthetic_queue(jobs: int, start: float, window: day_window, seed: int):
+        generator = random.Random(seed)
+        owners = random.Random(seed + 1)
+        prints = {}
+        for i in range(jobs):
+            # Mostly short prints, some long ones, like a school's queue
+            if generator.random() < 0.7:
+                estimated_time = generator.randint(10*60, 45*60)
+            else:
+                estimated_time = int(min(generator.lognormvariate(9.0, 0.6), 20*3600))
+            prints[f"print_{i}"] = {"owner": f"owner_{owners.randint(0, 99)}",
+                                    "estimated_time_to_print": estimated_time,
+                                    "enqueued_at": int(start) - generator.randint(0, 3*24*3600),
+                                    "wait_to_end_of_day": estimated_time > window.max_time_during_day}
+        return prints
+
+    def priority_key(print_info):
+        return print_info["estimated_time_to_print"] + print_info["enqueued_at"]
+
+    window = day_window()
+    monday_morning = datetime(2025, 3, 10, 8, 0).timestamp()
+    printers = {f"printer_{i}": monday_morning for i in range(20)}
+
+    for jobs in (1000, 5000, 10000):
+        prints = synthetic_queue(jobs, monday_morning, window, seed=jobs)
+        results = {}
+        for name in POLICIES:
+            policy = get_policy(name)
+            started = time.perf_counter()
+            steps = simulate(policy, prints, printers, window, priority_key)
+            elapsed = time.perf_counter() - started
+            assert len(steps) == jobs
+
+            makespan = max(step["end"] for step in steps) - monday_morning
+            mean_wait = sum(step["start"] - prints[step["print_id"]]["enqueued_at"] for step in steps) / jobs
+            results[name] = makespan
+            print(f"{jobs:6} jobs, {name:>10}: makespan {makespan / 86400:6.2f} days, mean wait {mean_wait / 86400:6.2f} days, "
+                  f"simulated in {elapsed * 1000:6.1f} ms")
+
+        assert results["makespan"] <= results["greedy"]
+
+    # Picking one print is only looking at the tops of the heaps, whatever the length of the queue
+    prints = synthetic_queue(10000, monday_morning, window, seed=1)
+    for name in POLICIES:
+        policy = get_policy(name)
+        heaps = policy.make_heaps(priority_key)
+        heaps.load(prints)
+        started = time.perf_counter()
+        picked = 0
+        while heaps:
+            print_id = policy.pick(heaps, prints, window, monday_morning + 7*3600 + picked)
+            heaps.claim(print_id)
+            picked += 1
+        print(f"{name:>10}: {(time.perf_counter() - started) / picked * 1e6:.1f} us per pick")
+
+    # One owner floods the queue with 5000 short prints just before 50 others add 20 prints each
+    prints = {}
+    for i in range(5000):
+        prints[f"flood_{i}"] = {"owner": "flooder", "estimated_time_to_print": 600, "enqueued_at": int(monday_morning) - 3600,
+                                "wait_to_end_of_day": False}
+    generator = random.Random(2)
+    for owner in range(50):
+        for i in range(20):
+            prints[f"owner_{owner}_{i}"] = {"owner": f"owner_{owner}", "estimated_time_to_print": generator.randint(10*60, 40*60),
+                                            "enqueued_at": int(monday_morning) - 3000, "wait_to_end_of_day": False}
+
+    for name in ("greedy", "fair_share"):
+        steps = simulate(get_policy(name), prints, printers, window, priority_key)
+        waits = {"flooder": [], "others": []}
+        for step in steps:
+            print_info = prints[step["print_id"]]
+            waits["flooder" if print_info["owner"] == "flooder" else "others"].append(step["start"] - print_info["enqueued_at"])
+        print(f"{name:>10}, flooded queue: mean wait {sum(waits['others']) / len(waits['others']) / 3600:6.1f} h for the 50 others, "
+              f"{sum(waits['flooder']) / len(waits['flooder']) / 3600:6.1f} h for the flooder")
@@ -0,0 +1,402 @@
+"""
+File: sdcard_cache.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-03-19
+Description: Module with the sdcard_cache class, which remembers what is on the SD cards of the printers so they don't have to be listed over
+             FTPS every time someone asks.
+
+Listing a printer's SD card takes one FTPS round trip per folder, which is seconds for a whole card. The cache keeps the tree of every
+printer for ttl seconds, refreshes many printers at the same time, and when a tree is refreshed only lists the folders that can have changed:
+a folder's modification time changes when files are added to or removed from it, so a folder without subfolders whose time is the same as
+last time still has the same files. Folders with subfolders are always listed, the time of a folder doesn't change when something in one of
+its subfolders does. Printers whose FTP server doesn't support MLSD are listed with LIST, where the time is only to the minute, the ttl limits
+how long a change within the same minute can be missed.
+
+The trees are in the same format as bpm's BambuPrinter.get_sdcard_contents, with the size and modification time of everything added:
+    {"id": "/", "name": "/", "modify": None, "children": [
+        {"id": "/cache/", "name": "cache", "modify": "20250319101500", "children": [
+            {"id": "/cache/print.gcode.3mf", "name": "print.gcode.3mf", "size": 123456, "modify": "20250319101500"}, ...]},
+        ...]}
+Folders always have "children", files never do. Trees are replaced, never changed, so they can be read without locking and must not be changed.
+Every tree is also indexed by file name and by the digest in the names of files uploaded by the server (see upload_store.printer_file_path_for),
+so find() doesn't have to walk any tree.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import ftplib
+import re
+import threading
+import time
+
+
+# printer_file_path_for names files "{first 12 characters of the digest}_{filename}"
+_DIGEST_PREFIX_PATTERN = re.compile(r"^([0-9a-f]{12})_")
+# -rw-r--r--    1 root     root       123456 Mar 19 10:15 print.gcode.3mf
+_LIST_LINE_PATTERN = re.compile(r"^([\-dl])\S*\s+\d+\s+\S+\s+\S+\s+(\d+)\s+(\w{3}\s+\d+\s+[\d:]+)\s+(.+)$")
+
+
+class ftps_lister():
+    """
+    Lists folders on a printer's SD card over FTPS, with MLSD if the printer supports it and LIST if not.
+    """
+    def __init__(self, ftps_client):
+        """
+        Params:
+            ftps_client (bpm.ftpsclient.IoTFTPSClient | ftps_pool.ftps_session) - logged in client
+        """
+        self.ftps_client = ftps_client
+        # Pooled connections remember it between listings
+        self.use_mlsd = getattr(ftps_client, "use_mlsd", True)
+        self.failed = False
+
+    def list(self, path: str):
+        """
+        List a folder.
+
+        Return:
+            list[dict]:
+                {"name": str, "is_dir": bool, "size": int | None, "modify": str | None} for every file and folder in it
+        """
+        try:
+            return self._list(path)
+        except Exception:
+            self.failed = True
+            raise
+
+    def _list(self, path: str):
+        if self.use_mlsd:
+            try:
+                return [{"name": name, "is_dir": facts.get("type") == "dir", "size": int(facts["size"]) if "size" in facts else None,
+                         "modify": facts.get("modify")}
+                        for name, facts in self.ftps_client.ftps_session.mlsd(path, facts=["type", "size", "modify"])
+                        if facts.get("type") in ("dir", "file")]
+            except ftplib.error_perm:
+                # Not supported, the printer is asked with LIST from now on
+                self.use_mlsd = False
+                if hasattr(self.ftps_client, "use_mlsd"):
+                    self.ftps_client.use_mlsd = False
+
+        lines = []
+        self.ftps_client.ftps_session.retrlines(f"LIST {path}", lines.append)
+        entries = []
+        for line in lines:
+            match = _LIST_LINE_PATTERN.match(line)
+            if match is None:
+                continue
+            kind, size, modify, name = match.groups()
+            if name in (".", ".."):
+                continue
+            entries.append({"name": name, "is_dir": kind == "d", "size": int(size), "modify": " ".join(modify.split())})
+        return entries
+
+    def close(self):
+        """
+        Disconnect, or give the connection back if it's pooled. A pooled connection a listing failed on is closed instead.
+        """
+        try:
+            if self.failed and hasattr(self.ftps_client, "discard"):
+                self.ftps_client.discard()
+            else:
+                self.ftps_client.disconnect()
+        except Exception:
+            pass
+
+
+class sdcard_cache():
+    def __init__(self, connect, ttl: float = 300, max_workers: int = 8):
+        """
+        Params:
+            connect (function) - connect(printer_name) -> a lister with list(path) and close() like ftps_lister
+            ttl (float) - seconds a tree is used before it's refreshed
+            max_workers (int) - most printers listed at the same time
+        """
+        self.connect = connect
+        self.ttl = ttl
+
+        self._trees = {}
+        self._indexes = {}
+        self._refreshed_at = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+        self._printer_locks = {}
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sdcard_cache")
+
+        # How many folders have been listed and how many were reused from the cache
+        self.stats = {"listed": 0, "reused": 0}
+
+    def _printer_lock(self, printer_name: str):
+        with self._lock:
+            return self._printer_locks.setdefault(printer_name, threading.Lock())
+
+    def get(self, printer_names: list[str], max_age: float | None = None):
+        """
+        Get the trees of printers, the ones older than max_age (ttl if None) are refreshed first, all at the same time.
+
+        Return:
+            dict[str: dict | None]:
+                printer names as keys and trees as values, None for printers that have never been listed successfully
+        """
+        if max_age is None:
+            max_age = self.ttl
+
+        now = time.monotonic()
+        stale = [printer_name for printer_name in printer_names if now - self._refreshed_at.get(printer_name, float("-inf")) > max_age]
+        if len(stale) == 1:
+            self.refresh(stale[0], max_age)
+        elif stale:
+            list(self._pool.map(lambda printer_name: self.refresh(printer_name, max_age), stale))
+
+        return {printer_name: self._trees.get(printer_name) for printer_name in printer_names}
+
+    def get_cached(self, printer_name: str):
+        """
+        Get the tree of a printer without refreshing it, None if it has never been listed.
+        """
+        return self._trees.get(printer_name)
+
+    def refresh(self, printer_name: str, max_age: float = 0):
+        """
+        List a printer's SD card again, only the folders that can have changed (see the top of this file).
+        If listing fails the old tree is kept and the error can be seen in get_errors.
+
+        Return:
+            dict | None:
+                the tree of the printer
+        """
+        with self._printer_lock(printer_name):
+            # Someone else refreshed it while waiting for the lock
+            if time.monotonic() - self._refreshed_at.get(printer_name, float("-inf")) <= max_age:
+                return self._trees.get(printer_name)
+
+            lister = None
+            try:
+                lister = self.connect(printer_name)
+                stats = {"listed": 0, "reused": 0}
+                tree = self._list_folder(lister, "/", "/", None, self._trees.get(printer_name), stats)
+            except Exception as e:
+                with self._lock:
+                    self._errors[printer_name] = str(e)
+                return self._trees.get(printer_name)
+            finally:
+                if lister is not None:
+                    lister.close()
+
+            self._set_tree(printer_name, tree)
+            with self._lock:
+                for key, count in stats.items():
+                    self.stats[key] += count
+            return tree
+
+    def _list_folder(self, lister, path: str, name: str, modify: str | None, old_folder: dict | None, stats: dict):
+        folder_id = path if path.endswith("/") else f"{path}/"
+        old_children = {child["id"]: child for child in old_folder["children"]} if old_folder else {}
+
+        stats["listed"] += 1
+        children = []
+        for entry in sorted(lister.list(path), key=lambda entry: entry["name"]):
+            child_id = f"{folder_id}{entry['name']}"
+            if not entry["is_dir"]:
+                children.append({"id": child_id, "name": entry["name"], "size": entry["size"], "modify": entry["modify"]})
+                continue
+
+            old_child = old_children.get(f"{child_id}/")
+            if (old_child is not None and entry["modify"] is not None and old_child["modify"] == entry["modify"]
+                    and not any("children" in grandchild for grandchild in old_child["children"])):
+                stats["reused"] += 1
+                children.append(old_child)
+            else:
+                children.append(self._list_folder(lister, child_id, entry["name"], entry["modify"], old_child, stats))
+
+        return {"id": folder_id, "name": name, "modify": modify, "children": children}
+
+    def _set_tree(self, printer_name: str, tree: dict):
+        index = {"names": {}, "digests": {}}
+        folders = [tree]
+        while folders:
+            for child in folders.pop()["children"]:
+                if "children" in child:
+                    folders.append(child)
+                    continue
+
+                index["names"].setdefault(child["name"].lower(), []).append(child)
+                match = _DIGEST_PREFIX_PATTERN.match(child["name"])
+                if match:
+                    index["digests"].setdefault(match.group(1), []).append(child)
+
+        with self._lock:
+            self._trees[printer_name] = tree
+            self._indexes[printer_name] = index
+            self._refreshed_at[printer_name] = time.monotonic()
+            self._errors.pop(printer_name, None)
+
+    def _change_folder(self, printer_name: str, path: str, change):
+        """
+        Replace the folder of path in the cached tree with change(children) -> new children, copying the folders above it.
+        """
+        tree = self._trees.get(printer_name)
+        if tree is None:
+            return
+
+        folder_ids = []
+        for part in path.strip("/").split("/")[:-1]:
+            folder_ids.append(f"{folder_ids[-1] if folder_ids else '/'}{part}/")
+
+        def replace(folder, depth):
+            if depth == len(folder_ids):
+                return dict(folder, children=change(folder["children"]))
+            child = next((child for child in folder["children"] if child["id"] == folder_ids[depth]), None)
+            if child is None:
+                # Folder isn't in the cache, it's seen on the next refresh
+                return folder
+            return dict(folder, children=[replace(child, depth + 1) if other is child else other for other in folder["children"]])
+
+        refreshed_at = self._refreshed_at.get(printer_name)
+        self._set_tree(printer_name, replace(tree, 0))
+        # Changed by the server itself, so the rest of the tree is as old as it was
+        with self._lock:
+            self._refreshed_at[printer_name] = refreshed_at
+
+    def file_added(self, printer_name: str, path: str, size: int | None = None):
+        """
+        Add a file the server has uploaded to a printer to its cached tree, so it can be found before the tree is refreshed.
+        """
+        name = path.rsplit("/", 1)[-1]
+        new_file = {"id": path, "name": name, "size": size, "modify": None}
+        with self._printer_lock(printer_name):
+            self._change_folder(printer_name, path,
+                                lambda children: sorted([child for child in children if child["id"] != path] + [new_file], key=lambda child: child["name"]))
+
+    def file_removed(self, printer_name: str, path: str):
+        """
+        Remove a file the server has deleted from a printer from its cached tree.
+        """
+        with self._printer_lock(printer_name):
+            self._change_folder(printer_name, path, lambda children: [child for child in children if child["id"] != path])
+
+    def forget(self, printer_name: str):
+        """
+        Drop everything cached about a printer, e.g. when it's disconnected.
+        """
+        with self._lock:
+            for cached in (self._trees, self._indexes, self._refreshed_at, self._errors):
+                cached.pop(printer_name, None)
+
+    def find(self, name: str | None = None, digest: str | None = None):
+        """
+        Find files on the SD cards of every printer by name (not case sensitive) and/or by the digest of files uploaded by the server,
+        only from the cache.
+
+        Params:
+            name (str | None) - file name, without the folder
+            digest (str | None) - sha256 of the file, only the first 12 characters are used
+
+        Return:
+            list[dict]:
+                {"printer_name": str, "path": str, "size": int | None} of every file that matches
+        """
+        found = []
+        for printer_name, index in list(self._indexes.items()):
+            if digest is not None:
+                files = index["digests"].get(digest[:12].lower(), ())
+                if name is not None:
+                    files = [found_file for found_file in files if found_file["name"].lower() == name.lower()]
+            elif name is not None:
+                files = index["names"].get(name.lower(), ())
+            else:
+                files = ()
+
+            found.extend({"printer_name": printer_name, "path": found_file["id"], "size": found_file["size"]} for found_file in files)
+
+        return found
+
+    def get_errors(self):
+        """
+        Why the last refresh of printers failed, only printers whose last refresh failed.
+        """
+        with self._lock:
+            return dict(self._errors)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+
+def filter_3mf_files(tree: dict | None):
+    """
+    Get a copy of a tree with only .3mf files and folders, like bpm's BambuPrinter.get_sdcard_3mf_files.
+    """
+    if tree is None:
+        return None
+    return dict(tree, children=[filter_3mf_files(child) if "children" in child else child
+                                for child in tree["children"] if "children" in child or child["name"].lower().endswith(".3mf")])
+
+
+# #BadTestingRules
+if __name__ == "__main__":
+    import random
+
+    LIST_LATENCY = 0.03
+
+    class fake_lister():
+        """
+        A printer's SD card, every list takes LIST_LATENCY like a round trip over FTPS.
+        """
+        def __init__(self, folders: dict):
+            self.folders = folders
+
+        def list(self, path):
+            time.sleep(LIST_LATENCY)
+            return self.folders[path.rstrip("/") or "/"]
+
+        def close(self):
+            pass
+
+    def make_card(printer_index):
+        files = lambda count, prefix: [{"name": f"{prefix}_{i}.gcode.3mf", "is_dir": False, "size": 1000 + i, "modify": "20250319101500"}
+                                       for i in range(count)]
+        return {"/": [{"name": name, "is_dir": True, "size": None, "modify": "20250319101500"} for name in ("cache", "timelapse", "logger")],
+                "/cache": [{"name": f"{i:012x}_print_{printer_index}_{i}.gcode.3mf", "is_dir": False, "size": 1000 + i, "modify": "20250319101500"}
+                           for i in range(300)],
+                "/timelapse": [{"name": "thumbnail", "is_dir": True, "size": None, "modify": "20250319101500"}] + files(100, "video"),
+                "/timelapse/thumbnail": files(100, "thumb"),
+                "/logger": files(50, "log")}
+
+    cards = {f"printer_{i}": make_card(i) for i in range(20)}
+    cache = sdcard_cache(lambda printer_name: fake_lister(cards[printer_name]), ttl=300, max_workers=20)
+
+    start = time.perf_counter()
+    trees = cache.get(list(cards))
+    print(f"first listing of {len(cards)} printers: {time.perf_counter() - start:.2f}s "
+          f"(one by one would be {len(cards) * 5 * LIST_LATENCY:.2f}s), {cache.stats}")
+    assert all(len(tree["children"]) == 3 for tree in trees.values())
+
+    # A file is added to /cache on one printer, only /, /cache and /timelapse (has a subfolder) are listed again,
+    # /logger and /timelapse/thumbnail are the same as before
+    cards["printer_3"]["/cache"] = cards["printer_3"]["/cache"] + [{"name": "abcdefabcdef_new.gcode.3mf", "is_dir": False, "size": 5, "modify": "20250319102000"}]
+    cards["printer_3"]["/"] = [dict(entry, modify="20250319102000") if entry["name"] == "cache" else entry for entry in cards["printer_3"]["/"]]
+    cache.stats = {"listed": 0, "reused": 0}
+    tree = cache.refresh("printer_3")
+    print(f"refresh after a change: {cache.stats}")
+    assert cache.stats == {"listed": 3, "reused": 2}
+    assert cache.find(digest="abcdefabcdef" + "0" * 52) == [{"printer_name": "printer_3", "path": "/cache/abcdefabcdef_new.gcode.3mf", "size": 5}]
+
+    # Served from the cache while it's fresh
+    start = time.perf_counter()
+    cache.get(list(cards))
+    print(f"cached get of {len(cards)} printers: {(time.perf_counter() - start) * 1e6:.1f} us")
+
+    cache.file_added("printer_5", "/cache/123456123456_uploaded.gcode.3mf", 10)
+    assert cache.find(name="123456123456_UPLOADED.gcode.3mf")[0]["printer_name"] == "printer_5"
+    cache.file_removed("printer_5", "/cache/123456123456_uploaded.gcode.3mf")
+    assert not cache.find(digest="123456123456")
+    cache.file_added("printer_0", "/logger/today.log")
+    assert "/logger/today.log" not in {child["id"] for child in filter_3mf_files(cache.get_cached("printer_0"))["children"][1]["children"]}
+
+    runs = 100_000
+    names = [f"{random.randrange(300):012x}_print_{random.randrange(20)}_0.gcode.3mf" for _ in range(100)]
+    start = time.perf_counter()
+    for i in range(runs):
+        cache.find(digest=f"{i % 300:012x}")
+    print(f"find by digest across {len(cards)} printers: {(time.perf_counter() - start) / runs * 1e6:.2f} us")
+    start = time.perf_counter()
+    for i in range(runs):
+        cache.find(name=names[i % len(names)])
+    print(f"find by name across {len(cards)} printers: {(time.perf_counter() - start) / runs * 1e6:.2f} us")
@@ -0,0 +1,322 @@
+"""
+File: storage_manager.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-03-17
+Description: Module with the storage_manager class, which keeps the upload folder and the printers' /cache folders from filling up.
+
+What it does:
+    - Keeps the upload folder under max_bytes. Files that no print uses (idle, see upload_store) are deleted least recently used first when
+      room is needed for a new upload, or when they have been idle for idle_ttl. If there still isn't room the upload is refused (storage_full).
+    - Sweeps the upload folder for files that don't belong to the upload_store or a print in the queue, left behind by uploads or dispatches
+      that were interrupted by a crash. The sweep is incremental, every call only looks at sweep_batch entries and the next call continues
+      where it stopped, so a folder with a lot of files never stops the server for long. Files younger than orphan_grace are never deleted,
+      they might be an upload that is still being parsed.
+    - Deletes files the server has uploaded to a printer's /cache, except the printer_cache_files most recently printed ones. Only files with
+      names from upload_store.printer_file_path_for are touched, anything else on the SD card was put there by someone else.
+"""
+import os
+import re
+import time
+
+from blocking_io import run_blocking
+
+
+# printer_file_path_for names files "{first 12 characters of the digest}_{filename}"
+_PRINTER_FILE_PATTERN = re.compile(r"^/cache/[0-9a-f]{12}_[^/]+$")
+
+
+class storage_full(Exception):
+    pass
+
+
+class storage_manager():
+    def __init__(self, u_store, q_man, p_man = None, max_bytes: int = 20 * 1024**3, idle_ttl: float = 7 * 24 * 3600,
+                 orphan_grace: float = 3600, sweep_batch: int = 500, printer_cache_files: int = 20, is_printer_busy = None):
+        """
+        Params:
+            u_store (upload_store) - store the uploads are saved in, should have keep_idle set
+            q_man (queue_manager) - queue whose files must never be deleted
+            p_man (printer_manager | None) - printers to prune the /cache of
+            max_bytes (int) - how much the upload store may use
+            idle_ttl (float) - seconds a file can be idle before it's deleted even if there's room
+            orphan_grace (float) - seconds a file that doesn't belong anywhere is left alone after it was last changed
+            sweep_batch (int) - entries of the upload folder looked at per call to sweep
+            printer_cache_files (int) - files the server has uploaded to keep on every printer
+            is_printer_busy (function | None) - is_printer_busy(printer_name) -> bool, printers that are printing or being sent a print aren't pruned
+        """
+        self.u_store = u_store
+        self.q_man = q_man
+        self.p_man = p_man
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.orphan_grace = orphan_grace
+        self.sweep_batch = sweep_batch
+        self.printer_cache_files = printer_cache_files
+        self.is_printer_busy = is_printer_busy or (lambda printer_name: False)
+
+        # Where the sweep is in the upload folder, and the files in the queue when it started
+        self._scan = None
+        self._queued_paths = set()
+
+    def get_usage(self):
+        """
+        Get how much of the budget is used.
+
+        Return:
+            dict:
+                {"files": int, "bytes": int, "idle_files": int, "idle_bytes": int, "max_bytes": int}
+        """
+        return dict(self.u_store.get_usage(), max_bytes=self.max_bytes)
+
+    def make_room(self, incoming_bytes: int):
+        """
+        Make sure there is room for an upload of incoming_bytes, by deleting idle files if needed.
+
+        Exceptions:
+            - storage_full
+                if there isn't room even with every idle file deleted
+        """
+        usage = self.u_store.get_usage()
+        over_budget = usage["bytes"] + incoming_bytes - self.max_bytes
+        if over_budget <= 0:
+            return
+
+        if over_budget > usage["idle_bytes"]:
+            raise storage_full(f"Upload needs {incoming_bytes} bytes, only {self.max_bytes - usage['bytes'] + usage['idle_bytes']} can be freed")
+
+        evicted = run_blocking(self.u_store.evict_idle, over_budget)
+        print(f"Deleted {len(evicted)} idle uploads to make room for a new upload")
+
+    def evict_expired(self, now: float | None = None):
+        """
+        Delete files that have been idle for longer than idle_ttl, and idle files while the store is over budget.
+
+        Return:
+            list[str]:
+                paths of the deleted files
+        """
+        if now is None:
+            now = time.time()
+
+        usage = self.u_store.get_usage()
+        return run_blocking(self.u_store.evict_idle, max(0, usage["bytes"] - self.max_bytes), now - self.idle_ttl)
+
+    def sweep(self, now: float | None = None):
+        """
+        Look at the next sweep_batch entries of the upload folder and delete the ones that don't belong anywhere.
+
+        Return:
+            list[str]:
+                paths of the deleted files
+        """
+        if now is None:
+            now = time.time()
+
+        return run_blocking(self._sweep_batch, now)
+
+    def _sweep_batch(self, now: float):
+        if self._scan is None:
+            try:
+                self._scan = os.scandir(self.u_store.store_folder)
+            except FileNotFoundError:
+                return []
+            # Snapshot of the queue, prints added after it are either referenced in the store or younger than orphan_grace
+            self._queued_paths = {os.path.normpath(print_info["file_path"]) for print_info in self.q_man.prints.values()}
+
+        deleted = []
+        for _ in range(self.sweep_batch):
+            entry = next(self._scan, None)
+            if entry is None:
+                self._scan.close()
+                self._scan = None
+                break
+
+            try:
+                if not entry.is_file(follow_symlinks=False) or entry.stat().st_mtime > now - self.orphan_grace:
+                    continue
+            except FileNotFoundError:
+                continue
+
+            path = os.path.normpath(entry.path)
+            if path in self._queued_paths or self.u_store.is_stored(path):
+                continue
+
+            try:
+                os.remove(path)
+                deleted.append(path)
+            except FileNotFoundError:
+                pass
+
+        return deleted
+
+    def prune_printer_cache(self, printer_name: str):
+        """
+        Delete files the server uploaded to a printer's /cache, except the printer_cache_files most recently printed.
+
+        Return:
+            list[str]:
+                paths of the deleted files on the printer
+        """
+        if self.is_printer_busy(printer_name):
+            return []
+
+        contents = self.p_man.get_sdcard_files([printer_name], only_3mf_files=False)[printer_name]
+        if not contents:
+            return []
+
+        cache_folder = next((child for child in contents.get("children", ()) if child["id"] == "/cache/"), {})
+        uploaded_files = [child["id"] for child in cache_folder.get("children", ()) if _PRINTER_FILE_PATTERN.match(child["id"])]
+
+        known_files = self.u_store.get_printer_files(printer_name)
+        keep = set(list(known_files.values())[-self.printer_cache_files:]) if self.printer_cache_files else set()
+        digests = {printer_file_path: digest for digest, printer_file_path in known_files.items()}
+
+        deleted = []
+        for printer_file_path in uploaded_files:
+            if printer_file_path in keep:
+                continue
+            # A print could have been sent to it while the other files were deleted
+            if self.is_printer_busy(printer_name):
+                break
+
+            try:
+                self.p_man.delete_sdcard_file(printer_name, printer_file_path)
+            except Exception as e:
+                print(f"Failed to delete {printer_file_path} from {printer_name}: {e}")
+                continue
+
+            if printer_file_path in digests:
+                self.u_store.forget_printer_file(printer_name, digests[printer_file_path])
+            deleted.append(printer_file_path)
+
+        return deleted
+
+    def prune_printer_caches(self):
+        """
+        prune_printer_cache for every printer, printers that can't be reached are skipped.
+
+        Return:
+            dict[str: list[str]]:
+                printer names as keys and deleted files as values, only printers that had files deleted
+        """
+        pruned = {}
+        for printer_name in list(self.p_man.printers):
+            try:
+                deleted = self.prune_printer_cache(printer_name)
+            except Exception as e:
+                print(f"Failed to prune the cache of {printer_name}: {e}")
+                continue
+
+            if deleted:
+                pruned[printer_name] = deleted
+
+        return pruned
+
+
+# #BadTestingRules
+if __name__ == "__main__":
+    import io
+    import tempfile
+    from upload_store import upload_store, printer_file_path_for
+    from queue_manager import queue_manager
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        u_store = upload_store(temp_dir, keep_idle=True)
+        q_man = queue_manager()
+        s_man = storage_manager(u_store, q_man, max_bytes=10_000, idle_ttl=60, orphan_grace=60, sweep_batch=100)
+
+        # Files no print uses are kept until room is needed, least recently used is deleted first
+        files = {}
+        for i in range(4):
+            digest, path = u_store.save_stream(io.BytesIO(bytes([i]) * 2000), f"{i}.gcode.3mf")
+            files[i] = (digest, path)
+        for i in (2, 0, 1):
+            u_store.release(*files[i])
+        assert u_store.get_usage() == {"files": 4, "bytes": 8000, "idle_files": 3, "idle_bytes": 6000}
+        s_man.make_room(5000)
+        assert not os.path.exists(files[2][1]) and not os.path.exists(files[0][1]) and os.path.exists(files[1][1])
+        try:
+            s_man.make_room(9000)
+            raise AssertionError("file in use was deleted to make room")
+        except storage_full:
+            pass
+
+        # The same file uploaded again is used again instead of deleted
+        digest, path = u_store.save_stream(io.BytesIO(bytes([1]) * 2000), "1.gcode.3mf")
+        assert digest == files[1][0] and u_store.get_usage()["idle_files"] == 0
+
+        # Left overs are deleted once they are older than orphan_grace, in batches
+        for i in range(250):
+            with open(os.path.join(temp_dir, f".upload_{i}"), "wb") as left_over:
+                left_over.write(b"x")
+        old = time.time() - 120
+        for entry in os.scandir(temp_dir):
+            os.utime(entry.path, (old, old))
+        deleted = []
+        batches = 0
+        while True:
+            batch = s_man.sweep()
+            deleted += batch
+            batches += 1
+            if s_man._scan is None:
+                break
+        assert len(deleted) == 250 and os.path.exists(files[1][1]) and os.path.exists(files[3][1]), (len(deleted), batches)
+        print(f"swept {len(deleted)} left overs in {batches} batches")
+
+        # Idle files are still idle after a restart, in the same order, and the sweep leaves them alone
+        u_store.release(*files[3])
+        os.utime(files[3][1], (old, old))
+        u_store.release(digest, path)
+        restarted_store = upload_store(temp_dir, keep_idle=True)
+        restarted_store.rebuild_refcounts(q_man.prints)
+        assert restarted_store.get_usage() == {"files": 2, "bytes": 4000, "idle_files": 2, "idle_bytes": 4000}
+        assert list(restarted_store._idle) == [files[3][0], files[1][0]]
+        u_store = restarted_store
+        s_man = storage_manager(u_store, q_man, max_bytes=10_000, idle_ttl=60, orphan_grace=60, sweep_batch=100)
+        while s_man.sweep() or s_man._scan is not None:
+            pass
+        assert os.path.exists(files[3][1]) and os.path.exists(files[1][1])
+
+        # Idle for longer than idle_ttl
+        assert s_man.evict_expired(now=old + 90) == [files[3][1]]
+
+    # A big upload folder, how long one sweep batch takes
+    with tempfile.TemporaryDirectory() as temp_dir:
+        u_store = upload_store(temp_dir, keep_idle=True)
+        for i in range(20_000):
+            u_store.save_stream(io.BytesIO(str(i).encode()), f"{i}.gcode")
+        s_man = storage_manager(u_store, queue_manager(), sweep_batch=500)
+        longest = 0
+        batches = 0
+        while True:
+            start = time.perf_counter()
+            s_man.sweep()
+            longest = max(longest, time.perf_counter() - start)
+            batches += 1
+            if s_man._scan is None:
+                break
+        print(f"20000 files swept in {batches} batches, longest batch {longest * 1000:.1f} ms")
+
+    # Printer /cache, the most recently printed files are kept and files not uploaded by the server are never touched
+    class fake_printer_manager():
+        def __init__(self, files):
+            self.printers = {"printer": None}
+            self.files = files
+
+        def get_sdcard_files(self, printers, only_3mf_files=True):
+            return {"printer": {"id": "/", "children": [{"id": "/cache/", "children": [{"id": path} for path in self.files]}]}}
+
+        def delete_sdcard_file(self, printer_name, path):
+            self.files.remove(path)
+
+    u_store = upload_store("./unused")
+    digests = [f"{i:064x}" for i in range(5)]
+    printer_files = [printer_file_path_for(digest, f"{i}.gcode.3mf") for i, digest in enumerate(digests)]
+    for digest, printer_file_path in zip(digests, printer_files):
+        u_store.set_printer_file("printer", digest, printer_file_path)
+    u_store.set_printer_file("printer", digests[0], printer_files[0])
+    fake_p_man = fake_printer_manager(printer_files + ["/cache/my_own_file.3mf", "/cache/aaaaaaaaaaaa_forgotten.3mf"])
+    s_man = storage_manager(u_store, queue_manager(), fake_p_man, printer_cache_files=2)
+    print(s_man.prune_printer_caches())
+    assert sorted(fake_p_man.files) == sorted([printer_files[4], printer_files[0], "/cache/my_own_file.3mf"])
+    assert list(u_store.get_printer_files("printer").values()) == [printer_files[4], printer_files[0]]
@@ -0,0 +1,329 @@
+"""
+File: telemetry_store.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-03-05
+Description: Module with the telemetry_store class, which keeps the history of every printer's reports, e.g. to see how accurate the time estimates are.
+
+Three tiers, from most to least detailed:
+    raw    - every report, in a ring buffer per printer in memory. The buffer has a fixed size, so the oldest reports are overwritten and
+             memory use doesn't grow with uptime (capacity * ROW_BYTES per printer, about 225 KB with the defaults).
+             The buffer is one array per column instead of a dict per report, which is about 10 times smaller.
+    minute - one row per printer and minute in SQLite, kept for minute_retention seconds
+    hour   - one row per printer and hour in SQLite, made from the minute rows, kept for hour_retention seconds
+Every minute/hour row has the last value of every field in it, and the average of the temperatures.
+"""
+from array import array
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from blocking_io import run_blocking
+
+
+# (name, array typecode, value stored when the printer didn't report it)
+COLUMNS = (("timestamp", "d", 0.0),
+           ("percent_complete", "b", -1),
+           ("current_layer", "i", -1),
+           ("total_layers", "i", -1),
+           ("time_remaining", "i", -1),
+           ("current_stage", "h", -1),
+           ("gcode_state", "b", 0),
+           ("bed_temp", "f", math.nan),
+           ("tool_temp", "f", math.nan))
+_COLUMN_INDEXES = {name: index for index, (name, _, _) in enumerate(COLUMNS)}
+ROW_BYTES = sum(array(typecode).itemsize for _, typecode, _ in COLUMNS)
+
+# Stored as an index into this tuple, states that aren't in it are stored as "UNKNOWN"
+GCODE_STATES = ("UNKNOWN", "IDLE", "PREPARE", "RUNNING", "PAUSE", "FINISH", "FAILED", "SLICING", "INIT", "OFFLINE")
+_GCODE_STATE_INDEXES = {gcode_state: index for index, gcode_state in enumerate(GCODE_STATES)}
+
+RESOLUTIONS = ("raw", "minute", "hour")
+_LAST_VALUE_COLUMNS = ("percent_complete", "current_layer", "total_layers", "time_remaining", "current_stage", "gcode_state")
+_AVERAGED_COLUMNS = ("bed_temp", "tool_temp")
+
+
+class telemetry_ring():
+    """
+    Fixed size ring buffer of reports from one printer, one array per column.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.columns = {name: array(typecode, [missing_value]) * capacity for name, typecode, missing_value in COLUMNS}
+        self._next_index = 0
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def append(self, values: tuple):
+        index = self._next_index
+        for (name, _, _), value in zip(COLUMNS, values):
+            self.columns[name][index] = value
+
+        self._next_index = (index + 1) % self.capacity
+        self._length = min(self._length + 1, self.capacity)
+
+    def oldest_timestamp(self):
+        if self._length == 0:
+            return None
+        return self.columns["timestamp"][(self._next_index - self._length) % self.capacity]
+
+    def since(self, start: float, end: float):
+        """
+        Get the reports between start and end, oldest first, as lists per column.
+        """
+        first = (self._next_index - self._length) % self.capacity
+        order = [(first + offset) % self.capacity for offset in range(self._length)]
+
+        timestamps = self.columns["timestamp"]
+        indexes = [index for index in order if start <= timestamps[index] <= end]
+        return {name: [self.columns[name][index] for index in indexes] for name, _, _ in COLUMNS}
+
+
+class telemetry_store():
+    def __init__(self, db_path: str = "./telemetry.db", capacity: int = 7200, minute_retention: float = 7 * 24 * 3600,
+                 hour_retention: float = 365 * 24 * 3600):
+        """
+        Params:
+            db_path (str) - SQLite database for the minute and hour tiers
+            capacity (int) - reports kept in memory per printer, printers report about once a second while printing
+            minute_retention (float) - seconds to keep minute rows
+            hour_retention (float) - seconds to keep hour rows
+        """
+        self.db_path = db_path
+        self.capacity = capacity
+        self.minute_retention = minute_retention
+        self.hour_retention = hour_retention
+
+        self._lock = threading.Lock()
+        self._rings = {}
+        # Per printer, the minute that is being accumulated: [minute_start, samples, last_values, sums, counts]
+        self._current_minutes = {}
+        self._finished_minutes = []
+
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection_lock = threading.Lock()
+        for table in ("telemetry_minute", "telemetry_hour"):
+            self._connection.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                                             printer_name TEXT NOT NULL,
+                                             start INTEGER NOT NULL,
+                                             samples INTEGER NOT NULL,
+                                             {", ".join(f"{name} INTEGER" for name in _LAST_VALUE_COLUMNS)},
+                                             {", ".join(f"{name} REAL" for name in _AVERAGED_COLUMNS)},
+                                             PRIMARY KEY (printer_name, start)
+                                         ) WITHOUT ROWID""")
+
+    def record(self, printer_name: str, sample: dict, timestamp: float | None = None):
+        """
+        Record a report from a printer.
+
+        Params:
+            printer_name (str) - name of the printer
+            sample (dict) - the fields in COLUMNS (except timestamp), missing fields and None are stored as missing
+            timestamp (float | None) - when the report was received, now if None
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        values = [timestamp]
+        for name, typecode, missing_value in COLUMNS[1:]:
+            value = sample.get(name)
+            if name == "gcode_state":
+                value = _GCODE_STATE_INDEXES.get(value, 0)
+            elif value is None:
+                value = missing_value
+            elif typecode in "bhi":
+                value = int(value)
+            else:
+                value = float(value)
+            values.append(value)
+
+        with self._lock:
+            ring = self._rings.get(printer_name)
+            if ring is None:
+                ring = self._rings[printer_name] = telemetry_ring(self.capacity)
+            ring.append(values)
+            self._accumulate_minute(printer_name, timestamp, values)
+
+    def _accumulate_minute(self, printer_name: str, timestamp: float, values: list):
+        minute_start = int(timestamp // 60 * 60)
+        current_minute = self._current_minutes.get(printer_name)
+        if current_minute is not None and current_minute[0] != minute_start:
+            self._finished_minutes.append((printer_name, current_minute))
+            current_minute = None
+
+        if current_minute is None:
+            current_minute = self._current_minutes[printer_name] = [minute_start, 0, None, [0.0] * len(_AVERAGED_COLUMNS), [0] * len(_AVERAGED_COLUMNS)]
+
+        current_minute[1] += 1
+        current_minute[2] = values
+        for column_index, name in enumerate(_AVERAGED_COLUMNS):
+            value = values[_COLUMN_INDEXES[name]]
+            if not math.isnan(value):
+                current_minute[3][column_index] += value
+                current_minute[4][column_index] += 1
+
+    def flush(self, now: float | None = None, include_current_minute: bool = False):
+        """
+        Write finished minutes to disk, roll finished hours up from them and delete rows older than the retention.
+        Meant to be called about once a minute.
+
+        Params:
+            now (float | None) - current time, time.time() if None
+            include_current_minute (bool) - also write the minutes that haven't ended yet, used when closing
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            # Minutes that nothing has been reported in since they ended are finished too
+            for printer_name, current_minute in list(self._current_minutes.items()):
+                if include_current_minute or current_minute[0] + 60 <= now:
+                    self._finished_minutes.append((printer_name, current_minute))
+                    del self._current_minutes[printer_name]
+
+            finished_minutes = self._finished_minutes
+            self._finished_minutes = []
+
+        rows = []
+        for printer_name, (minute_start, samples, last_values, sums, counts) in finished_minutes:
+            rows.append((printer_name, minute_start, samples,
+                         *(last_values[_COLUMN_INDEXES[name]] for name in _LAST_VALUE_COLUMNS),
+                         *(total / count if count else None for total, count in zip(sums, counts))))
+
+        with self._connection_lock:
+            run_blocking(self._write_rollups, rows, now)
+
+    def _write_rollups(self, rows: list[tuple], now: float):
+        columns = ("printer_name", "start", "samples") + _LAST_VALUE_COLUMNS + _AVERAGED_COLUMNS
+        hours_to_roll_up = {(row[0], row[1] // 3600 * 3600) for row in rows}
+
+        self._connection.execute("BEGIN")
+        try:
+            self._connection.executemany(f"INSERT OR REPLACE INTO telemetry_minute ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                                         rows)
+
+            # The hour is rolled up again every time a minute in it is written, so it's up to date even before the hour has ended
+            for printer_name, hour_start in hours_to_roll_up:
+                self._connection.execute(f"""INSERT OR REPLACE INTO telemetry_hour ({', '.join(columns)})
+                                             SELECT printer_name, ?, SUM(samples),
+                                                    {", ".join(f"(SELECT {name} FROM telemetry_minute WHERE printer_name = ? AND start >= ? AND start < ? ORDER BY start DESC LIMIT 1)" for name in _LAST_VALUE_COLUMNS)},
+                                                    {", ".join(f"SUM({name} * samples) / SUM(CASE WHEN {name} IS NULL THEN 0 ELSE samples END)" for name in _AVERAGED_COLUMNS)}
+                                             FROM telemetry_minute WHERE printer_name = ? AND start >= ? AND start < ?
+                                             GROUP BY printer_name""",
+                                         (hour_start, *(value for _ in _LAST_VALUE_COLUMNS for value in (printer_name, hour_start, hour_start + 3600)),
+                                          printer_name, hour_start, hour_start + 3600))
+
+            self._connection.execute("DELETE FROM telemetry_minute WHERE start < ?", (now - self.minute_retention,))
+            self._connection.execute("DELETE FROM telemetry_hour WHERE start < ?", (now - self.hour_retention,))
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def query(self, printer_name: str, start: float, end: float | None = None, resolution: str | None = None):
+        """
+        Get the telemetry of a printer between start and end.
+
+        Params:
+            printer_name (str) - name of the printer
+            start (float) - timestamp of the start of the range
+            end (float | None) - timestamp of the end of the range, now if None
+            resolution (str | None) - "raw", "minute" or "hour", if None the most detailed tier that covers start is used
+
+        Return:
+            dict:
+                {"resolution": str, "columns": {column name: list of values}}, oldest first. Missing values are None, gcode_state is a string
+                For "minute" and "hour", "timestamp" is the start of the minute/hour and there's a "samples" column
+        """
+        end = time.time() if end is None else end
+        if resolution is None:
+            resolution = self._pick_resolution(printer_name, start, end)
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"resolution has to be one of {RESOLUTIONS}, got {resolution}")
+
+        if resolution == "raw":
+            with self._lock:
+                ring = self._rings.get(printer_name)
+                columns = ring.since(start, end) if ring else {name: [] for name, _, _ in COLUMNS}
+        else:
+            columns = self._query_table(f"telemetry_{resolution}", printer_name, start, end)
+
+        columns["gcode_state"] = [GCODE_STATES[index] if isinstance(index, int) and 0 <= index < len(GCODE_STATES) else None
+                                  for index in columns["gcode_state"]]
+        for name, _, missing_value in COLUMNS[1:]:
+            if name != "gcode_state":
+                columns[name] = [None if value is None or value == missing_value or (isinstance(value, float) and math.isnan(value)) else value
+                                 for value in columns[name]]
+
+        return {"resolution": resolution, "columns": columns}
+
+    def _pick_resolution(self, printer_name: str, start: float, end: float):
+        with self._lock:
+            ring = self._rings.get(printer_name)
+            oldest_raw = ring.oldest_timestamp() if ring else None
+
+        if oldest_raw is not None and oldest_raw <= start:
+            return "raw"
+        if end - start <= 6 * 3600 and time.time() - start <= self.minute_retention:
+            return "minute"
+        return "hour"
+
+    def _query_table(self, table: str, printer_name: str, start: float, end: float):
+        columns = ("start", "samples") + _LAST_VALUE_COLUMNS + _AVERAGED_COLUMNS
+        with self._connection_lock:
+            rows = run_blocking(lambda: self._connection.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE printer_name = ? AND start >= ? AND start <= ? ORDER BY start",
+                                                                 (printer_name, int(start // 60 * 60), end)).fetchall())
+
+        result = {name: [row[index] for row in rows] for index, name in enumerate(columns)}
+        result["timestamp"] = result.pop("start")
+        return result
+
+    def memory_bytes(self):
+        """
+        Bytes used by the ring buffers, capacity * ROW_BYTES per printer no matter how long the server has been running.
+        """
+        with self._lock:
+            return len(self._rings) * self.capacity * ROW_BYTES
+
+    def close(self):
+        self.flush(include_current_minute=True)
+        with self._connection_lock:
+            self._connection.close()
+
+
+# #BadTestingRules
+if __name__ == "__main__":
+    import random
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = telemetry_store(os.path.join(temp_dir, "telemetry.db"))
+
+        # 20 printers reporting once a second for 3 hours
+        printers = [f"S{i} Printer" for i in range(20)]
+        start_time = 1_700_000_000.0
+        reports = 3 * 3600
+        started = time.perf_counter()
+        for second in range(reports):
+            for printer_index, printer_name in enumerate(printers):
+                store.record(printer_name, {"percent_complete": second * 100 // reports, "current_layer": second // 30, "total_layers": reports // 30,
+                                            "time_remaining": (reports - second) // 60, "current_stage": 0, "gcode_state": "RUNNING",
+                                            "bed_temp": 60 + random.random(), "tool_temp": 220 + random.random()},
+                             timestamp=start_time + second + printer_index / 100)
+            if second % 60 == 59:
+                store.flush(now=start_time + second + 1)
+        elapsed = time.perf_counter() - started
+        print(f"recorded {reports * len(printers)} reports in {elapsed:.2f}s ({reports * len(printers) / elapsed:.0f}/s, including flushing every minute)")
+        print(f"ring buffers: {store.memory_bytes() / 1024:.0f} KB for {len(printers)} printers ({ROW_BYTES} bytes per report)")
+
+        now = start_time + reports
+        for resolution, since in (("raw", 600), ("minute", 3 * 3600), ("hour", 3 * 3600)):
+            started = time.perf_counter()
+            result = store.query(printers[0], now - since, now, resolution=resolution)
+            print(f"{resolution:>6}: {len(result['columns']['timestamp'])} rows in {(time.perf_counter() - started) * 1000:.1f} ms, "
+                  f"last time_remaining {result['columns']['time_remaining'][-1]}, gcode_state {result['columns']['gcode_state'][-1]}")
+
+        assert store.query(printers[0], now - 600, now)["resolution"] == "raw"
+        hours = store.query(printers[0], start_time, now, resolution="hour")["columns"]
+        assert len(hours["timestamp"]) == 3 and all(60 < bed_temp < 61 for bed_temp in hours["bed_temp"])
+        store.close()
@@ -0,0 +1,225 @@
+"""
+File: time_parser.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-03-14
+Description: Functions for reading the times BambuStudio and OrcaSlicer write in the header of a gcode file.
+
+The slicers write times as "{days}d {hours}h {minutes}m {seconds}s", where parts that are zero at the start are left out, e.g.
+    ; model printing time: 5h 49m 54s; total estimated time: 5h 56m 6s
+    ; model printing time: 1d 2h 3m 4s; total estimated time: 1d 2h 10m 0s
+    ; estimated printing time (normal mode) = 12m 30s
+    ; total estimated time: 0s
+The known field names are found with str.find, and only the text right after each one is read as a time, so letters in e.g. the filename
+can't be taken as units. Times written the way the slicers write them ("5h 49m 54s", ASCII digits and units from days down to seconds) are
+read with str.split, anything else (e.g. "5h49m" or "5 h") with a compiled pattern. Regex matching is what costs, matching the field names with it as well (an alternation tried at every
+position of the line) was several times slower than finding them.
+"""
+import re
+
+
+# Field names in the header and the keys they are returned as by parse_time_fields
+TIME_FIELDS = {"model printing time": "model_time",
+               "total estimated time": "total_time",
+               # OrcaSlicer and old BambuStudio versions, the total time
+               "estimated printing time (normal mode)": "total_time",
+               "estimated first layer printing time (normal mode)": "first_layer_time",
+               "prepare time": "prepare_time"}
+
+_UNIT_SECONDS = (("d", 86400), ("h", 3600), ("m", 60), ("s", 1))
+_SECONDS_BY_UNIT = dict(_UNIT_SECONDS)
+# Groups are days, hours, minutes and seconds. Every part is optional, but at least one has to be there (checked after matching).
+# A unit can't be followed by a letter, so "5 mins" or "2 hours" aren't read as minutes or hours.
+# Everything is matched against lowercased text, matching without IGNORECASE is about twice as fast.
+# ASCII, \d would match digits of every script as well
+_DURATION = (r"(?:(\d+)\s*d(?![a-z]))?\s*"
+             r"(?:(\d+)\s*h(?![a-z]))?\s*"
+             r"(?:(\d+)\s*m(?![a-z]))?\s*"
+             r"(?:(\d+)\s*s(?![a-z]))?")
+_DURATION_PATTERN = re.compile(_DURATION, re.ASCII)
+# Matched right after a field name, a time can't be followed by another number (e.g. "5h 5h")
+_VALUE_PATTERN = re.compile(r"\s*[:=]\s*" + _DURATION + r"(?!\s*\d)", re.ASCII)
+_FIELDS = tuple((field, key, len(field)) for field, key in TIME_FIELDS.items())
+
+
+def _seconds(days: str, hours: str, minutes: str, seconds: str):
+    """
+    Total seconds of the groups of a matched duration, None if none of its parts are there.
+    """
+    if not (days or hours or minutes or seconds):
+        return None
+    return int(days or 0)*86400 + int(hours or 0)*3600 + int(minutes or 0)*60 + int(seconds or 0)
+
+
+def parse_duration(text: str):
+    """
+    Parse a time like "1d 2h 3m 4s" to seconds.
+
+    Params:
+        - str:
+            text: the time, nothing else
+
+    Return:
+        - int:
+            the time in seconds, 0 is allowed
+
+    Exceptions:
+        - ValueError
+            if text isn't a time
+    """
+    match = _DURATION_PATTERN.fullmatch(text.strip().lower())
+    seconds = _seconds(*match.groups()) if match else None
+    if seconds is None:
+        raise ValueError(f"Unable to parse time from {text!r}")
+    return seconds
+
+
+def parse_time_fields(line: str):
+    """
+    Read every known time on a line of a gcode header.
+
+    Params:
+        - str:
+            line: the line, e.g. "; model printing time: 5h 49m 54s; total estimated time: 5h 56m 6s"
+
+    Return:
+        - dict[str: int]:
+            seconds of every time on the line, with the keys in TIME_FIELDS. Empty if there are none.
+            prepare_time is total_time - model_time if the line has both but no prepare time of its own
+    """
+    times = {}
+    line = line.lower()
+    # Most lines of a header have no times at all
+    if "time" not in line:
+        return times
+
+    for field, key, field_length in _FIELDS:
+        position = line.find(field)
+        if position == -1 or key in times:
+            continue
+        position += field_length
+
+        # Fast path, "{separator} 1d 2h 3m 4s" up to the next field. int() would also take e.g. "-9", "+5" and "1_0",
+        # so anything but ASCII digits, or units out of order, is left to the pattern
+        end = line.find(";", position)
+        parts = (line[position:end] if end != -1 else line[position:]).split()
+        if len(parts) > 1 and parts[0] in (":", "="):
+            seconds = 0
+            previous_unit_seconds = None
+            for part in parts[1:]:
+                number = part[:-1]
+                unit_seconds = _SECONDS_BY_UNIT.get(part[-1])
+                if (unit_seconds is None or not (number.isdigit() and number.isascii())
+                        or (previous_unit_seconds is not None and unit_seconds >= previous_unit_seconds)):
+                    break
+                seconds += int(number) * unit_seconds
+                previous_unit_seconds = unit_seconds
+            else:
+                times[key] = seconds
+                continue
+
+        match = _VALUE_PATTERN.match(line, position)
+        if match is not None:
+            seconds = _seconds(*match.groups())
+            if seconds is not None:
+                times[key] = seconds
+
+    if "prepare_time" not in times and "total_time" in times and "model_time" in times:
+        times["prepare_time"] = max(0, times["total_time"] - times["model_time"])
+
+    return times
+
+
+def format_duration(seconds: int):
+    """
+    Write seconds the way the slicers do, e.g. 93784 -> "1d 2h 3m 4s".
+    """
+    parts = []
+    for unit, unit_seconds in _UNIT_SECONDS:
+        value, seconds = divmod(seconds, unit_seconds)
+        if value or parts or unit == "s":
+            parts.append(f"{value}{unit}")
+    return " ".join(parts)
+
+
+# #BadTestingRules
+if __name__ == "__main__":
+    import random
+    import time
+
+    # Lines from real files
+    corpus = {"; model printing time: 5h 49m 54s; total estimated time: 5h 56m 6s": {"model_time": 20994, "total_time": 21366, "prepare_time": 372},
+              "; model printing time: 1d 2h 3m 4s; total estimated time: 1d 2h 10m 0s": {"model_time": 93784, "total_time": 94200, "prepare_time": 416},
+              "; total estimated time: 0s": {"total_time": 0},
+              "; estimated printing time (normal mode) = 12m 30s": {"total_time": 750},
+              "; estimated first layer printing time (normal mode) = 45s": {"first_layer_time": 45},
+              "; model printing time: 1h; total estimated time: 1h 2m 3s": {"model_time": 3600, "total_time": 3723, "prepare_time": 123},
+              "; Total Estimated Time: 3M 2S": {"total_time": 182},
+              "; filename = mushroom_shelf_5h.gcode": {},
+              "; total estimated time: unknown": {},
+              "; total layer number: 790": {},
+              # Not times the way the slicers write them, int() and unit lookups alone would read every one of them
+              "; total estimated time: -9h 1m": {},
+              "; total estimated time: +5h": {},
+              "; total estimated time: 1_0m": {},
+              "; total estimated time: 5h 5h": {},
+              "; total estimated time: 1m 5h": {},
+              "; total estimated time: \u0665h": {}}
+    for line, expected in corpus.items():
+        assert parse_time_fields(line) == expected, (line, parse_time_fields(line))
+    assert parse_duration("0s") == 0 and parse_duration(" 2d ") == 172800
+    for not_a_time in ("", "abc", "5 mins", "2 hours"):
+        try:
+            parse_duration(not_a_time)
+            raise AssertionError(f"{not_a_time!r} was parsed")
+        except ValueError:
+            pass
+    print("corpus ok")
+
+    # Random times, written every way the slicers write them with random text around, are always read back as the same times
+    rng = random.Random(0)
+    for _ in range(100_000):
+        model_time = rng.choice((0, rng.randint(0, 59), rng.randint(0, 3600), rng.randint(0, 10 * 86400)))
+        total_time = model_time + rng.randint(0, 1800)
+        separator = rng.choice((": ", ":", " : ", " = "))
+        spacing = rng.choice((" ", "", "  "))
+        model = spacing.join(format_duration(model_time).split())
+        total = spacing.join(format_duration(total_time).split())
+        noise = "".join(rng.choice("dhms ;_.x0123456789") for _ in range(rng.randint(0, 20)))
+        line = f"; {noise}model printing time{separator}{model}; total estimated time{separator}{total}; {noise}"
+        times = parse_time_fields(rng.choice((line, line.upper(), line.lower())))
+        assert times["model_time"] == model_time and times["total_time"] == total_time, (line, times)
+        assert parse_duration(total) == total_time
+    print("fuzz ok, 100000 lines")
+
+    def old_parse_estimated_time_line(line: str):
+        # What printing_utils did before, for comparison
+        time_string = line.split("total estimated time: ")[1]
+        total_seconds = 0
+        if "h" in time_string:
+            total_seconds += int(time_string.split("h")[0].strip()) * 3600
+            time_string = time_string.split("h")[1].strip()
+        if "m" in time_string:
+            total_seconds += int(time_string.split("m")[0].strip()) * 60
+            time_string = time_string.split("m")[1].strip()
+        if "s" in time_string:
+            total_seconds += int(time_string.split("s")[0].strip())
+        return total_seconds
+
+    # Importing an archive of thousands of old files reads one time line per plate
+    lines = [f"; model printing time: {format_duration(t)}; total estimated time: {format_duration(t + 300)}"
+             for t in (rng.randint(60, 86000) for _ in range(10_000))]
+    # The old parser only read the total time (and can't read days), so it's also timed reading both times the same way
+    def old_parse_both(line: str):
+        model_part = line[line.index("model printing time:"):line.index(";", 2)].replace("model printing time:", "total estimated time: ")
+        return old_parse_estimated_time_line(model_part), old_parse_estimated_time_line(line[line.index("total estimated time:"):])
+
+    for name, parse in (("parse_time_fields, model and total time", parse_time_fields),
+                        ("old split parser, total time only", lambda line: old_parse_estimated_time_line(line[line.index("total estimated time:"):])),
+                        ("old split parser, model and total time", old_parse_both)):
+        best = float("inf")
+        for _ in range(5):
+            start = time.perf_counter()
+            for line in lines:
+                parse(line)
+            best = min(best, time.perf_counter() - start)
+        print(f"{name}: {best / len(lines) * 1e6:.2f} us per line")
@@ -0,0 +1,109 @@
+"""
+File: update_dispatcher.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-02-13
+Description: Module with the update_dispatcher class, which runs a callback (dispatching prints and pushing updates to the UI) when printers report something.
+
+Printers send MQTT reports about once a second each, so running the callback for every report would be a waste. Instead every report triggers
+the dispatcher, and all triggers within debounce seconds are coalesced into one call. Triggers marked as urgent (a printer finishing or failing)
+only wait urgent_debounce seconds, so that the next print is sent out right away.
+"""
+import threading
+import time
+
+
+class update_dispatcher():
+    def __init__(self, callback, debounce: float = 1.0, urgent_debounce: float = 0.1):
+        """
+        Params:
+            callback (function) - function without params to call
+            debounce (float) - longest time in seconds a normal trigger waits before the callback is called
+            urgent_debounce (float) - longest time in seconds an urgent trigger waits before the callback is called
+        """
+        self.callback = callback
+        self.debounce = debounce
+        self.urgent_debounce = urgent_debounce
+
+        self._condition = threading.Condition()
+        self._deadline = None
+        self._running = False
+        self._thread = None
+
+        self.calls = 0
+        self.triggers = 0
+
+    def trigger(self, urgent: bool = False):
+        """
+        Ask for the callback to be called. Can be called from any thread and never blocks.
+
+        Params:
+            urgent (bool) - whether to use urgent_debounce instead of debounce
+        """
+        delay = self.urgent_debounce if urgent else self.debounce
+
+        with self._condition:
+            self.triggers += 1
+            deadline = time.monotonic() + delay
+
+            # The deadline is only ever moved closer, otherwise a steady stream of reports would keep pushing it back
+            if self._deadline is None or deadline < self._deadline:
+                self._deadline = deadline
+                self._condition.notify()
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+
+        self._thread = threading.Thread(target=self._run, name="update_dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and (self._deadline is None or self._deadline > time.monotonic()):
+                    timeout = None if self._deadline is None else self._deadline - time.monotonic()
+                    self._condition.wait(timeout)
+
+                if not self._running:
+                    return
+
+                self._deadline = None
+
+            try:
+                self.callback()
+                self.calls += 1
+            except Exception as e:
+                print("***WARNING***")
+                print(f"Dispatcher callback failed with exception: {e}")
+                print("***WARNING***")
+
+
+# #BadTestingRules
+if __name__ == "__main__":
+    dispatcher = update_dispatcher(lambda: print("dispatching"), debounce=0.5, urgent_debounce=0.05)
+    dispatcher.start()
+
+    # 100 reports within half a second should only give one call
+    for _ in range(100):
+        dispatcher.trigger()
+        time.sleep(0.004)
+    time.sleep(0.6)
+
+    # Urgent trigger should be called almost right away
+    start = time.monotonic()
+    dispatcher.trigger(urgent=True)
+    while dispatcher.calls < 2:
+        time.sleep(0.001)
+    print(f"urgent call after {time.monotonic() - start:.3f}s, {dispatcher.triggers} triggers gave {dispatcher.calls} calls")
+
+    dispatcher.stop()
@@ -0,0 +1,326 @@
+"""
+File: upload_store.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-02-19
+Description: Module with the upload_store class, which stores uploaded print files by the sha256 of their content (content-addressed).
+
+The same file uploaded many times is only stored once, and is kept for as long as any print in the queue uses it (reference counting).
+With keep_idle, files no print uses anymore are kept as idle instead of being deleted, so the same file being uploaded again (a print that
+failed and is sent again) is already there, idle files are deleted least recently used first by evict_idle (see storage_manager.py).
+The store also remembers the parsed metadata of every file, and which printers already have a file in their /cache, so that printing the same
+file again skips both parsing it and uploading it to the printer.
+"""
+from collections import OrderedDict
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+
+
+# Files in the store are named "{digest}{suffix}", see get_path and file_suffix
+_STORED_FILE_PATTERN = re.compile(r"^([0-9a-f]{64})(\.gcode\.3mf|\.3mf|\.gcode)$")
+
+
+class upload_store():
+    def __init__(self, store_folder: str, chunk_size: int = 1024 * 1024, max_cached_metadata: int = 4096, keep_idle: bool = False):
+        """
+        Params:
+            store_folder (str) - folder to store files in
+            chunk_size (int) - bytes read at a time when saving a file
+            max_cached_metadata (int) - how many files' metadata to remember, least recently used is forgotten first
+            keep_idle (bool) - keep files no print uses until evict_idle deletes them, instead of deleting them when they are released
+        """
+        self.store_folder = store_folder
+        self.chunk_size = chunk_size
+        self.max_cached_metadata = max_cached_metadata
+        self.keep_idle = keep_idle
+
+        self._lock = threading.Lock()
+        self._refcounts = {}
+        # digest: (path, size) of every file in the store, used or idle
+        self._files = {}
+        self._bytes = 0
+        # digest: time it became idle, least recently used first
+        self._idle = OrderedDict()
+        self._idle_bytes = 0
+        self._metadata = OrderedDict()
+        self._printer_files = {}
+
+    def get_path(self, digest: str, suffix: str):
+        return os.path.join(self.store_folder, f"{digest}{suffix}")
+
+    def save_stream(self, stream, filename: str):
+        """
+        Save a file to the store, hashing it while it's written so it's only read once.
+
+        Params:
+            stream (file-like) - the file's content, e.g. werkzeug's FileStorage.stream
+            filename (str) - original (secured) filename, the extension is kept
+
+        Return:
+            tuple:
+                (digest, path) of the file, a reference is taken on it that has to be released with release()
+        """
+        os.makedirs(self.store_folder, exist_ok=True)
+        sha256 = hashlib.sha256()
+
+        temp_file = tempfile.NamedTemporaryFile(dir=self.store_folder, prefix=".upload_", delete=False)
+        try:
+            with temp_file:
+                while True:
+                    chunk = stream.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    temp_file.write(chunk)
+
+            return self.add_file(temp_file.name, filename, sha256.hexdigest())
+
+        except Exception:
+            if os.path.exists(temp_file.name):
+                os.remove(temp_file.name)
+            raise
+
+    def add_file(self, temp_path: str, filename: str, digest: str):
+        """
+        Move a file that is already on disk (and hashed) into the store, used by save_stream and by uploads that were received in chunks.
+
+        Return:
+            tuple:
+                (digest, path) of the file, a reference is taken on it that has to be released with release()
+        """
+        path = self.get_path(digest, file_suffix(filename))
+
+        with self._lock:
+            if os.path.exists(path):
+                os.remove(temp_path)
+            else:
+                os.replace(temp_path, path)
+
+            if digest not in self._files:
+                self._add_to_files(digest, path, os.path.getsize(path))
+            self._take_reference(digest)
+
+        return digest, path
+
+    def _add_to_files(self, digest: str, path: str, size: int):
+        self._files[digest] = (path, size)
+        self._bytes += size
+
+    def _take_reference(self, digest: str):
+        self._refcounts[digest] = self._refcounts.get(digest, 0) + 1
+        if digest in self._idle:
+            del self._idle[digest]
+            self._idle_bytes -= self._files[digest][1]
+
+    def _delete_file(self, digest: str):
+        path, size = self._files.pop(digest, (None, 0))
+        self._bytes -= size
+        if digest in self._idle:
+            del self._idle[digest]
+            self._idle_bytes -= size
+        if path and os.path.exists(path):
+            os.remove(path)
+        return path
+
+    def acquire(self, digest: str):
+        """
+        Take another reference on a file, e.g. when a print is put back in the queue.
+        """
+        with self._lock:
+            self._take_reference(digest)
+
+    def release(self, digest: str | None, path: str):
+        """
+        Release a reference on a file, the file is deleted (or becomes idle, see keep_idle) when no print uses it anymore.
+        Files of prints from before the store was used have no digest, those are deleted right away.
+
+        Return:
+            bool:
+                whether the file was deleted
+        """
+        if digest is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return True
+
+        with self._lock:
+            refcount = self._refcounts.get(digest, 0) - 1
+            if refcount > 0:
+                self._refcounts[digest] = refcount
+                return False
+
+            self._refcounts.pop(digest, None)
+            if self.keep_idle and digest in self._files:
+                self._idle[digest] = time.time()
+                self._idle_bytes += self._files[digest][1]
+                # The modification time is when it became idle, so the order survives a restart (see rebuild_refcounts)
+                try:
+                    os.utime(self._files[digest][0])
+                except OSError:
+                    pass
+                return False
+
+            self._files.setdefault(digest, (path, 0))
+            self._delete_file(digest)
+            return True
+
+    def evict_idle(self, bytes_to_free: int = 0, idle_before: float | None = None):
+        """
+        Delete idle files, least recently used first, until bytes_to_free bytes have been freed and no file has been idle since before idle_before.
+
+        Return:
+            list[str]:
+                paths of the files that were deleted
+        """
+        evicted = []
+        freed = 0
+        with self._lock:
+            while self._idle:
+                digest, idle_since = next(iter(self._idle.items()))
+                if freed >= bytes_to_free and (idle_before is None or idle_since >= idle_before):
+                    break
+
+                freed += self._files[digest][1]
+                evicted.append(self._delete_file(digest))
+
+        return evicted
+
+    def is_stored(self, path: str):
+        """
+        Whether a file in the store folder belongs to the store (used or idle), anything else in the folder is left over from something.
+        """
+        digest = os.path.basename(path).split(".")[0]
+        with self._lock:
+            stored = self._files.get(digest)
+            return stored is not None and os.path.normpath(stored[0]) == os.path.normpath(path)
+
+    def get_usage(self):
+        """
+        Get how much is stored.
+
+        Return:
+            dict:
+                {"files": int, "bytes": int, "idle_files": int, "idle_bytes": int}
+        """
+        with self._lock:
+            return {"files": len(self._files), "bytes": self._bytes, "idle_files": len(self._idle), "idle_bytes": self._idle_bytes}
+
+    def rebuild_refcounts(self, prints: dict[str: dict]):
+        """
+        Count references from the prints in the queue, used after the queue has been loaded on startup.
+        With keep_idle, the other files in the store folder become idle again, least recently modified first, so they are kept across restarts.
+        Files that aren't named like stored files are left for storage_manager.sweep.
+        """
+        with self._lock:
+            self._refcounts = {}
+            self._files = {}
+            self._bytes = 0
+            self._idle = OrderedDict()
+            self._idle_bytes = 0
+            for print_info in prints.values():
+                digest = print_info.get("digest")
+                if not digest:
+                    continue
+                if digest not in self._files and os.path.isfile(print_info["file_path"]):
+                    self._add_to_files(digest, print_info["file_path"], os.path.getsize(print_info["file_path"]))
+                self._refcounts[digest] = self._refcounts.get(digest, 0) + 1
+
+            if not self.keep_idle:
+                return
+
+            idle_files = []
+            try:
+                with os.scandir(self.store_folder) as entries:
+                    for entry in entries:
+                        match = _STORED_FILE_PATTERN.match(entry.name)
+                        if match is None or match.group(1) in self._files or not entry.is_file(follow_symlinks=False):
+                            continue
+                        stat = entry.stat()
+                        idle_files.append((stat.st_mtime, match.group(1), entry.path, stat.st_size))
+            except FileNotFoundError:
+                return
+
+            for idle_since, digest, path, size in sorted(idle_files):
+                # The same content with two extensions, only one of them is stored, the other is swept as a left over
+                if digest in self._files:
+                    continue
+                self._add_to_files(digest, path, size)
+                self._idle[digest] = idle_since
+                self._idle_bytes += size
+
+    def get_metadata(self, digest: str):
+        """
+        Get the cached metadata of a file, None if it hasn't been parsed.
+        """
+        with self._lock:
+            metadata = self._metadata.get(digest)
+            if metadata is not None:
+                self._metadata.move_to_end(digest)
+            return metadata
+
+    def set_metadata(self, digest: str, metadata):
+        with self._lock:
+            self._metadata[digest] = metadata
+            self._metadata.move_to_end(digest)
+            while len(self._metadata) > self.max_cached_metadata:
+                self._metadata.popitem(last=False)
+
+    def get_printer_file(self, printer_name: str, digest: str):
+        """
+        Get where a file is stored on a printer, if it has already been uploaded there.
+
+        Return:
+            str | None:
+                path of the file on the printer, None if the printer doesn't have it
+        """
+        with self._lock:
+            return self._printer_files.get(printer_name, {}).get(digest)
+
+    def set_printer_file(self, printer_name: str, digest: str, printer_file_path: str):
+        """
+        Remember that a printer has a file.
+        """
+        with self._lock:
+            printer_files = self._printer_files.setdefault(printer_name, {})
+            # Moved to the end, so the files are in the order they were last printed in (see storage_manager.prune_printer_cache)
+            printer_files.pop(digest, None)
+            printer_files[digest] = printer_file_path
+
+    def forget_printer_file(self, printer_name: str, digest: str):
+        """
+        Forget that a printer has a file, e.g. when it was deleted or starting a print with it failed.
+        """
+        with self._lock:
+            self._printer_files.get(printer_name, {}).pop(digest, None)
+
+    def get_printer_files(self, printer_name: str):
+        """
+        Get all files known to be on a printer.
+
+        Return:
+            dict[str: str]:
+                digests as keys and paths on the printer as values, least recently printed first
+        """
+        with self._lock:
+            return dict(self._printer_files.get(printer_name, {}))
+
+
+def file_suffix(filename: str):
+    """
+    Get the extension of a print file, including double extensions like ".gcode.3mf".
+    """
+    lower_filename = filename.lower()
+    for suffix in (".gcode.3mf", ".3mf", ".gcode"):
+        if lower_filename.endswith(suffix):
+            return suffix
+    return os.path.splitext(filename)[1]
+
+
+def printer_file_path_for(digest: str, filename: str):
+    """
+    Path to upload a file to on a printer, starts with part of the digest so two different files with the same name don't overwrite each other.
+    """
+    return f"/cache/{digest[:12]}_{filename}"
@@ -0,0 +1,51 @@
+"""
+File: wsgi.py
+Author: Samuel Olsson, fdABB-Gym-Samuel
+Date Created: 2025-02-26
+Description: Production entry point, runs the app on gevent instead of Werkzeug's dev server.
+
+The dev server (python backend/app.py) uses one OS thread per connection. Every connected dashboard keeps its websocket open, so with a
+few dozen dashboards plus the threads blocked on JWKS, MSAL and uploads to printers the server runs out of threads. On gevent every connection
+is a greenlet, which costs a few KB, and a greenlet waiting on a socket lets all the others run. See blocking_io.py for what is done about
+calls that block without going through a socket.
+
+Concurrency limit:
+    PRINTEZ_MAX_CONNECTIONS (default 1000) is the most connections handled at the same time. Every open dashboard uses one for its
+    websocket (or one per outstanding long-poll if websockets are blocked), and every HTTP request uses one while it runs.
+    Connections over the limit wait in the listen backlog until another one closes, they aren't dropped.
+
+Run with:
+    python backend/wsgi.py
+"""
+# Has to be done before anything else is imported, so everything uses gevent's sockets, locks and sleep
+from gevent import monkey
+monkey.patch_all()
+
+import os
+os.environ.setdefault("PRINTEZ_ASYNC_MODE", "gevent")
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from geventwebsocket.handler import WebSocketHandler
+
+import app as printez
+
+
+MAX_CONNECTIONS = int(os.getenv("PRINTEZ_MAX_CONNECTIONS", 1000))
+HOST = os.getenv("PRINTEZ_HOST", "0.0.0.0")
+PORT = int(os.getenv("PRINTEZ_PORT", 5000))
+
+
+if __name__ == "__main__":
+    printez.start_background_services()
+
+    server = WSGIServer((HOST, PORT), printez.app, handler_class=WebSocketHandler, spawn=Pool(MAX_CONNECTIONS))
+    print(f"Serving on http://{HOST}:{PORT} with at most {MAX_CONNECTIONS} connections at a time")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop(timeout=5)
+        printez.stop_background_services()
@@ -1,6 +1,8 @@
 
 console.log("opening socket")
 let socket = io()
+let prelim_queue = undefined
+let printer_data = undefined
 
 
 
@@ -53,103 +55,182 @@ function update_printer_box_values(printer_name, percentage_complete, time_remai
 
 
 
+function render_printer_data(){
+    const printers = printer_data.printers
+    print_area = document.getElementById("print-area")
+
+    if (print_area.children.length !== Object.keys(printers).length){
+        print_area.innerHTML = ""
+        for (printer_name in printers){
+            createPrintBox(printer_name)
+        }
+
+    }
+    for (const printerName in printers) {
+        const printerInfo = printers[printerName];
+
+        update_printer_box_values(printerName, printerInfo.percentage_complete, printerInfo.time_remaining, printerInfo.subtask_name)
+    }
+}
+
+function update_queue_time(){
+    queue_time_el = document.getElementById("QueueTime")
+    if (!queue_time_el || prelim_queue === undefined || prelim_queue.queue.length === 0) return
+
+    const last_in_queue = prelim_queue.queue[prelim_queue.queue.length - 1]
+    queue_time_el.innerText = `~${minutes_until(Object.values(last_in_queue)[0]["estimated_completion_at"])}min`
+}
+
+// The queue has when prints will be done, not how long it is until then, so the time shown is counted down here
+function minutes_until(timestamp){
+    return Math.max(0, Math.floor((timestamp * 1000 - Date.now()) / 60000))
+}
+
+setInterval(update_queue_time, 30 * 1000)
+
+
+
+// The handlers are registered once, registering them on connect would add them again on every reconnect.
+// Patches and diffs sent while disconnected are lost, so the full state is asked for again
 socket.on("connect", function(){
+    socket.emit("update_printer_times_resync")
+    socket.emit("prelim_queue_resync")
+});
 
 
-    // This should update info available on GUI about every printer
-    // Example data:
-        // 
-        //{
-        // 
-        //{
-        //   "S5. Brienne of Tarth": {
-        //     "time_remaining": 1,
-        //     "subtask_name": "mattias v 240s VattenRäna",
-        //     "total_layers": 30,
-        //     "current_layer": 4,
-        //     "current_stage": 0,
-        //     "current_stage_text": "",
-        //     "gcode_state": "FAILED",
-        //     "percentage_complete": "13%"
-        //     "gcode_state": "FAILED",
-        //     "percentage_complete": "13%"
-        //   }
-        //   ...
-        // }
-        socket.on("update_printer_times", function (printer_data) {
-            print_area = document.getElementById("print-area")
-
-            if (print_area.children.length !== printer_data.length){
-                print_area.innerHTML = ""
-                for (printer_name in printer_data){
-                    createPrintBox(printer_name)
-                }
-
-            }
-            for (const printerName in printer_data) {
-                if (printer_data.hasOwnProperty(printerName)) {
-                    const printerInfo = printer_data[printerName];
-
-                    update_printer_box_values(printerName, printerInfo.percentage_complete, printerInfo.time_remaining, printerInfo.subtask_name)
-
-                }
-            }
-        });
-        
-        
-    // This should add the file data to whatever is showing your uploaded files
-    // Example data:
-    // {
-    //     "filename": "{name of file}",
-    //     "owner": "{name of owner}"
-    //   }
-    socket.on("file_added_to_queue", function(file_data){
-        console.log("file_added_to_queue")
-        console.log(file_data)
-    })
-
-
-    // This should update whatever is showing a prelimary queue
-    // Example Data:
-    // [
-    //   {
-    //      "print_id": "{id_of_print}",
-    //      "estimated_time_to_completion": {time in minutes from now until print being finished, its preliminary},
-    //      "file_name": {filepath on server, will probably change since theres no reason},
-    //      "owner": "{owner name}"
-    //   }
-    //   ...
-    // ]
-    socket.on("prelim_queue", function(queue_data){
-        if (queue_data !== undefined){
-            return
-        }
-        update_queue_time = Object.values(queue_data[-1])[0]["estimated_time_to_completion"]
-        queue_time_el = document.getElementById("QueueTime")
-        queue_time_el.innerText = `~${update_queue_time}min`
-    })
-    // This should create some sort of pop-up-like thing asking user to clean plate
-
-    // Listen for the cleanup request from the server
-    socket.on("request_plate_cleanup", function (cleanup_msg) {
-
-        // Extract printId from the message
-        const printer_name = cleanup_msg.printer_name || 'unknown';
-
-        // Call the function to create the cleanup prompt
-        createTakeoutPrompt(printer_name.replace(/ /g, "_"), cleanup_msg.msg || "A cleanup is required!");
-        // This should remove said pop-up
-    })
-    socket.on("plate_is_clean", function(data){
-        // console.log("plate_is_clean")
-        // console.log(data)
-        printer_name = data["printer_name"]
-        msg = data["msg"]
-
-        request_cleanup_el = document.getElementById(`prompt-${printer_name}`)
-        if (request_cleanup_el === undefined){
-            request_cleanup_el.remove();
-        }
-        console.log(msg)
-    })
+// This should update info available on GUI about every printer
+// The full state is sent on connect (and on resync), after that only patches with the fields that changed are sent
+// Example data:
+//{
+//   "seq": 12,
+//   "printers": {
+//     "S5. Brienne of Tarth": {
+//       "time_remaining": 1,
+//       "subtask_name": "mattias v 240s VattenRäna",
+//       "total_layers": 30,
+//       "current_layer": 4,
+//       "current_stage": 0,
+//       "current_stage_text": "",
+//       "gcode_state": "FAILED",
+//       "percentage_complete": "13%"
+//     }
+//     ...
+//   }
+// }
+socket.on("update_printer_times", function (printer_times) {
+    printer_data = printer_times
+    render_printer_data()
+});
+
+// Example data:
+//{
+//   "seq": 13,
+//   "patches": {"S5. Brienne of Tarth": {"time_remaining": 0, "current_layer": 5}},
+//   "removed": []
+// }
+socket.on("update_printer_times_patch", function (patch) {
+    if (printer_data === undefined || patch.seq !== printer_data.seq + 1){
+        // Missed a patch, get the full state again
+        socket.emit("update_printer_times_resync")
+        return
+    }
+    for (const printerName in patch.patches) {
+        printer_data.printers[printerName] = Object.assign(printer_data.printers[printerName] || {}, patch.patches[printerName])
+    }
+    for (const printerName of patch.removed) {
+        delete printer_data.printers[printerName]
+    }
+    printer_data.seq = patch.seq
+    render_printer_data()
 });
+
+
+// This should add the file data to whatever is showing your uploaded files
+// Example data:
+// {
+//     "filename": "{name of file}",
+//     "owner": "{name of owner}"
+//   }
+socket.on("file_added_to_queue", function(file_data){
+    console.log("file_added_to_queue")
+    console.log(file_data)
+})
+
+
+// Same as file_added_to_queue, but for every file of a batch upload (/upload/batch) at once
+// Example data:
+// {
+//     "owner": "{name of owner}",
+//     "files": [{"filename": "{name of file}", "owner": "{name of owner}", "uuid": "{id of print}"}, ...],
+//     "failed": [{"filename": "{name of file}", "uuid": "{id the print would have had}", "reason": "{why it wasn't added}"}, ...]
+//   }
+socket.on("files_added_to_queue", function(batch_data){
+    console.log("files_added_to_queue")
+    console.log(batch_data)
+})
+
+
+// This should update whatever is showing a prelimary queue
+// The whole queue is sent on connect (and on resync), after that only diffs are sent
+// Example Data:
+// {
+//   "version": {version of the queue, increases by one for every diff},
+//   "queue": [
+//     {
+//        "{id_of_print}": {
+//            "estimated_completion_at": {unix timestamp in seconds, rounded down to the minute, of when the print will be finished, its preliminary},
+//            "filename": {filepath on server, will probably change since theres no reason},
+//            "owner": "{owner name}"
+//        }
+//     }
+//     ...
+//   ]
+// }
+socket.on("prelim_queue", function(queue_data){
+    prelim_queue = queue_data
+    update_queue_time()
+})
+
+// Example Data:
+// {
+//   "version": {version after applying the diff},
+//   "length": {length of queue after applying the diff},
+//   "changed": {"{position in queue}": {same format as an entry in the queue above}, ...}
+// }
+socket.on("prelim_queue_diff", function(diff){
+    if (prelim_queue === undefined || diff.version !== prelim_queue.version + 1){
+        // Missed a diff, get the whole queue again
+        socket.emit("prelim_queue_resync")
+        return
+    }
+    prelim_queue.queue.length = Math.min(prelim_queue.queue.length, diff.length)
+    for (const position in diff.changed){
+        prelim_queue.queue[Number(position)] = diff.changed[position]
+    }
+    prelim_queue.version = diff.version
+    update_queue_time()
+})
+// This should create some sort of pop-up-like thing asking user to clean plate
+
+// Listen for the cleanup request from the server
+socket.on("request_plate_cleanup", function (cleanup_msg) {
+
+    // Extract printId from the message
+    const printer_name = cleanup_msg.printer_name || 'unknown';
+
+    // Call the function to create the cleanup prompt
+    createTakeoutPrompt(printer_name.replace(/ /g, "_"), cleanup_msg.msg || "A cleanup is required!");
+    // This should remove said pop-up
+})
+socket.on("plate_is_clean", function(data){
+    // console.log("plate_is_clean")
+    // console.log(data)
+    printer_name = data["printer_name"]
+    msg = data["msg"]
+
+    request_cleanup_el = document.getElementById(`prompt-${printer_name}`)
+    if (request_cleanup_el === undefined){
+        request_cleanup_el.remove();
+    }
+    console.log(msg)
+})
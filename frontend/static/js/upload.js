@@ -84,6 +84,56 @@ function removeFile(index) {
     updateFileList();
 }
 
+// Files bigger than this are sent in chunks, the server doesn't take requests bigger than 10 MB
+const SINGLE_UPLOAD_MAX_BYTES = 8 * 1024 * 1024;
+const CHUNK_RETRIES = 3;
+
+// Upload a big file in chunks, the last chunk first so the server can reject a bad file right away.
+// Returns the response of the last chunk, or the first response that failed
+async function uploadInChunks(file) {
+    const startResponse = await fetch("/upload/chunked", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ filename: file.name, size: file.size }),
+    });
+    if (!startResponse.ok) {
+        return startResponse;
+    }
+
+    const upload = await startResponse.json();
+    const offsets = [];
+    for (let offset = 0; offset < file.size; offset += upload.chunk_size) {
+        offsets.push(offset);
+    }
+    offsets.unshift(offsets.pop());
+
+    let response = startResponse;
+    for (const offset of offsets) {
+        const chunk = file.slice(offset, Math.min(offset + upload.chunk_size, file.size));
+
+        // A chunk that failed because of the connection is sent again, the server just writes it over the same bytes
+        for (let attempt = 1; attempt <= CHUNK_RETRIES; attempt++) {
+            try {
+                response = await fetch(`/upload/chunked/${upload.upload_id}?offset=${offset}`, {
+                    method: "PUT",
+                    body: chunk,
+                });
+                break;
+            } catch (error) {
+                if (attempt === CHUNK_RETRIES) {
+                    throw error;
+                }
+            }
+        }
+
+        if (!response.ok) {
+            return response;
+        }
+    }
+
+    return response;
+}
+
 // Add files to the queue and upload
 async function addToQueue() {
     for (let i = 0; i < yourfiles.length; i++) {
@@ -96,15 +146,19 @@ async function addToQueue() {
             await removeQueueFile(existingFileIndex);
         }
 
-        const formData = new FormData();
-        formData.append("file", file);
-
-
         try {
-            const response = await fetch("/upload", {
-                method: "POST",
-                body: formData,
-            });
+            let response;
+            if (file.size > SINGLE_UPLOAD_MAX_BYTES) {
+                response = await uploadInChunks(file);
+            } else {
+                const formData = new FormData();
+                formData.append("file", file);
+
+                response = await fetch("/upload", {
+                    method: "POST",
+                    body: formData,
+                });
+            }
 
 
             const result = await response.json();